@@ -0,0 +1,25 @@
+import logging
+import threading
+
+from cache_db import create_tables
+
+# Logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("app_init")
+
+# Inizializzazione condivisa di homepage e pagine Streamlit: le migrazioni dello
+# schema (colonne nuove, vincoli univoci, vecchia tabella 'cache') girano una
+# volta per processo, prima che una pagina legga dal DB
+_initialized = False
+_lock = threading.Lock()
+
+
+def init_app():
+    """Crea/migra le tabelle alla prima chiamata del processo (idempotente)"""
+    global _initialized
+    with _lock:
+        if _initialized:
+            return
+        create_tables()
+        _initialized = True
+        logger.info("Schema del DB pronto")
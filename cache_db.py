@@ -3,10 +3,21 @@ import json
 import logging
 import pandas as pd
 import numpy as np
-from sqlalchemy import create_engine, Column, String, Text, Integer
+from sqlalchemy import create_engine, Column, String, Text, Integer, Float, DateTime, LargeBinary, UniqueConstraint, func, inspect, text, select, tuple_, delete, update, bindparam
+from sqlalchemy.dialects import sqlite, postgresql
 from sqlalchemy.orm import declarative_base, scoped_session, sessionmaker
 from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
 import math
+import hashlib
+from contextlib import contextmanager
+from statements import FIELD_NAMES
+from kpi_registry import KPI_NAMES, KPI_FORMULA_VERSION
+from record_cache import RecordCache, freeze, _MISSING
+import record_codec
+import datetime
+import threading
+from collections import Counter
 
 # Logging
 logging.basicConfig(level=logging.INFO)
@@ -14,6 +25,8 @@ logger = logging.getLogger("cache_db")
 
 # Base ORM
 Base = declarative_base()
+# Tabelle dismesse, lette solo dalle migrazioni (create_all non le ricrea)
+LegacyBase = declarative_base()
 
 # Engine di DB
 if os.environ.get("STREAMLIT_CLOUD") == "1":
@@ -22,10 +35,21 @@ if os.environ.get("STREAMLIT_CLOUD") == "1":
 else:
     os.makedirs("data", exist_ok=True)
     DATABASE_URL = "sqlite:///data/financials_db.db"
-    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+    # timeout: attesa del lock di scrittura quando più processi scrivono (kpi_materialize --rebuild)
+    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 30})
 
 Session = scoped_session(sessionmaker(bind=engine))
 
+# Cache in memoria davanti ai loader: record già decodificati, condivisi tra le sessioni Streamlit
+financial_records = RecordCache()
+kpi_records = RecordCache()
+ALL_KPIS_KEY = ('*', '*')
+
+
+def cache_stats():
+    """Contatori hit/miss/eviction delle cache in memoria del processo"""
+    return {'financials': financial_records.stats(), 'kpis': kpi_records.stats()}
+
 # Modelli tabella
 #class FinancialCache(Base):
 #    __tablename__ = 'cache'
@@ -34,25 +58,174 @@ Session = scoped_session(sessionmaker(bind=engine))
 #    year = Column(Integer, index=True)
 #    data_json = Column(Text)
 
-class FinancialCache(Base):
+class LegacyFinancialCache(LegacyBase):
+    # Vecchio formato: un blob JSON per symbol/anno (migrato in FinancialCache)
     __tablename__ = 'cache'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     symbol = Column(String, index=True)
     year = Column(Integer, index=True)
-    data_json = Column(String)  # o JSON se usi PostgreSQL con JSONB
-    
+    data_json = Column(String)
+
+# Colonne descrittive dei record, nell'ordine dei dict restituiti dai loader
+RECORD_META_COLUMNS = ['symbol', 'sector', 'industry', 'description', 'stock_exchange', 'year']
+
+class FinancialCache(Base):
+    # Tabella larga tipizzata: una colonna numerica per ogni campo di statements.FIELD_MAP
+    __tablename__ = 'financials'
+    __table_args__ = (UniqueConstraint('symbol', 'year', name='uq_financials_symbol_year'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    symbol = Column(String, index=True)
+    year = Column(Integer, index=True)
+    sector = Column(String, index=True, nullable=True)
+    industry = Column(String, index=True, nullable=True)
+    description = Column(String, nullable=True)
+    stock_exchange = Column(String, index=True, nullable=True)
+    fetched_at = Column(DateTime, index=True, nullable=True)  # ultimo download da Yahoo
+    content_hash = Column(String, nullable=True)  # hash dei valori canonicalizzati della riga
+
+# Un campo nuovo in FIELD_MAP diventa una colonna (aggiunta da create_tables)
+for _field in FIELD_NAMES:
+    setattr(FinancialCache, _field, Column(_field, Float, nullable=True))
+
+FINANCIAL_COLUMNS = RECORD_META_COLUMNS + FIELD_NAMES
+
 class KPICache(Base):
     __tablename__ = 'kpi_cache'
+    __table_args__ = (UniqueConstraint('symbol', 'year', name='uq_kpi_symbol_year'),)
     id = Column(Integer, primary_key=True)
     symbol = Column(String, index=True)
     description = Column(String, index=True, nullable=True)
     year = Column(Integer, index=True)
     kpi_json = Column(Text)
+    kpi_blob = Column(LargeBinary, nullable=True)  # codec binario (record_codec), in alternativa a kpi_json
+    formula_version = Column(String, nullable=True)  # versione delle formule in compute_kpis
+    input_hash = Column(String, nullable=True)  # hash degli input (o dei KPI) della riga
+    content_hash = Column(String, nullable=True)  # hash dei KPI salvati (canonicalizzati)
+    updated_at = Column(DateTime, nullable=True)
+
+class KPIAggregate(Base):
+    # Statistiche cross-section per gruppo di pari: una riga per exchange/settore/industria/anno/KPI.
+    # AGGREGATE_ALL in sector/industry indica il totale del livello superiore.
+    __tablename__ = 'kpi_aggregates'
+    __table_args__ = (
+        UniqueConstraint('stock_exchange', 'year', 'sector', 'industry', 'kpi', name='uq_kpi_aggregates_group'),
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    stock_exchange = Column(String, nullable=False)
+    year = Column(Integer, nullable=False)
+    sector = Column(String, nullable=False)
+    industry = Column(String, nullable=False)
+    kpi = Column(String, nullable=False)
+    count = Column(Integer)
+    mean = Column(Float, nullable=True)
+    median = Column(Float, nullable=True)
+    p10 = Column(Float, nullable=True)
+    p25 = Column(Float, nullable=True)
+    p75 = Column(Float, nullable=True)
+    p90 = Column(Float, nullable=True)
+    min = Column(Float, nullable=True)
+    max = Column(Float, nullable=True)
+    sketch = Column(LargeBinary, nullable=True)  # sketch dei quantili unibile fra exchange (quantile_sketch)
+    updated_at = Column(DateTime, nullable=True)
+
+AGGREGATE_ALL = '*'
+AGGREGATE_STAT_COLUMNS = ['count', 'mean', 'median', 'p10', 'p25', 'p75', 'p90', 'min', 'max']
+AGGREGATE_COLUMNS = ['stock_exchange', 'year', 'sector', 'industry', 'kpi'] + AGGREGATE_STAT_COLUMNS
+
+class IngestionJournal(Base):
+    __tablename__ = 'ingestion_journal'
+    __table_args__ = (UniqueConstraint('run_id', 'symbol', 'year', name='uq_journal_run_symbol_year'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    run_id = Column(String, index=True)
+    symbol = Column(String, index=True)
+    year = Column(Integer)
+    stock_exchange = Column(String, index=True)
+    status = Column(String, index=True, default='pending')  # pending / done / empty / failed
+    attempts = Column(Integer, default=0)
+    last_error = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class CompanyProfile(Base):
+    __tablename__ = 'company_profile'
+
+    symbol = Column(String, primary_key=True)
+    stock_exchange = Column(String, index=True, nullable=True)
+    sector = Column(String, index=True, nullable=True)
+    industry = Column(String, index=True, nullable=True)
+    fetched_at = Column(DateTime, index=True)
+
+class NegativeCache(Base):
+    __tablename__ = 'negative_cache'
+    __table_args__ = (UniqueConstraint('symbol', 'year', name='uq_negative_symbol_year'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    symbol = Column(String, index=True)
+    year = Column(Integer)
+    reason = Column(String)  # no_data / year_missing
+    retry_after = Column(DateTime, index=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class FetchLock(Base):
+    __tablename__ = 'fetch_lock'
+
+    key = Column(String, primary_key=True)
+    owner = Column(String)
+    expires_at = Column(DateTime, index=True)
+
+class TickerDemand(Base):
+    __tablename__ = 'ticker_demand'
+
+    symbol = Column(String, primary_key=True)
+    request_count = Column(Integer, default=0)
+    last_requested_at = Column(DateTime, nullable=True)
+
+def _add_missing_columns():
+    # create_all non modifica tabelle esistenti: aggiungiamo le colonne nuove a mano
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            with engine.begin() as conn:
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                if column.index:
+                    conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{table.name}_{column.name} ON {table.name} ({column.name})'))
+            logger.info(f"Aggiunta colonna {table.name}.{column.name}")
+
+def _ensure_unique_keys():
+    # Tabelle create prima del vincolo: via i doppioni (resta la riga più recente) e indice univoco
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {ix['name'] for ix in inspector.get_indexes(table.name)}
+        existing |= {uq['name'] for uq in inspector.get_unique_constraints(table.name)}
+        for constraint in table.constraints:
+            if not isinstance(constraint, UniqueConstraint) or constraint.name in existing:
+                continue
+            columns = ', '.join(column.name for column in constraint.columns)
+            with engine.begin() as conn:
+                removed = conn.execute(text(
+                    f'DELETE FROM {table.name} WHERE id NOT IN '
+                    f'(SELECT MAX(id) FROM {table.name} GROUP BY {columns})'
+                )).rowcount
+                conn.execute(text(f'CREATE UNIQUE INDEX IF NOT EXISTS {constraint.name} ON {table.name} ({columns})'))
+            logger.info(f"Vincolo {constraint.name} creato su {table.name} ({removed} doppioni rimossi)")
 
 def create_tables():
     Base.metadata.bind = engine
     Base.metadata.create_all(engine)
+    _add_missing_columns()
+    _ensure_unique_keys()
+    migrate_json_cache()
+    backfill_content_hashes()
     logger.info("✅ Tabelle create o già esistenti.")
 
 
@@ -90,42 +263,169 @@ def convert_numpy(obj):
     else:
         return obj
 
-def save_to_db(symbol, years, data_list):
-    session = Session()
+# Chiavi per blocco nelle clausole IN (limite dei parametri di SQLite)
+KEY_CHUNK_SIZE = 500
+
+
+def _canonical(value):
+    # Stessa rappresentazione per valori equivalenti: NaN/inf -> None, -0.0 -> 0.0, numpy -> Python
+    if value is None:
+        return None
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        value = float(value)
+        if not math.isfinite(value):
+            return None
+        return value + 0.0
+    return str(value)
+
+
+def content_hash(values):
+    """Hash (blake2b, 128 bit) di una sequenza di valori canonicalizzati"""
+    canonical = json.dumps([_canonical(v) for v in values], separators=(',', ':'), ensure_ascii=False)
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def financial_content_hash(row):
+    # Le righe di record_to_row (e quelle lette dal DB) sono già canoniche: niente _canonical
+    canonical = json.dumps([row[column] for column in FINANCIAL_COLUMNS], separators=(',', ':'), ensure_ascii=False)
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def kpi_content_hash(description, record):
+    keys = sorted(record)
+    return content_hash([description] + keys + [record[key] for key in keys])
+
+
+# Chiavi cambiate davvero (hash diverso) per chi le sta raccogliendo: vedi track_changes()
+_change_trackers = []
+_change_trackers_lock = threading.Lock()
+
+
+@contextmanager
+def track_changes():
+    """
+    Raccoglie le chiavi (symbol, year) scritte con contenuto diverso durante il blocco:
+    {'financials': set(), 'kpis': set()}. Serve a ricalcolare solo ciò che è cambiato.
+    """
+    tracker = {'financials': set(), 'kpis': set()}
+    with _change_trackers_lock:
+        _change_trackers.append(tracker)
     try:
-        for i, year in enumerate(years):
-            year_int = int(year)
+        yield tracker
+    finally:
+        with _change_trackers_lock:
+            _change_trackers.remove(tracker)
 
-            # Salta se il dato manca o è malformato
-            if i >= len(data_list) or not isinstance(data_list[i], dict) or not data_list[i]:
-                logger.debug(f"Salvataggio SKIPPED per {symbol} anno {year}: no data.")
-                continue
 
-            data_for_year = data_list[i]
+def _emit_changes(table, keys):
+    if not keys:
+        return
+    with _change_trackers_lock:
+        for tracker in _change_trackers:
+            tracker[table].update(keys)
 
-            # Validazione dell'anno nei dati
-            data_year = data_for_year.get("year")
-            if data_year != year_int:
-                logger.warning(f"❌ Mismatch anno nei dati per {symbol}: atteso {year_int}, trovato {data_year}. Salvataggio saltato.")
-                continue
 
-            # Conversione dati e serializzazione JSON
-            data_for_year = convert_numpy(data_for_year)
-            json_data = json.dumps(data_for_year, ensure_ascii=False, allow_nan=False)
+def _insert(model):
+    # INSERT del dialetto corrente, con supporto ON CONFLICT
+    if engine.dialect.name == 'postgresql':
+        return postgresql.insert(model.__table__)
+    return sqlite.insert(model.__table__)
 
-            entry = session.query(FinancialCache).filter_by(symbol=symbol, year=year_int).first()
-            if entry:
-                if entry.data_json != json_data:
-                    entry.data_json = json_data
-                    logger.info(f"Aggiornato FinancialCache per {symbol} anno {year_int}")
-                else:
-                    logger.debug(f"Nessuna modifica per {symbol} anno {year_int}")
+
+def upsert_rows(session, model, rows, key_columns):
+    """
+    INSERT ... ON CONFLICT (chiave) DO UPDATE di tutte le colonne passate.
+    Un solo statement compilato ed eseguito in executemany: su Postgres il
+    driver lo raggruppa in INSERT multi-riga (insertmanyvalues).
+    """
+    if not rows:
+        return
+    columns = list(rows[0].keys())
+    stmt = _insert(model)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=key_columns,
+        set_={column: stmt.excluded[column] for column in columns if column not in key_columns}
+    )
+    session.execute(stmt, rows)
+
+
+def _existing_hashes(session, model, keys):
+    """{(symbol, year): content_hash} delle chiavi già presenti, una query per blocco di chiavi"""
+    existing = {}
+    keys = list(keys)
+    for start in range(0, len(keys), KEY_CHUNK_SIZE):
+        chunk = keys[start:start + KEY_CHUNK_SIZE]
+        query = select(model.symbol, model.year, model.content_hash) \
+            .where(tuple_(model.symbol, model.year).in_(chunk))
+        for symbol, year, row_hash in session.execute(query):
+            existing[(symbol, year)] = row_hash
+    return existing
+
+
+def upsert_financials(records):
+    """
+    Salva in blocco i record (anche di ticker diversi) con INSERT ... ON CONFLICT.
+    Si scrivono solo le righe nuove o con content_hash diverso; per le invariate
+    si aggiorna soltanto fetched_at. Le chiavi cambiate vanno ai track_changes() attivi.
+    Restituisce i conteggi {'inserted', 'updated', 'unchanged'}.
+    """
+    rows = {}
+    for data in records:
+        row = record_to_row(data)
+        row['content_hash'] = financial_content_hash(row)
+        rows[(row['symbol'], row['year'])] = row  # a parità di chiave vince l'ultimo
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    if not rows:
+        return counts
+
+    session = Session()
+    try:
+        existing = _existing_hashes(session, FinancialCache, rows.keys())
+        fetched_at = datetime.datetime.utcnow()
+        changed = []
+        unchanged = []
+        for key, row in rows.items():
+            if key not in existing:
+                counts['inserted'] += 1
+            elif existing[key] != row['content_hash']:
+                counts['updated'] += 1
             else:
-                entry = FinancialCache(symbol=symbol, year=year_int, data_json=json_data)
-                session.add(entry)
-                logger.info(f"Inserito FinancialCache per {symbol} anno {year_int}")
+                counts['unchanged'] += 1
+                unchanged.append(key)
+                continue
+            row['fetched_at'] = fetched_at
+            changed.append(key)
+
+        upsert_rows(session, FinancialCache, [rows[key] for key in changed], ['symbol', 'year'])
+        # fetched_at si aggiorna comunque: il dato è appena stato verificato
+        if unchanged:
+            table = FinancialCache.__table__
+            session.execute(
+                update(table)
+                .where(table.c.symbol == bindparam('b_symbol'), table.c.year == bindparam('b_year'))
+                .values(fetched_at=bindparam('b_fetched_at')),
+                [{'b_symbol': symbol, 'b_year': year, 'b_fetched_at': fetched_at} for symbol, year in unchanged]
+            )
 
+        # Il dato ora esiste: gli eventuali risultati negativi non valgono più
+        keys = list(rows.keys())
+        for start in range(0, len(keys), KEY_CHUNK_SIZE):
+            session.execute(
+                delete(NegativeCache)
+                .where(tuple_(NegativeCache.symbol, NegativeCache.year).in_(keys[start:start + KEY_CHUNK_SIZE]))
+            )
         session.commit()
+        financial_records.invalidate(changed)
+        _emit_changes('financials', changed)
+        logger.info(
+            f"FinancialCache: {counts['inserted']} inseriti, {counts['updated']} aggiornati, "
+            f"{counts['unchanged']} invariati"
+        )
+        return counts
     except Exception as e:
         logger.error(f"Errore salvataggio FinancialCache: {e}")
         session.rollback()
@@ -134,93 +434,424 @@ def save_to_db(symbol, years, data_list):
         session.close()
 
 
+def save_to_db(symbol, years, data_list):
+    records = []
+    for i, year in enumerate(years):
+        year_int = int(year)
+
+        # Salta se il dato manca o è malformato
+        if i >= len(data_list) or not isinstance(data_list[i], dict) or not data_list[i]:
+            logger.debug(f"Salvataggio SKIPPED per {symbol} anno {year}: no data.")
+            continue
 
-def load_from_db(symbol, years):
-    session = Session()
+        data_for_year = data_list[i]
+
+        # Validazione dell'anno nei dati
+        data_year = data_for_year.get("year")
+        if data_year != year_int:
+            logger.warning(f"❌ Mismatch anno nei dati per {symbol}: atteso {year_int}, trovato {data_year}. Salvataggio saltato.")
+            continue
+
+        records.append(dict(data_for_year, symbol=symbol))
+
+    return upsert_financials(records)
+
+
+
+def record_to_row(data):
+    """Record dict -> valori delle colonne tipizzate, già in forma canonica (NaN/inf -> NULL, -0.0 -> 0.0)"""
+    row = {column: data.get(column) for column in RECORD_META_COLUMNS}
+    row['year'] = int(row['year'])
+    for column in ('symbol', 'sector', 'industry', 'description', 'stock_exchange'):
+        if row[column] is not None and not isinstance(row[column], str):
+            row[column] = str(row[column])
+    for field in FIELD_NAMES:
+        value = data.get(field)
+        try:
+            value = float(value) if value is not None else None
+        except (TypeError, ValueError):
+            value = None
+        row[field] = value + 0.0 if value is not None and math.isfinite(value) else None
+    return row
+
+
+def row_to_record(row):
+    """Riga tipizzata (ORM o mapping) -> record dict nel formato storico"""
+    if isinstance(row, dict):
+        return {column: row.get(column) for column in FINANCIAL_COLUMNS}
+    return {column: getattr(row, column) for column in FINANCIAL_COLUMNS}
+
+
+def _financial_select(symbols=None, years=None, stock_exchanges=None, sectors=None, columns=None):
+    table = FinancialCache.__table__
+    query = select(*[table.c[column] for column in (columns or FINANCIAL_COLUMNS)])
+    if symbols is not None:
+        query = query.where(table.c.symbol.in_(list(symbols)))
+    if years is not None:
+        query = query.where(table.c.year.in_([int(y) for y in years]))
+    if stock_exchanges is not None:
+        query = query.where(table.c.stock_exchange.in_(list(stock_exchanges)))
+    if sectors is not None:
+        query = query.where(table.c.sector.in_(list(sectors)))
+    return query
+
+
+# Righe lette per volta dal cursore nei loader in streaming
+STREAM_BATCH_SIZE = 2000
+
+
+def _symbol_chunks(symbols, chunk_size=KEY_CHUNK_SIZE):
+    # Liste di simboli spezzate per restare sotto il limite dei parametri di binding
+    if symbols is None:
+        yield None
+        return
+    symbols = list(symbols)
+    for start in range(0, len(symbols), chunk_size):
+        yield symbols[start:start + chunk_size]
+
+
+def iter_financial_frames(symbols=None, years=None, stock_exchanges=None, sectors=None, columns=None,
+                          chunk_size=KEY_CHUNK_SIZE, batch_size=STREAM_BATCH_SIZE):
+    """
+    DataFrame a blocchi (al massimo `batch_size` righe) letti in streaming:
+    simboli a gruppi di `chunk_size`, solo le colonne richieste, cursore lato
+    server su Postgres. Memoria e tempo alla prima riga non crescono con l'universo.
+    """
+    columns = list(columns or FINANCIAL_COLUMNS)
+    # Campi numerici sempre float64, anche se un blocco li ha tutti NULL (altrimenti object)
+    numeric = {column: 'float64' for column in columns if column in FIELD_NAMES}
+    with engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        for chunk in _symbol_chunks(symbols, chunk_size):
+            if chunk is not None and not chunk:
+                continue
+            result = conn.execute(_financial_select(chunk, years, stock_exchanges, sectors, columns))
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield pd.DataFrame(rows, columns=columns).astype(numeric)
+
+
+def iter_financial_rows(symbols=None, years=None, stock_exchanges=None, sectors=None, columns=None,
+                        chunk_size=KEY_CHUNK_SIZE, batch_size=STREAM_BATCH_SIZE):
+    """Come iter_financial_frames ma una riga (dict) alla volta"""
+    columns = list(columns or FINANCIAL_COLUMNS)
+    with engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        for chunk in _symbol_chunks(symbols, chunk_size):
+            if chunk is not None and not chunk:
+                continue
+            result = conn.execute(_financial_select(chunk, years, stock_exchanges, sectors, columns))
+            while True:
+                rows = result.mappings().fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(row)
+
+
+def load_frame(symbols=None, years=None, stock_exchanges=None, sectors=None, columns=None):
+    """DataFrame tipizzato costruito direttamente dal risultato della query"""
+    columns = list(columns or FINANCIAL_COLUMNS)
     try:
-        query = session.query(FinancialCache).filter(
-            FinancialCache.symbol == symbol,
-            FinancialCache.year.in_([int(y) for y in years])
-        )
-        results = query.all()
-        
-        data_by_year = {}
-        for row in results:
-            try:
-                if isinstance(row.data_json, dict):
-                    parsed = row.data_json
-                else:
-                    parsed = json.loads(row.data_json)
-                parsed['year'] = row.year
-                data_by_year[row.year] = parsed
-            except Exception as e:
-                print(f"Errore nel parsing DB per {symbol} {row.year}: {e}")
-                data_by_year[row.year] = None
-        
-        data = [data_by_year.get(int(year), None) for year in years]
-        
+        frames = list(iter_financial_frames(symbols, years, stock_exchanges, sectors, columns))
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True)
+    except Exception as e:
+        logger.error(f"Errore caricamento DataFrame FinancialCache: {e}")
+        return pd.DataFrame(columns=columns)
+
+
+def _load_financial_records(symbols, years, refresh=False):
+    """
+    {(symbol, year): record in sola lettura} passando dalla cache in memoria;
+    il DB viene letto solo per le chiavi mancanti (anche gli assenti finiscono in cache).
+    Con refresh=True le chiavi si rileggono dal DB (es. dopo una scrittura di un altro processo).
+    """
+    keys = [(symbol, int(year)) for symbol in symbols for year in years]
+    if refresh:
+        financial_records.invalidate(keys)
+    found = {}
+    missing = []
+    for key in keys:
+        record = financial_records.get(key)
+        if record is _MISSING:
+            missing.append(key)
+        elif record is not None:
+            found[key] = record
+    if not missing:
+        return found
+
+    # Token prima della query: una upsert concorrente rende il valore letto non cacheabile
+    tokens = {key: financial_records.token(key) for key in missing}
+    missing_symbols = sorted({symbol for symbol, _ in missing})
+    missing_years = sorted({year for _, year in missing})
+    loaded = {
+        (row['symbol'], row['year']): freeze(row_to_record(row))
+        for row in iter_financial_rows(missing_symbols, missing_years)
+    }
+    for key in missing:
+        record = loaded.get(key)
+        financial_records.put(key, record, token=tokens[key])
+        if record is not None:
+            found[key] = record
+    return found
+
+
+def load_from_db(symbol, years, refresh=False):
+    try:
+        data_by_key = _load_financial_records([symbol], years, refresh=refresh)
+        data = [data_by_key.get((symbol, int(year)), None) for year in years]
+
         return data
     except Exception as e:
         print(f"Errore durante il caricamento da DB per {symbol}: {e}")
         return [None] * len(years)
-    finally:
-        session.close()
+
+def iter_many_from_db(symbols, years, chunk_size=KEY_CHUNK_SIZE):
+    """
+    ((symbol, year), record) in streaming, nell'ordine di symbols e years:
+    una query (o nessuna, se in cache) ogni `chunk_size` simboli.
+    """
+    for chunk in _symbol_chunks(symbols, chunk_size):
+        found = _load_financial_records(chunk, years)
+        for symbol in chunk:
+            for year in years:
+                key = (symbol, int(year))
+                if key in found:
+                    yield key, found[key]
+
 
 def load_many_from_db(symbols, years):
+    try:
+        return dict(iter_many_from_db(symbols, years))
+
+    except Exception as e:
+        print(f"Errore batch load: {e}")
+        return {}
+
+
+def migrate_json_cache(batch_size=1000):
+    """Converte le righe JSON della vecchia tabella 'cache' nella tabella tipizzata"""
+    inspector = inspect(engine)
+    if not inspector.has_table(LegacyFinancialCache.__tablename__):
+        return 0
     session = Session()
     try:
-        query = session.query(FinancialCache).filter(
-            FinancialCache.symbol.in_(symbols),
-            FinancialCache.year.in_([int(y) for y in years])
-        )
-        results = query.all()
+        # Migrazione una tantum: se la tabella nuova ha già dati non facciamo nulla
+        if session.query(FinancialCache.id).first() is not None:
+            return 0
+        legacy_columns = {c['name'] for c in inspector.get_columns(LegacyFinancialCache.__tablename__)}
+        fetched_at_column = text('fetched_at') if 'fetched_at' in legacy_columns else text('NULL')
 
-        data_by_symbol_year = {}
-        for row in results:
+        migrated = 0
+        seen = set()
+        query = select(LegacyFinancialCache.symbol, LegacyFinancialCache.year, LegacyFinancialCache.data_json, fetched_at_column) \
+            .order_by(LegacyFinancialCache.id.desc())
+        batch = []
+        for symbol, year, data_json, fetched_at in session.execute(query):
+            # In caso di doppioni vince la riga più recente
+            if (symbol, year) in seen:
+                continue
+            seen.add((symbol, year))
             try:
-                parsed = json.loads(row.data_json) if isinstance(row.data_json, str) else row.data_json
-                parsed['year'] = row.year
-                data_by_symbol_year[(row.symbol, row.year)] = parsed
+                data = json.loads(data_json) if isinstance(data_json, str) else data_json
+                data['year'] = year
+                row = record_to_row(data)
             except Exception as e:
-                print(f"Errore parsing {row.symbol}-{row.year}: {e}")
-                data_by_symbol_year[(row.symbol, row.year)] = None
-
-        return data_by_symbol_year
-
+                logger.warning(f"Riga legacy non migrabile {symbol}-{year}: {e}")
+                continue
+            row['symbol'] = symbol
+            row['fetched_at'] = fetched_at if isinstance(fetched_at, datetime.datetime) else pd.to_datetime(fetched_at).to_pydatetime() if fetched_at else None
+            batch.append(row)
+            if len(batch) >= batch_size:
+                session.bulk_insert_mappings(FinancialCache, batch)
+                migrated += len(batch)
+                batch = []
+        if batch:
+            session.bulk_insert_mappings(FinancialCache, batch)
+            migrated += len(batch)
+        session.commit()
+        financial_records.clear()
+        logger.info(f"✅ Migrate {migrated} righe da 'cache' (JSON) a 'financials'")
+        return migrated
     except Exception as e:
-        print(f"Errore batch load: {e}")
-        return {}
+        logger.error(f"Errore migrazione cache JSON: {e}")
+        session.rollback()
+        return 0
     finally:
         session.close()
 
 #-------------------------------------------------------------
 
-def save_kpis_to_db(kpi_df):
-    session = Session()
+def backfill_content_hashes(batch_size=2000):
+    """Calcola content_hash per le righe scritte prima che esistesse la colonna"""
+    updated = 0
+    fin_table = FinancialCache.__table__
+    kpi_table = KPICache.__table__
     try:
-        for _, row in kpi_df.iterrows():
-            symbol = row['symbol']
-            year = int(row['year'])
-
-            # Controlla solo su symbol + year, IGNORA description per decidere se esiste
-            exists = session.query(KPICache).filter_by(symbol=symbol, year=year).first()
-            if exists:
-                # La combinazione esiste già, NON FARE NULLA
-                logger.info(f"Record già esistente per {symbol} anno {year}, salto inserimento")
+        with engine.connect() as conn:
+            fin_rows = conn.execute(
+                select(fin_table.c.id, *[fin_table.c[column] for column in FINANCIAL_COLUMNS])
+                .where(fin_table.c.content_hash.is_(None))
+            ).mappings().all()
+            kpi_rows = conn.execute(
+                select(kpi_table.c.id, kpi_table.c.description, kpi_table.c.kpi_json, kpi_table.c.kpi_blob)
+                .where(kpi_table.c.content_hash.is_(None))
+            ).all()
+        fin_updates = [{'b_id': row['id'], 'b_hash': financial_content_hash(row)} for row in fin_rows]
+        kpi_updates = []
+        for row_id, description, kpi_json, kpi_blob in kpi_rows:
+            try:
+                record = decode_kpi_payload(kpi_json, kpi_blob)
+            except Exception:
                 continue
+            kpi_updates.append({'b_id': row_id, 'b_hash': kpi_content_hash(description, record)})
+
+        for table, updates in ((fin_table, fin_updates), (kpi_table, kpi_updates)):
+            stmt = update(table).where(table.c.id == bindparam('b_id')).values(content_hash=bindparam('b_hash'))
+            for start in range(0, len(updates), batch_size):
+                with engine.begin() as conn:
+                    conn.execute(stmt, updates[start:start + batch_size])
+            updated += len(updates)
+        if updated:
+            logger.info(f"content_hash calcolato per {updated} righe esistenti")
+        return updated
+    except Exception as e:
+        logger.error(f"Errore backfill content_hash: {e}")
+        return updated
 
-            # Se non esiste, inserisci nuova riga (con description anche se è NULL)
-            desc = row.get('description', None)
 
-            data = row.drop(['symbol','year','description'], errors='ignore').to_dict()
-            data = convert_numpy(data)
-            json_data = json.dumps(data, ensure_ascii=False, allow_nan=False, sort_keys=True)
+# Formato di salvataggio dei KPI: 'json' (kpi_json) oppure 'binary' (kpi_blob, record_codec).
+# La lettura riconosce entrambi, quindi si può cambiare senza migrare le righe esistenti.
+KPI_STORAGE_FORMAT = os.environ.get("KPI_STORAGE_FORMAT", "json")
+RECORD_CODEC_COMPRESSION = os.environ.get("RECORD_CODEC_COMPRESSION", "zlib")
+
+
+def encode_kpi_payload(record):
+    """(kpi_json, kpi_blob) per un record di KPI secondo KPI_STORAGE_FORMAT"""
+    if KPI_STORAGE_FORMAT == 'binary' and record_codec.encodable(record, record_codec.SCHEMA_KPIS):
+        return None, record_codec.encode(record, record_codec.SCHEMA_KPIS, RECORD_CODEC_COMPRESSION)
+    # KPI fuori schema: si resta su JSON
+    return json.dumps(record, ensure_ascii=False, allow_nan=False, sort_keys=True), None
+
+
+def decode_kpi_payload(kpi_json, kpi_blob=None):
+    """Record di KPI da kpi_blob (codec binario) o da kpi_json"""
+    if kpi_blob is not None:
+        return record_codec.decode(kpi_blob)
+    if isinstance(kpi_json, str):
+        return json.loads(kpi_json)
+    if isinstance(kpi_json, dict):
+        return dict(kpi_json)
+    raise ValueError(f"Formato inatteso in kpi_json: {type(kpi_json)}")
+
+
+def frame_hashes(df, columns):
+    """Hash esadecimale per riga delle colonne indicate (vettoriale, indipendente dall'indice)"""
+    hashes = pd.util.hash_pandas_object(df[columns], index=False)
+    return hashes.map('{:016x}'.format)
 
-            entry = KPICache(symbol=symbol, year=year, description=desc, kpi_json=json_data)
-            session.add(entry)
-            logger.info(f"Inserito KPICache per {symbol} anno {year}")
 
+def _existing_kpi_versions(session, keys):
+    """{(symbol, year): (formula_version, input_hash, content_hash)} delle righe KPI già presenti"""
+    existing = {}
+    keys = list(keys)
+    for start in range(0, len(keys), KEY_CHUNK_SIZE):
+        chunk = keys[start:start + KEY_CHUNK_SIZE]
+        query = select(KPICache.symbol, KPICache.year, KPICache.formula_version, KPICache.input_hash, KPICache.content_hash) \
+            .where(tuple_(KPICache.symbol, KPICache.year).in_(chunk))
+        for symbol, year, formula_version, input_hash, row_hash in session.execute(query):
+            existing[(symbol, year)] = (formula_version, input_hash, row_hash)
+    return existing
+
+
+def save_kpis_to_db(kpi_df, formula_version=None, input_hashes=None, force=False):
+    """
+    Materializza un DataFrame di KPI in KPICache con un unico upsert su (symbol, year).
+    Vengono riscritte solo le righe nuove o con versione delle formule / hash degli
+    input cambiati. `input_hashes` è una Series indicizzata per (symbol, year);
+    se manca, l'hash è calcolato sui KPI stessi. Si salvano solo le colonne del
+    registro dei KPI (kpi_registry), nel suo ordine. Con force=True si riscrivono
+    tutte le righe, ignorando versione e hash salvati.
+    Restituisce i conteggi {'inserted', 'updated', 'unchanged'}.
+    """
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    if kpi_df is None or kpi_df.empty:
+        return counts
+    if formula_version is None:
+        formula_version = kpi_df.attrs.get('formula_version', KPI_FORMULA_VERSION)
+
+    df = kpi_df.copy()
+    if 'description' not in df.columns:
+        df['description'] = None
+    df['year'] = pd.to_numeric(df['year'], errors='coerce')
+    df = df.dropna(subset=['symbol', 'year'])
+    df['year'] = df['year'].astype(int)
+    df = df.drop_duplicates(subset=['symbol', 'year'], keep='last')
+    kpi_columns = [name for name in KPI_NAMES if name in df.columns]
+
+    if input_hashes is not None:
+        keys = pd.MultiIndex.from_frame(df[['symbol', 'year']])
+        df['input_hash'] = input_hashes.reindex(keys).to_numpy()
+    else:
+        df['input_hash'] = frame_hashes(df, kpi_columns + ['description']).to_numpy()
+
+    session = Session()
+    try:
+        # Prima il confronto con le versioni salvate: si serializzano solo le righe da riscrivere
+        existing = _existing_kpi_versions(session, zip(df['symbol'], df['year']))
+        write = []
+        for symbol, year, input_hash in zip(df['symbol'], df['year'], df['input_hash']):
+            previous = existing.get((symbol, int(year)))
+            stale = force or previous is None or previous[:2] != (formula_version, input_hash)
+            counts['inserted' if previous is None else 'updated' if stale else 'unchanged'] += 1
+            write.append(stale)
+        df = df[write]
+
+        # Serializzazione: NaN/inf -> mancanti, formato scelto da KPI_STORAGE_FORMAT
+        values = df[kpi_columns].apply(pd.to_numeric, errors='coerce').replace([np.inf, -np.inf], np.nan)
+        values = values.astype(object).where(values.notna(), None)
+        records = values.to_dict('records')
+
+        now = datetime.datetime.utcnow()
+        rows = []
+        changed = []
+        for symbol, year, description, input_hash, record in zip(
+            df['symbol'], df['year'], df['description'], df['input_hash'], records
+        ):
+            key = (symbol, int(year))
+            description = description if isinstance(description, str) else None
+            kpi_json, kpi_blob = encode_kpi_payload(record)
+            row_hash = kpi_content_hash(description, record)
+            # Per chi sta a valle conta solo se i KPI salvati sono cambiati
+            previous = existing.get(key)
+            if previous is None or previous[2] != row_hash:
+                changed.append(key)
+            rows.append({
+                'symbol': symbol,
+                'year': int(year),
+                'description': description,
+                'kpi_json': kpi_json,
+                'kpi_blob': kpi_blob,
+                'formula_version': formula_version,
+                'input_hash': input_hash if isinstance(input_hash, str) else None,
+                'content_hash': row_hash,
+                'updated_at': now,
+            })
+
+        upsert_rows(session, KPICache, rows, ['symbol', 'year'])
         session.commit()
+        if changed:
+            kpi_records.invalidate(changed + [ALL_KPIS_KEY])
+        _emit_changes('kpis', changed)
+        logger.info(
+            f"KPICache: {counts['inserted']} inseriti, {counts['updated']} aggiornati, "
+            f"{counts['unchanged']} invariati"
+        )
+        return counts
     except Exception as e:
         logger.error(f"Errore salvataggio KPICache: {e}")
         session.rollback()
@@ -230,60 +861,565 @@ def save_kpis_to_db(kpi_df):
 
 
 
+def _decode_kpi_entry(symbol, year, description, kpi_json, kpi_blob):
+    data = decode_kpi_payload(kpi_json, kpi_blob)
+    data.update({'symbol': symbol, 'year': year, 'description': description})
+    return freeze(data)
+
+
 def load_kpis_for_symbol_year(symbol, year, description=None):
-    session = Session()
     try:
-        query = session.query(KPICache).filter_by(symbol=symbol, year=year)
-        if description is not None:
-            query = query.filter_by(description=description)
-        entry = query.first()
-        if entry:
-            if isinstance(entry.kpi_json, str):
-                data = json.loads(entry.kpi_json)
-            elif isinstance(entry.kpi_json, dict):
-                data = entry.kpi_json
-            else:
-                raise ValueError(f"Formato inatteso in kpi_json: {type(entry.kpi_json)}")
-            data.update({'symbol': entry.symbol, 'year': entry.year, 'description': entry.description})
-            return pd.DataFrame([data])
+        key = (symbol, int(year))
+        data = kpi_records.get(key)
+        if data is _MISSING:
+            token = kpi_records.token(key)
+            session = Session()
+            try:
+                entry = session.query(KPICache.symbol, KPICache.year, KPICache.description, KPICache.kpi_json, KPICache.kpi_blob) \
+                    .filter_by(symbol=symbol, year=int(year)).first()
+            finally:
+                session.close()
+            data = _decode_kpi_entry(*entry) if entry else None
+            kpi_records.put(key, data, token=token)
+        if data is not None and (description is None or data['description'] == description):
+            return pd.DataFrame([dict(data)])
         else:
             return pd.DataFrame()
     except Exception as e:
         logger.error(f"Errore caricamento KPICache per {symbol} {year}: {e}")
         return pd.DataFrame()
-    finally:
-        session.close()
 
 def load_all_kpis():
-    session = Session()
     try:
-        entries = session.query(KPICache).all()
-        if not entries:
-            return pd.DataFrame()
-        rows = []
-        for entry in entries:
+        rows = kpi_records.get(ALL_KPIS_KEY)
+        if rows is _MISSING:
+            token = kpi_records.token(ALL_KPIS_KEY)
+            session = Session()
             try:
-                if isinstance(entry.kpi_json, str):
-                    data = json.loads(entry.kpi_json)
-                elif isinstance(entry.kpi_json, dict):
-                    data = entry.kpi_json
-                else:
-                    # Prova a convertire a stringa prima di json.loads
-                    try:
-                        json_str = str(entry.kpi_json)
-                        data = json.loads(json_str)
-                    except Exception:
-                        raise ValueError(f"Formato inatteso in kpi_json: {type(entry.kpi_json)}")
-
-            except Exception as e:
-                logger.error(f"Errore parsing JSON per {entry.symbol} {entry.year}: {e}")
-                continue
-            data.update({'symbol': entry.symbol, 'year': entry.year, 'description': entry.description})
-            rows.append(data)
-        return pd.DataFrame(rows)
+                entries = session.query(KPICache.symbol, KPICache.year, KPICache.description, KPICache.kpi_json, KPICache.kpi_blob).all()
+            finally:
+                session.close()
+            rows = []
+            for entry in entries:
+                try:
+                    rows.append(_decode_kpi_entry(*entry))
+                except Exception as e:
+                    logger.error(f"Errore parsing JSON per {entry.symbol} {entry.year}: {e}")
+            # Una sola voce per l'intera tabella, invalidata da ogni salvataggio di KPI
+            rows = tuple(rows)
+            kpi_records.put(ALL_KPIS_KEY, rows, token=token)
+        if not rows:
+            return pd.DataFrame()
+        return pd.DataFrame([dict(data) for data in rows])
     except Exception as e:
         logger.error(f"Errore caricamento tutti i KPI: {e}")
         return pd.DataFrame()
+
+
+def replace_kpi_aggregates(rows, groups):
+    """
+    Sostituisce in una transazione gli aggregati dei gruppi (stock_exchange, year)
+    indicati con `rows` (dict con AGGREGATE_COLUMNS e sketch): chi legge
+    vede il prima o il dopo.
+    """
+    groups = list(groups)
+    session = Session()
+    try:
+        for start in range(0, len(groups), KEY_CHUNK_SIZE):
+            chunk = groups[start:start + KEY_CHUNK_SIZE]
+            session.execute(
+                delete(KPIAggregate).where(tuple_(KPIAggregate.stock_exchange, KPIAggregate.year).in_(chunk))
+            )
+        if rows:
+            now = datetime.datetime.utcnow()
+            session.execute(KPIAggregate.__table__.insert(), [dict(row, updated_at=now) for row in rows])
+        session.commit()
+        logger.info(f"KPIAggregate: {len(rows)} righe per {len(groups)} gruppi exchange/anno")
+        return len(rows)
+    except Exception as e:
+        logger.error(f"Errore salvataggio KPIAggregate: {e}")
+        session.rollback()
+        raise
     finally:
         session.close()
 
+
+def load_kpi_aggregates(stock_exchange, year, sector=None, industry=None, kpis=None):
+    """
+    Aggregati di un exchange/anno (lettura sull'indice univoco). sector/industry
+    filtrano il livello: es. industry=AGGREGATE_ALL dà una riga per settore e KPI.
+    """
+    session = Session()
+    try:
+        query = select(*[getattr(KPIAggregate, column) for column in AGGREGATE_COLUMNS]) \
+            .where(KPIAggregate.stock_exchange == stock_exchange, KPIAggregate.year == int(year))
+        if sector is not None:
+            query = query.where(KPIAggregate.sector == sector)
+        if industry is not None:
+            query = query.where(KPIAggregate.industry == industry)
+        if kpis is not None:
+            query = query.where(KPIAggregate.kpi.in_(list(kpis)))
+        return pd.DataFrame(session.execute(query).all(), columns=AGGREGATE_COLUMNS)
+    except Exception as e:
+        logger.error(f"Errore caricamento KPIAggregate per {stock_exchange} {year}: {e}")
+        return pd.DataFrame(columns=AGGREGATE_COLUMNS)
+    finally:
+        session.close()
+
+
+def aggregated_groups():
+    """(stock_exchange, year) già presenti in kpi_aggregates con gli sketch"""
+    session = Session()
+    try:
+        query = select(KPIAggregate.stock_exchange, KPIAggregate.year).where(KPIAggregate.sketch.isnot(None)).distinct()
+        return {(exchange, int(year)) for exchange, year in session.execute(query)}
+    finally:
+        session.close()
+
+
+def load_kpi_sketches(year, stock_exchanges=None, sector=AGGREGATE_ALL, industry=AGGREGATE_ALL, kpis=None):
+    """
+    {(stock_exchange, sector, industry, kpi): blob dello sketch} di un anno, per
+    alcuni exchange (default tutti). sector=None/industry=None non filtrano il livello.
+    """
+    session = Session()
+    try:
+        query = select(KPIAggregate.stock_exchange, KPIAggregate.sector, KPIAggregate.industry, KPIAggregate.kpi, KPIAggregate.sketch) \
+            .where(KPIAggregate.year == int(year))
+        if stock_exchanges is not None:
+            query = query.where(KPIAggregate.stock_exchange.in_(list(stock_exchanges)))
+        if sector is not None:
+            query = query.where(KPIAggregate.sector == sector)
+        if industry is not None:
+            query = query.where(KPIAggregate.industry == industry)
+        if kpis is not None:
+            query = query.where(KPIAggregate.kpi.in_(list(kpis)))
+        return {
+            (exchange, sector, industry, kpi): sketch
+            for exchange, sector, industry, kpi, sketch in session.execute(query)
+            if sketch is not None
+        }
+    except Exception as e:
+        logger.error(f"Errore caricamento sketch KPI per {year}: {e}")
+        return {}
+    finally:
+        session.close()
+
+
+#-------------------------------------------------------------
+# Journal di ingestion: stato per ticker/anno di ogni refresh completo
+
+# skipped: anno non scaricato perché in cache negativa (vuoto upstream in un run precedente)
+JOURNAL_STATUSES = ['done', 'empty', 'skipped', 'failed', 'pending']
+
+
+def journal_start_run(run_id, jobs, years):
+    """Registra come 'pending' le coppie ticker/anno del run non ancora presenti nel journal"""
+    session = Session()
+    try:
+        existing = {
+            (symbol, year) for symbol, year in
+            session.query(IngestionJournal.symbol, IngestionJournal.year).filter_by(run_id=run_id)
+        }
+        now = datetime.datetime.utcnow()
+        new_rows = []
+        for job in jobs:
+            for year in years:
+                if (job['symbol'], int(year)) in existing:
+                    continue
+                new_rows.append({
+                    'run_id': run_id,
+                    'symbol': job['symbol'],
+                    'year': int(year),
+                    'stock_exchange': job.get('stock_exchange'),
+                    'status': 'pending',
+                    'attempts': 0,
+                    'updated_at': now,
+                })
+        if new_rows:
+            session.bulk_insert_mappings(IngestionJournal, new_rows)
+        session.commit()
+        logger.info(f"Journal {run_id}: {len(new_rows)} nuove righe pending")
+    except Exception as e:
+        logger.error(f"Errore inizializzazione journal {run_id}: {e}")
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def journal_pending_work(run_id, max_attempts=3):
+    """Anni ancora da fare per ogni ticker: pending, oppure failed con tentativi residui"""
+    session = Session()
+    try:
+        rows = session.query(IngestionJournal.symbol, IngestionJournal.year).filter(
+            IngestionJournal.run_id == run_id,
+            (IngestionJournal.status == 'pending') |
+            ((IngestionJournal.status == 'failed') & (IngestionJournal.attempts < max_attempts))
+        ).all()
+        pending = {}
+        for symbol, year in rows:
+            pending.setdefault(symbol, []).append(year)
+        return pending
+    finally:
+        session.close()
+
+
+def journal_record(run_id, symbol, years, status, error=None):
+    """Aggiorna stato, tentativi, errore e timestamp per i ticker/anno indicati"""
+    if not years:
+        return
+    session = Session()
+    try:
+        session.query(IngestionJournal).filter(
+            IngestionJournal.run_id == run_id,
+            IngestionJournal.symbol == symbol,
+            IngestionJournal.year.in_([int(y) for y in years])
+        ).update({
+            IngestionJournal.status: status,
+            IngestionJournal.attempts: IngestionJournal.attempts + 1,
+            IngestionJournal.last_error: str(error)[:1000] if error else None,
+            IngestionJournal.updated_at: datetime.datetime.utcnow(),
+        }, synchronize_session=False)
+        session.commit()
+    except Exception as e:
+        logger.error(f"Errore aggiornamento journal per {symbol}: {e}")
+        session.rollback()
+    finally:
+        session.close()
+
+
+def journal_latest_open_run(max_attempts=3):
+    """run_id più recente con lavoro ancora da completare (None se non esiste)"""
+    session = Session()
+    try:
+        row = session.query(IngestionJournal.run_id).filter(
+            (IngestionJournal.status == 'pending') |
+            ((IngestionJournal.status == 'failed') & (IngestionJournal.attempts < max_attempts))
+        ).order_by(IngestionJournal.run_id.desc()).first()
+        return row[0] if row else None
+    finally:
+        session.close()
+
+
+def journal_summary(run_id=None):
+    """Conteggi done/empty/failed/pending per exchange (ultimo run se run_id è None)"""
+    session = Session()
+    try:
+        if run_id is None:
+            run_id = session.query(func.max(IngestionJournal.run_id)).scalar()
+            if run_id is None:
+                return pd.DataFrame(columns=['stock_exchange'] + JOURNAL_STATUSES)
+        rows = session.query(
+            IngestionJournal.stock_exchange, IngestionJournal.status, func.count(IngestionJournal.id)
+        ).filter_by(run_id=run_id).group_by(IngestionJournal.stock_exchange, IngestionJournal.status).all()
+
+        df = pd.DataFrame(rows, columns=['stock_exchange', 'status', 'count'])
+        summary = df.pivot_table(index='stock_exchange', columns='status', values='count', aggfunc='sum', fill_value=0)
+        summary = summary.reindex(columns=JOURNAL_STATUSES, fill_value=0).reset_index()
+        summary.columns.name = None
+        return summary
+    except Exception as e:
+        logger.error(f"Errore lettura journal: {e}")
+        return pd.DataFrame(columns=['stock_exchange'] + JOURNAL_STATUSES)
+    finally:
+        session.close()
+
+
+#-------------------------------------------------------------
+# Domanda per ticker (richieste dalle pagine) e freschezza dei dati
+
+DEMAND_FLUSH_SECONDS = 60
+DEMAND_FLUSH_SIZE = 200
+
+_demand_buffer = Counter()
+_demand_lock = threading.Lock()
+_demand_flushed_at = datetime.datetime.utcnow()
+
+
+def record_demand(symbol):
+    """Conta una richiesta per il ticker; i contatori sono scritti a blocchi"""
+    global _demand_flushed_at
+    with _demand_lock:
+        _demand_buffer[symbol] += 1
+        now = datetime.datetime.utcnow()
+        if len(_demand_buffer) < DEMAND_FLUSH_SIZE and (now - _demand_flushed_at).total_seconds() < DEMAND_FLUSH_SECONDS:
+            return
+        pending = dict(_demand_buffer)
+        _demand_buffer.clear()
+        _demand_flushed_at = now
+    flush_demand(pending, now)
+
+
+def flush_demand(counts, requested_at=None):
+    if not counts:
+        return
+    requested_at = requested_at or datetime.datetime.utcnow()
+    session = Session()
+    try:
+        existing = {
+            row.symbol: row for row in
+            session.query(TickerDemand).filter(TickerDemand.symbol.in_(list(counts)))
+        }
+        for symbol, count in counts.items():
+            entry = existing.get(symbol)
+            if entry:
+                entry.request_count = (entry.request_count or 0) + count
+                entry.last_requested_at = requested_at
+            else:
+                session.add(TickerDemand(symbol=symbol, request_count=count, last_requested_at=requested_at))
+        session.commit()
+    except Exception as e:
+        logger.error(f"Errore salvataggio TickerDemand: {e}")
+        session.rollback()
+    finally:
+        session.close()
+
+
+def load_refresh_candidates():
+    """Per ogni ticker in cache: fetched_at più vecchio tra gli anni e numero di richieste"""
+    session = Session()
+    try:
+        freshness = session.query(
+            FinancialCache.symbol, func.min(FinancialCache.fetched_at).label('fetched_at'),
+            func.count(FinancialCache.id).label('years_cached')
+        ).group_by(FinancialCache.symbol).all()
+        demand = session.query(TickerDemand.symbol, TickerDemand.request_count).all()
+
+        df = pd.DataFrame(freshness, columns=['symbol', 'fetched_at', 'years_cached'])
+        df_demand = pd.DataFrame(demand, columns=['symbol', 'request_count'])
+        df = pd.merge(df, df_demand, on='symbol', how='outer')
+        df['request_count'] = df['request_count'].fillna(0).astype(int)
+        df['years_cached'] = df['years_cached'].fillna(0).astype(int)
+        return df
+    except Exception as e:
+        logger.error(f"Errore caricamento candidati refresh: {e}")
+        return pd.DataFrame(columns=['symbol', 'fetched_at', 'years_cached', 'request_count'])
+    finally:
+        session.close()
+
+
+#-------------------------------------------------------------
+# Cache negativa: ticker/anni per cui Yahoo non ha dati
+
+# Giorni prima di riprovare, per motivo
+NEGATIVE_TTL_DAYS = {
+    'no_data': 7,        # nessun prospetto per il ticker
+    'year_missing': 3,   # prospetti presenti ma senza l'anno richiesto
+}
+
+# Un primo "nessun dato" può essere throttling silenzioso di Yahoo (frame vuoti
+# invece di un 429): il TTL pieno vale solo se il vuoto si ripete, la prima
+# volta si riprova dopo qualche ora
+NEGATIVE_UNCONFIRMED_TTL_DAYS = 0.25
+NEGATIVE_CONFIRMED_REASONS = ('no_data',)
+
+
+def save_negative(symbol, years, reason, ttl_days=None):
+    """Registra (o rinnova) un risultato negativo per i ticker/anno indicati"""
+    if not years:
+        return
+    confirm = ttl_days is None and reason in NEGATIVE_CONFIRMED_REASONS
+    ttl_days = NEGATIVE_TTL_DAYS.get(reason, 1) if ttl_days is None else ttl_days
+    now = datetime.datetime.utcnow()
+    years = [int(y) for y in years]
+    session = Session()
+    try:
+        existing = {
+            row.year: row for row in
+            session.query(NegativeCache).filter(NegativeCache.symbol == symbol, NegativeCache.year.in_(years))
+        }
+        for year in years:
+            entry = existing.get(year)
+            # Conferma = c'era già un risultato negativo per l'anno (anche scaduto)
+            days = NEGATIVE_UNCONFIRMED_TTL_DAYS if confirm and entry is None else ttl_days
+            retry_after = now + datetime.timedelta(days=days)
+            if entry:
+                entry.reason = reason
+                entry.retry_after = retry_after
+                entry.created_at = now
+            else:
+                session.add(NegativeCache(symbol=symbol, year=year, reason=reason, retry_after=retry_after, created_at=now))
+        session.commit()
+        logger.info(f"Cache negativa per {symbol} anni {years}: {reason}")
+    except Exception as e:
+        logger.error(f"Errore salvataggio NegativeCache per {symbol}: {e}")
+        session.rollback()
+    finally:
+        session.close()
+
+
+def load_negative(symbol, years):
+    """Anni (int) di `symbol` con un risultato negativo ancora valido"""
+    return {year for _, year in load_negative_many([symbol], years)}
+
+
+def load_negative_many(symbols, years):
+    """Coppie (symbol, anno) con un risultato negativo ancora valido"""
+    if not symbols or not years:
+        return set()
+    session = Session()
+    try:
+        rows = session.query(NegativeCache.symbol, NegativeCache.year).filter(
+            NegativeCache.symbol.in_(list(symbols)),
+            NegativeCache.year.in_([int(y) for y in years]),
+            NegativeCache.retry_after > datetime.datetime.utcnow()
+        ).all()
+        return {(symbol, year) for symbol, year in rows}
+    except Exception as e:
+        logger.error(f"Errore lettura NegativeCache: {e}")
+        return set()
+    finally:
+        session.close()
+
+
+#-------------------------------------------------------------
+# Lock di download tra processi (una riga per chiave in volo)
+
+def try_acquire_fetch_lock(key, owner, ttl_seconds=300):
+    """True se il lock è stato preso; i lock scaduti vengono liberati"""
+    session = Session()
+    try:
+        now = datetime.datetime.utcnow()
+        session.query(FetchLock).filter(FetchLock.key == key, FetchLock.expires_at < now).delete(synchronize_session=False)
+        session.add(FetchLock(key=key, owner=owner, expires_at=now + datetime.timedelta(seconds=ttl_seconds)))
+        session.commit()
+        return True
+    except IntegrityError:
+        session.rollback()
+        return False
+    except Exception as e:
+        logger.error(f"Errore acquisizione FetchLock {key}: {e}")
+        session.rollback()
+        return False
+    finally:
+        session.close()
+
+
+def release_fetch_lock(key, owner):
+    session = Session()
+    try:
+        session.query(FetchLock).filter_by(key=key, owner=owner).delete(synchronize_session=False)
+        session.commit()
+    except Exception as e:
+        logger.error(f"Errore rilascio FetchLock {key}: {e}")
+        session.rollback()
+    finally:
+        session.close()
+
+
+def fetch_lock_held(key):
+    session = Session()
+    try:
+        return session.query(FetchLock.key).filter(
+            FetchLock.key == key, FetchLock.expires_at >= datetime.datetime.utcnow()
+        ).first() is not None
+    finally:
+        session.close()
+
+
+#-------------------------------------------------------------
+# Profilo societario (sector/industry) con refresh lungo e indipendente
+
+PROFILE_TTL_DAYS = float(os.environ.get("PROFILE_TTL_DAYS", "90"))
+
+
+def save_profile(symbol, sector, industry, stock_exchange=None, fetched_at=None):
+    session = Session()
+    try:
+        entry = session.get(CompanyProfile, symbol)
+        if entry is None:
+            entry = CompanyProfile(symbol=symbol)
+            session.add(entry)
+        entry.sector = sector
+        entry.industry = industry
+        if stock_exchange:
+            entry.stock_exchange = stock_exchange
+        entry.fetched_at = fetched_at or datetime.datetime.utcnow()
+        session.commit()
+    except Exception as e:
+        logger.error(f"Errore salvataggio CompanyProfile per {symbol}: {e}")
+        session.rollback()
+    finally:
+        session.close()
+
+
+def load_profile(symbol, max_age_days=PROFILE_TTL_DAYS):
+    """{'sector', 'industry'} se il profilo esiste ed è più recente di max_age_days, altrimenti None"""
+    session = Session()
+    try:
+        entry = session.get(CompanyProfile, symbol)
+        if entry is None or entry.fetched_at is None:
+            return None
+        if entry.fetched_at < datetime.datetime.utcnow() - datetime.timedelta(days=max_age_days):
+            return None
+        return {'sector': entry.sector, 'industry': entry.industry}
+    except Exception as e:
+        logger.error(f"Errore lettura CompanyProfile per {symbol}: {e}")
+        return None
+    finally:
+        session.close()
+
+
+def load_profiles(symbols=None, stock_exchanges=None):
+    """DataFrame symbol/stock_exchange/sector/industry/fetched_at, filtrabile per simboli o exchange"""
+    session = Session()
+    try:
+        query = session.query(
+            CompanyProfile.symbol, CompanyProfile.stock_exchange, CompanyProfile.sector,
+            CompanyProfile.industry, CompanyProfile.fetched_at
+        )
+        if symbols is not None:
+            query = query.filter(CompanyProfile.symbol.in_(list(symbols)))
+        if stock_exchanges is not None:
+            query = query.filter(CompanyProfile.stock_exchange.in_(list(stock_exchanges)))
+        return pd.DataFrame(query.all(), columns=['symbol', 'stock_exchange', 'sector', 'industry', 'fetched_at'])
+    except Exception as e:
+        logger.error(f"Errore caricamento CompanyProfile: {e}")
+        return pd.DataFrame(columns=['symbol', 'stock_exchange', 'sector', 'industry', 'fetched_at'])
+    finally:
+        session.close()
+
+
+def stale_profile_symbols(symbols, max_age_days=PROFILE_TTL_DAYS):
+    """Simboli senza profilo o con profilo più vecchio di max_age_days, dal più vecchio"""
+    profiles = load_profiles(symbols)
+    limit = datetime.datetime.utcnow() - datetime.timedelta(days=max_age_days)
+    fresh = set(profiles.loc[pd.to_datetime(profiles['fetched_at']) >= limit, 'symbol'])
+    ages = dict(zip(profiles['symbol'], profiles['fetched_at']))
+    stale = [s for s in symbols if s not in fresh]
+    return sorted(stale, key=lambda s: ages.get(s) or datetime.datetime.min)
+
+
+def backfill_profiles_from_cache():
+    """Popola CompanyProfile dai record già in cache (una riga per ticker)"""
+    session = Session()
+    try:
+        known = {symbol for (symbol,) in session.query(CompanyProfile.symbol)}
+        rows = session.query(
+            FinancialCache.symbol, FinancialCache.stock_exchange, FinancialCache.sector,
+            FinancialCache.industry, FinancialCache.fetched_at
+        ).order_by(FinancialCache.symbol, FinancialCache.year.desc()).all()
+        added = 0
+        for symbol, stock_exchange, sector, industry, fetched_at in rows:
+            if symbol in known:
+                continue
+            session.add(CompanyProfile(
+                symbol=symbol,
+                stock_exchange=stock_exchange,
+                sector=sector,
+                industry=industry,
+                # Senza fetched_at il profilo risulta vecchio e verrà riscaricato
+                fetched_at=fetched_at or datetime.datetime(1970, 1, 1)
+            ))
+            known.add(symbol)
+            added += 1
+        session.commit()
+        logger.info(f"Profili ricavati dalla cache: {added}")
+        return added
+    except Exception as e:
+        logger.error(f"Errore backfill CompanyProfile: {e}")
+        session.rollback()
+        return 0
+    finally:
+        session.close()
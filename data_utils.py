@@ -9,7 +9,14 @@ import atexit
 import datetime
 from cache_db import load_from_db
 from cache_db import save_to_db
-import random
+from cache_db import record_demand
+from cache_db import load_negative, save_negative
+from cache_db import load_profile, save_profile
+from providers import get_provider, ProviderError
+from statements import extract_year_block, block_to_records
+from kpi_registry import KPI_PLAN, KPI_FORMULA_VERSION
+import raw_archive
+import singleflight
 import streamlit as st
 
 def read_exchanges(filename):
@@ -28,6 +35,15 @@ def read_companies(filename):
         for row in reader:
             companies.append(row)
     return companies
+
+def read_all_companies(exchanges):
+    # Aziende di tutti gli exchange, ognuna con il proprio exchange in 'stock_exchange'
+    companies = []
+    for exchange_name, filename in exchanges.items():
+        for company in read_companies(filename):
+            company['stock_exchange'] = exchange_name
+            companies.append(company)
+    return companies
     
 ##def format_to_billions(value):
 ##    try:
@@ -36,110 +52,122 @@ def read_companies(filename):
 ##    except Exception:
 ##        return "N/A"
     
-def get_financial_data_from_source(symbol, years, description=None, stock_exchange=None):
-    #Scarica i dati finanziari da Yahoo Finance per ogni anno richiesto
-
-    def format_to_billions(x):
-        try:
-            return float(x) / 1e9
-        except:
-            return 0
-
-    results = []
+def fetch_profile(symbol, stock_exchange=None, provider=None):
+    #Scarica info dal provider e aggiorna il profilo societario
+    if provider is None:
+        provider = get_provider()
+    info = provider.get_info(symbol) or {}
+    save_profile(symbol, info.get('sector', 'N/A'), info.get('industry', 'N/A'), stock_exchange=stock_exchange)
+    return info
+
+def get_financial_data_from_source(symbol, years, description=None, stock_exchange=None, provider=None, raise_errors=False):
+    #Scarica i dati finanziari dal provider (default Yahoo Finance) per ogni anno richiesto
+    # raise_errors=True propaga gli errori upstream (usato dal journal di ingestion)
+    if provider is None:
+        provider = get_provider()
 
     try:
-        stock = yf.Ticker(symbol)
-        financials = stock.financials
-        balance_sheet = stock.balance_sheet
-        cashflow = stock.cashflow
-        info = stock.info
+        statements = provider.get_statements(symbol)
+        financials = statements['financials']
+        balance_sheet = statements['balance_sheet']
+        cashflow = statements['cashflow']
 
         if financials.empty and balance_sheet.empty and cashflow.empty:
             print(f"No financial data found for symbol: {symbol}")
             return []
 
-        # Ottieni anni disponibili nei dati
-        #columns_years = [col.year for col in financials.columns if isinstance(col, pd.Timestamp)]
-        columns_years = []
-        for col in financials.columns:
-            try:
-                parsed = pd.to_datetime(col)
-                columns_years.append(parsed.year)
-            except:
-                continue
-        print(f"[{symbol}] Anni trovati in financials: {columns_years}")
-
+        # info è la chiamata più lenta: la saltiamo se il profilo (sector/industry) è fresco
+        info = load_profile(symbol)
+        if info is None:
+            info = fetch_profile(symbol, stock_exchange=stock_exchange, provider=provider)
 
+        # Archivio grezzo: nuovi campi si ricavano in seguito senza riscaricare.
+        # Con il profilo da DB info ha solo sector/industry: l'archivio conserva
+        # l'ultimo payload completo scaricato e aggiorna solo quei due campi
+        if raw_archive.ARCHIVE_ENABLED:
+            try:
+                raw_archive.archive_statements(symbol, stock_exchange, statements, info)
+            except Exception as e:
+                print(f"Archiviazione grezza fallita per {symbol}: {e}")
 
+        # Estrazione vettoriale di tutti gli anni richiesti in un unico blocco
+        found_years, block = extract_year_block(financials, balance_sheet, cashflow, years)
+        print(f"[{symbol}] Anni trovati in financials: {found_years}")
         for year in years:
-            sleep_time = random.uniform(4, 8)
-            time.sleep(sleep_time)
-            if year not in columns_years:
+            if int(year) not in found_years:
                 print(f"Year {year} not found for symbol {symbol}")
-                continue
-
-            year_index = columns_years.index(year)
-            year_column = financials.columns[year_index]
-
-            # Funzioni di utilità per prendere i dati in modo sicuro
-            def f(idx): return financials.loc[idx, year_column] if idx in financials.index else 0
-            def fb(idx): return balance_sheet.loc[idx, year_column] if idx in balance_sheet.index else 0
-            def fc(idx): return cashflow.loc[idx, year_column] if idx in cashflow.index else 0
-
-            data = {
-                'symbol': symbol,
-                'sector': info.get('sector', 'N/A'),
-                'industry': info.get('industry', 'N/A'),
-                'description': description,
-                'stock_exchange': stock_exchange,
-                'year': year,
-                'total_revenue': format_to_billions(f('Total Revenue')),
-                'operating_revenue': format_to_billions(f('Operating Revenue')),
-                'cost_of_revenue': format_to_billions(f('Cost Of Revenue')),
-                'gross_profit': format_to_billions(f('Gross Profit')),
-                'operating_expense': format_to_billions(f('Operating Expense')),
-                'sg_and_a': format_to_billions(f('Selling General And Administration')),
-                'r_and_d': format_to_billions(f('Research And Development')),
-                'operating_income': format_to_billions(f('Operating Income')),
-                'net_non_operating_interest_income_expense': format_to_billions(f('Net Non Operating Interest Income Expense')),
-                'interest_expense_non_operating': format_to_billions(f('Interest Expense Non Operating')),
-                'pretax_income': format_to_billions(f('Pretax Income')),
-                'tax_provision': format_to_billions(f('Tax Provision')),
-                'net_income_common_stockholders': format_to_billions(f('Net Income Common Stockholders')),
-                'net_income': format_to_billions(f('Net Income')),
-                'net_income_continuous_operations': format_to_billions(f('Net Income Continuous Operations')),
-                'basic_eps': f('Basic EPS'),
-                'diluted_eps': f('Diluted EPS'),
-                'basic_average_shares': format_to_billions(f('Basic Average Shares')),
-                'diluted_average_shares': format_to_billions(f('Diluted Average Shares')),
-                'total_expenses': format_to_billions(f('Total Expenses')),
-                'normalized_income': format_to_billions(f('Normalized Income')),
-                'interest_expense': format_to_billions(f('Interest Expense')),
-                'net_interest_income': format_to_billions(f('Net Interest Income')),
-                'ebit': format_to_billions(f('EBIT')),
-                'ebitda': format_to_billions(f('EBITDA')),
-                'reconciled_depreciation': format_to_billions(f('Reconciled Depreciation')),
-                'normalized_ebitda': format_to_billions(f('Normalized EBITDA')),
-                'total_assets': format_to_billions(fb('Total Assets')),
-                'stockholders_equity': format_to_billions(fb("Stockholders Equity")),
-                'free_cash_flow': format_to_billions(fc("Free Cash Flow")),
-                'changes_in_cash': format_to_billions(fc('Changes In Cash')),
-                'working_capital': format_to_billions(fb("Working Capital")),
-                'invested_capital': format_to_billions(fb("Invested Capital")),
-                'total_debt': format_to_billions(fb("Total Debt")),
-            }
-
-            results.append(data)
-            time.sleep(random.uniform(4, 8))
+
+        results = block_to_records(
+            symbol, found_years, block,
+            sector=info.get('sector', 'N/A'),
+            industry=info.get('industry', 'N/A'),
+            description=description,
+            stock_exchange=stock_exchange
+        )
         return results
 
     except Exception as e:
         print(f"Error retrieving financial data for {symbol}: {e}")
+        if raise_errors:
+            raise
         return []
 
 
 
-def get_financial_data(symbol, years, force_refresh=False, description=None, stock_exchange=None):
+def _fetch_and_store(symbol, years, description=None, stock_exchange=None, provider=None):
+    # Download + cache negativa + salvataggio: l'unità di lavoro condivisa dal single-flight.
+    # Gli errori upstream sono transitori e non entrano nella cache negativa: altrimenti
+    # un resume dell'ingestion li salterebbe e li registrerebbe come anni vuoti.
+    new_data = get_financial_data_from_source(
+        symbol, years,
+        description=description,
+        stock_exchange=stock_exchange,
+        provider=provider,
+        raise_errors=True
+    )
+
+    # Nessun dato mentre Yahoo ci sta limitando: probabile throttling silenzioso.
+    # Niente cache negativa, e l'errore fa segnare il ticker come 'failed' (da
+    # riprovare al resume) invece che 'empty'
+    if not new_data and (provider or get_provider()).is_throttled():
+        raise ProviderError(f"Nessun dato per {symbol} durante il throttling upstream")
+
+    # Anni richiesti ma non restituiti: risultato negativo con data di retry
+    returned_years = {int(d['year']) for d in new_data}
+    empty_years = [year for year in years if int(year) not in returned_years]
+    save_negative(symbol, empty_years, 'year_missing' if new_data else 'no_data')
+
+    if new_data:
+        # Salva nuovi dati nel DB/cache (gli anni non trovati non sono in new_data)
+        save_to_db(symbol, [d['year'] for d in new_data], new_data)
+    return new_data
+
+
+_single_flight = singleflight.SingleFlight()
+
+
+def fetch_once(symbol, years, description=None, stock_exchange=None, provider=None):
+    """Chiamanti concorrenti per lo stesso (symbol, anni) condividono un solo download"""
+    years_key = tuple(sorted(int(y) for y in years))
+
+    def fetch():
+        return _fetch_and_store(symbol, years, description=description, stock_exchange=stock_exchange, provider=provider)
+
+    def reload_from_db():
+        # Un altro processo ha appena scaricato e salvato: rileggiamo dal DB,
+        # scavalcando gli eventuali "non trovato" in cache di questo processo
+        return [d for d in load_from_db(symbol, years, refresh=True) if d]
+
+    def fetch_coordinated():
+        if not singleflight.DB_LOCK_ENABLED:
+            return fetch()
+        lock_key = f"{symbol}:{','.join(str(y) for y in years_key)}"
+        return singleflight.run_with_db_lock(lock_key, fetch, reload_from_db)
+
+    return _single_flight.do((symbol, years_key), fetch_coordinated)
+
+
+def get_financial_data(symbol, years, force_refresh=False, description=None, stock_exchange=None, provider=None, raise_errors=False):
     if not isinstance(years, (list, tuple)):
         years = [years]
     # Carica dati cached (None se non disponibili)
@@ -148,25 +176,30 @@ def get_financial_data(symbol, years, force_refresh=False, description=None, sto
     # Trova anni mancanti (dove cached_data[i] è None)
     missing_years = [year for i, year in enumerate(years) if cached_data[i] is None]
 
+    # Salta gli anni per cui sappiamo già che Yahoo non ha dati
+    if missing_years and not force_refresh:
+        negative_years = load_negative(symbol, missing_years)
+        missing_years = [year for year in missing_years if int(year) not in negative_years]
+
     # BLOCCO PER STREAMLIT CLOUD
     #if os.environ.get("STREAMLIT_CLOUD") == "1":
     #    return cached_data
-    if missing_years or force_refresh:
-        # Scarica dati mancanti
-        new_data = get_financial_data_from_source(symbol, missing_years, description=description, stock_exchange=stock_exchange)
-        if new_data:
-            # Salva nuovi dati nel DB/cache
-            save_to_db(symbol, missing_years, new_data)
+    # Con force_refresh si riscaricano tutti gli anni, non solo quelli mancanti
+    years_to_fetch = list(years) if force_refresh else missing_years
+    if years_to_fetch:
+        try:
+            new_data = fetch_once(symbol, years_to_fetch, description=description, stock_exchange=stock_exchange, provider=provider)
+        except Exception:
+            if raise_errors:
+                raise
+            new_data = []
 
-            # Integra i dati scaricati nei dati cached
+        if new_data:
+            # Integra i dati scaricati nei dati cached, abbinandoli per anno
+            new_by_year = {d['year']: d for d in new_data}
             for i, year in enumerate(years):
-                if cached_data[i] is None and year in missing_years:
-                    idx = missing_years.index(year)
-                    #cached_data[i] = new_data[idx]
-                    if idx < len(new_data):
-                        cached_data[i] = new_data[idx]
-                    else:
-                        cached_data[i] = None                 
+                if int(year) in new_by_year:
+                    cached_data[i] = new_by_year[int(year)]
  
     return cached_data
 
@@ -186,32 +219,24 @@ def remove_duplicates(data):
 
 
 
-def get_all_financial_data(force_refresh=True):
-    exchanges = read_exchanges('exchanges.txt')
-    financial_data = []
-
-    for exchange in exchanges.values():
-        companies = read_companies(exchange)
-        for company in companies:
-            symbol = company['ticker']
-            description = company['description']
-            stock_exchange = exchange
+def get_all_financial_data(force_refresh=True, max_workers=8, requests_per_second=None, provider=None, resume=True):
+    # Import locale per evitare import circolari (ingestion importa data_utils)
+    from ingestion import build_jobs, run_bulk_ingestion, start_run
 
-            data_list = get_financial_data(
-                symbol, ['2021', '2022', '2023', '2024'],
-                force_refresh=force_refresh,
-                description=description,
-                stock_exchange=stock_exchange
-            )
-            #print(f"Fetched {len(data_list)} records for {symbol}")
-
-            for data in data_list:
-                if data is not None and isinstance(data, dict):
-                    data['description'] = description
-                    data['stock_exchange'] = stock_exchange
-                    financial_data.append(data)
-                #save_to_db(symbol, selected_years, data_list)
-            time.sleep(random.uniform(5, 9))
+    years = [2021, 2022, 2023, 2024]
+    jobs = build_jobs('exchanges.txt')
+    # Il journal permette di riprendere un refresh interrotto dal punto in cui si era fermato:
+    # vengono restituiti solo i record elaborati in questa esecuzione
+    run_id = start_run(jobs, years, resume=resume)
+    financial_data, stats = run_bulk_ingestion(
+        jobs, years,
+        max_workers=max_workers,
+        requests_per_second=requests_per_second,
+        force_refresh=force_refresh,
+        provider=provider,
+        run_id=run_id
+    )
+    print(f"Ingestion completata: {stats.summary()}")
 
     financial_data = remove_duplicates(financial_data)
     financial_data = [x for x in financial_data if 'symbol' in x and 'year' in x]
@@ -220,124 +245,95 @@ def get_all_financial_data(force_refresh=True):
     if financial_data:
         financial_data.sort(key=lambda x: (x['symbol'], x['year']))
 
-    #financial_data.sort(key=lambda x: (x['symbol'], x['year']))
     return financial_data
 
 
 
 
+# Nomi "da prospetto" accettati in alternativa alle colonne dei record
+KPI_INPUT_LABELS = {
+    'gross_profit': 'Gross Profit',
+    'total_revenue': 'Total Revenue',
+    'operating_income': 'Operating Income',
+    'net_income': 'Net Income',
+    'ebitda': 'EBITDA',
+    'ebit': 'EBIT',
+    'total_assets': 'Total Assets',
+    'stockholders_equity': 'Stockholders Equity',
+    'invested_capital': 'Invested Capital',
+    'total_debt': 'Total Debt',
+    'tax_provision': 'Tax Provision',
+    'pretax_income': 'Pretax Income',
+    'sg_and_a': 'SG&A',
+    'r_and_d': 'R&D',
+    'free_cash_flow': 'Free Cash Flow',
+    'working_capital': 'Working Capital',
+    'interest_expense': 'Interest Expense',
+    'basic_eps': 'Basic EPS',
+}
+
+
+def to_numeric_column(column):
+    """
+    Conversione vettoriale a float64: prima pd.to_numeric su tutta la colonna,
+    poi solo le stringhe rimaste non numeriche vengono ripulite da virgole e
+    parentesi ("(1,234)" -> -1234) con operazioni di colonna. Il resto -> NaN.
+    """
+    if pd.api.types.is_bool_dtype(column) or pd.api.types.is_numeric_dtype(column):
+        return column.astype('float64')
+    values = pd.to_numeric(column, errors='coerce').astype('float64')
+    retry = values.isna() & column.notna()
+    if retry.any():
+        text = column[retry].astype(str)
+        text = text.str.replace(',', '', regex=False).str.replace('(', '-', regex=False).str.replace(')', '', regex=False)
+        values[retry] = pd.to_numeric(text, errors='coerce')
+    return values
+
+
 def compute_kpis(financial_data):
-    import pandas as pd
     import numpy as np
 
-    # Mappa colonne dataset -> nomi usati nei KPI
-    col_map = {
-        'Gross Profit': 'gross_profit',
-        'Total Revenue': 'total_revenue',
-        'Operating Income': 'operating_income',
-        'Net Income': 'net_income',
-        'EBITDA': 'ebitda',
-        'EBIT': 'ebit',
-        'Total Assets': 'total_assets',
-        'Stockholders Equity': 'stockholders_equity',
-        'Invested Capital': 'invested_capital',
-        'Total Debt': 'total_debt',
-        'Interest Expense': 'interest_expense',
-        'Tax Provision': 'tax_provision',
-        'Pretax Income': 'pretax_income',
-        'SG&A': 'sg_and_a',
-        'R&D': 'r_and_d',
-        'Free Cash Flow': 'free_cash_flow',
-        'Change in Cash': 'changes_in_cash',
-        'Working Capital': 'working_capital',
-        'Current Assets': 'current_assets',
-        'Current Liabilities': 'current_liabilities',
-        'inventories': 'inventories',
-        'cost_of_revenue': 'cost_of_revenue',
-        'receivables': 'receivables',
-    }
-
-    # Invertiamo il dizionario per rinominare da dataset a nomi KPI
-    reverse_map = {v: k for k, v in col_map.items()}
-
     try:
-        def to_float(val):
-            if pd.isna(val):
-                return np.nan
-            if isinstance(val, str):
-                # pulizia stringhe numeriche con virgole, parentesi ecc.
-                val = val.replace(",", "").replace("(", "-").replace(")", "")
-            try:
-                return float(val)
-            except:
-                return np.nan
-
         # Se è un dizionario singolo, lo trasformiamo in lista per DataFrame
         if isinstance(financial_data, dict):
             financial_data = [financial_data]
 
         df = pd.DataFrame(financial_data)
 
-        # Rinominare le colonne del dataset con i nomi KPI (se presenti)
-        df.rename(columns=reverse_map, inplace=True)
-
-        # Assicuriamoci che tutte le colonne necessarie esistano, altrimenti creiamole con NaN
-        for col in col_map.keys():
-            if col not in df.columns:
-                df[col] = np.nan
-
-        # Conversione numerica su tutte le colonne KPI
-        for col in col_map.keys():
-            df[col] = df[col].apply(to_float)
-
         # Colonne "base" che devono sempre esserci
         if 'symbol' not in df.columns:
             df['symbol'] = 'N/A'
         if 'year' not in df.columns:
             df['year'] = 'N/A'
-
-        # Calcolo KPI
-        df['Gross Margin'] = df['Gross Profit'] / df['Total Revenue']
-        df['Operating Margin'] = df['Operating Income'] / df['Total Revenue']
-        df['Net Margin'] = df['Net Income'] / df['Total Revenue']
-        df['EBITDA Margin'] = df['EBITDA'] / df['Total Revenue']
-        df['ROA'] = df['Net Income'] / df['Total Assets']
-        df['ROE'] = df['Net Income'] / df['Stockholders Equity']
-        df['ROIC'] = df['EBIT'] / df['Invested Capital']
-        df['Debt/Equity'] = df['Total Debt'] / df['Stockholders Equity']
-        #df['Interest Coverage'] = df['EBIT'] / df['Interest Expense']
-        df['Tax Rate'] = df['Tax Provision'] / df['Pretax Income']
-        df['SG&A/Revenue'] = df['SG&A'] / df['Total Revenue']
-        df['R&D/Revenue'] = df['R&D'] / df['Total Revenue']
-        df['FCF Margin'] = df['Free Cash Flow'] / df['Total Revenue']
-        df['Working Capital/Revenue'] = df['Working Capital'] / df['Total Revenue']
-        #df['Current Ratio'] = df['Current Assets'] / df['Current Liabilities']
-        #df['Quick Ratio'] = (df['Current Assets'] - df['inventories']) / df['Current Liabilities']
-        df['Asset Turnover'] = df['Total Revenue'] / df['Total Assets']
-        #df['Inventory Turnover'] = df['cost_of_revenue'] / df['inventories']
-        #df['Receivables Turnover'] = df['Total Revenue'] / df['receivables']
-        df['Equity Ratio'] = df['Stockholders Equity'] / df['Total Assets']
-
         df = df.drop_duplicates(subset=['symbol', 'year'])
 
+        # Matrice degli input del piano (righe x campi), convertita colonna per colonna
+        matrix = np.empty((len(df), len(KPI_PLAN.inputs)))
+        for i, column in enumerate(KPI_PLAN.inputs):
+            source = column if column in df.columns else KPI_INPUT_LABELS.get(column)
+            matrix[:, i] = to_numeric_column(df[source]).to_numpy() if source in df.columns else np.nan
 
-        # Restituisco solo le colonne richieste, se esistono
-        kpi_cols = ['symbol', 'year', 'description', 'Gross Margin', 'Operating Margin', 'Net Margin', 'EBITDA Margin',
-                    'ROA', 'ROE', 'ROIC', 'Debt/Equity', 'Tax Rate',
-                    'SG&A/Revenue', 'R&D/Revenue', 'FCF Margin', 'Working Capital/Revenue', 'Asset Turnover', 'Equity Ratio']
-
-        # Per sicurezza, filtriamo solo colonne esistenti
-        kpi_cols_present = [col for col in kpi_cols if col in df.columns]
+        # Tutti i KPI del registro in un solo piano vettoriale; non finiti -> NaN.
+        # I trend (lag/std) usano gli altri anni dello stesso simbolo presenti nei dati.
+        kpis = KPI_PLAN.evaluate(matrix, symbols=df['symbol'].to_numpy(), years=df['year'].to_numpy())
 
-        return df[kpi_cols_present]
+        id_cols = [col for col in ('symbol', 'year', 'description') if col in df.columns]
+        result = pd.concat(
+            [df[id_cols], pd.DataFrame(kpis, columns=KPI_PLAN.names, index=df.index)],
+            axis=1
+        )
+        result.attrs['formula_version'] = KPI_FORMULA_VERSION
+        return result
 
     except Exception as e:
         print(f"Errore nel calcolo dei KPI: {e}")
         return pd.DataFrame()
 
 
-def get_or_fetch_data(symbol, years, description, stock_exchange):
+def get_or_fetch_data(symbol, years, description, stock_exchange, provider=None):
     print(f"get_or_fetch_data chiamata per {symbol} anni {years}", flush=True)
+    # La domanda per ticker guida le priorità dello scheduler di refresh
+    record_demand(symbol)
     db_data = load_from_db(symbol, years)
 
     final_data = []
@@ -347,6 +343,8 @@ def get_or_fetch_data(symbol, years, description, stock_exchange):
         record = db_data[i]
         if isinstance(record, dict) and record:
             print(f"Dati da DB per {symbol} anno {year} trovati.", flush=True)
+            # I record del DB arrivano dalla cache condivisa in sola lettura
+            record = dict(record)
             record['description'] = description
             record['stock_exchange'] = stock_exchange
             final_data.append(record)
@@ -354,9 +352,16 @@ def get_or_fetch_data(symbol, years, description, stock_exchange):
             print(f"Dati da DB per {symbol} anno {year} MANCANTI, da scaricare.", flush=True)
             years_to_fetch.append(year)
 
+    # Anni già noti come vuoti: una lookup invece di un download
+    if years_to_fetch:
+        negative_years = load_negative(symbol, years_to_fetch)
+        if negative_years:
+            print(f"Anni senza dati upstream (cache negativa) per {symbol}: {sorted(negative_years)}", flush=True)
+            years_to_fetch = [year for year in years_to_fetch if int(year) not in negative_years]
+
     if years_to_fetch:
         print(f"Scarico dati per {symbol} anni: {years_to_fetch}", flush=True)
-        fetched_data = get_financial_data(symbol, years_to_fetch, description=description, stock_exchange=stock_exchange)
+        fetched_data = get_financial_data(symbol, years_to_fetch, description=description, stock_exchange=stock_exchange, provider=provider)
 
         valid_data = []
 
@@ -365,8 +370,9 @@ def get_or_fetch_data(symbol, years, description, stock_exchange):
                 data_year = data.get("year")
                 expected_year = years_to_fetch[i]
 
-                if data_year == expected_year:
+                if data_year is not None and int(data_year) == int(expected_year):
                     print(f"Dati scaricati validi per {symbol} anno {expected_year}", flush=True)
+                    data = dict(data)
                     data['description'] = description
                     data['stock_exchange'] = stock_exchange
                     final_data.append(data)
@@ -376,11 +382,9 @@ def get_or_fetch_data(symbol, years, description, stock_exchange):
             else:
                 print(f"Dati scaricati NON validi per {symbol} anno {years_to_fetch[i]}", flush=True)
 
-        if valid_data:
-            print(f"Salvo dati nuovi nel DB per {symbol} anni {[d['year'] for d in valid_data]}", flush=True)
-            save_to_db(symbol, [d['year'] for d in valid_data], valid_data)
-        else:
-            print(f"Nessun dato valido da salvare per {symbol}", flush=True)
+        # Il salvataggio avviene già una sola volta dentro fetch_once
+        if not valid_data:
+            print(f"Nessun dato valido scaricato per {symbol}", flush=True)
 
     return final_data
 
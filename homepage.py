@@ -13,6 +13,9 @@ import random
 from urllib.parse import urlparse
 import requests
 import uuid
+from app_init import init_app
+
+init_app()
 
 # --------------- Client-side GA4 -----------------
 components.html("""
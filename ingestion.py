@@ -0,0 +1,218 @@
+import time
+import logging
+import argparse
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from data_utils import read_exchanges, read_companies, get_financial_data
+from rate_limiter import configure_limiter, get_limiter
+from providers import FixtureProvider
+from kpi_materialize import materialize_kpis
+from kpi_aggregates import refresh_aggregates
+from cache_db import create_tables, journal_start_run, journal_pending_work, journal_record, journal_latest_open_run, journal_summary, track_changes, load_negative
+
+# Logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("ingestion")
+
+DEFAULT_YEARS = [2021, 2022, 2023, 2024]
+
+class IngestionStats:
+    """Contatori thread-safe e throughput di una sessione di ingestion"""
+
+    def __init__(self, total):
+        self.total = total
+        self.ok = 0
+        self.empty = 0
+        self.failed = 0
+        self.records = 0
+        # Chiavi (symbol, year) il cui contenuto è cambiato nel DB durante la sessione
+        self.changed_keys = set()
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, records=0, failed=False):
+        with self._lock:
+            if failed:
+                self.failed += 1
+            elif records:
+                self.ok += 1
+                self.records += records
+            else:
+                self.empty += 1
+
+    @property
+    def done(self):
+        return self.ok + self.empty + self.failed
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        return {
+            'tickers_total': self.total,
+            'tickers_done': self.done,
+            'tickers_ok': self.ok,
+            'tickers_empty': self.empty,
+            'tickers_failed': self.failed,
+            'records': self.records,
+            'records_changed': len(self.changed_keys),
+            'elapsed_s': round(elapsed, 2),
+            'tickers_per_s': round(self.done / elapsed, 3),
+            'records_per_s': round(self.records / elapsed, 3),
+        }
+
+
+def build_jobs(exchanges_file='exchanges.txt', exchange_names=None):
+    """Lista di ticker da scaricare, nell'ordine di exchanges.txt"""
+    exchanges = read_exchanges(exchanges_file)
+    jobs = []
+    for exchange_name, companies_file in exchanges.items():
+        if exchange_names and exchange_name not in exchange_names:
+            continue
+        for company in read_companies(companies_file):
+            jobs.append({
+                'symbol': company['ticker'],
+                'description': company['description'],
+                'stock_exchange': exchange_name,
+            })
+    return jobs
+
+
+def new_run_id():
+    return datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+
+
+def start_run(jobs, years=DEFAULT_YEARS, resume=True):
+    """Riprende l'ultimo run incompleto del journal, oppure ne apre uno nuovo"""
+    create_tables()
+    run_id = journal_latest_open_run() if resume else None
+    if run_id:
+        logger.info(f"Riprendo il run {run_id}")
+    else:
+        run_id = new_run_id()
+        logger.info(f"Nuovo run {run_id}")
+    journal_start_run(run_id, jobs, years)
+    return run_id
+
+
+def _ingest_one(job, years, force_refresh, provider, run_id):
+    # Anni che get_financial_data salterà per la cache negativa: nel journal sono
+    # 'skipped', non 'empty' (non sono stati scaricati in questo run)
+    negative_years = set() if force_refresh or not run_id else load_negative(job['symbol'], years)
+    try:
+        data_list = get_financial_data(
+            job['symbol'], years,
+            force_refresh=force_refresh,
+            description=job['description'],
+            stock_exchange=job['stock_exchange'],
+            provider=provider,
+            raise_errors=True
+        )
+    except Exception as e:
+        if run_id:
+            journal_record(run_id, job['symbol'], years, 'failed', error=e)
+        raise
+
+    records = []
+    for data in data_list:
+        if data is not None and isinstance(data, dict):
+            # I record già in cache arrivano in sola lettura
+            data = dict(data)
+            data['description'] = job['description']
+            data['stock_exchange'] = job['stock_exchange']
+            records.append(data)
+
+    if run_id:
+        done_years = {int(d['year']) for d in records}
+        missing_years = [y for y in years if int(y) not in done_years]
+        journal_record(run_id, job['symbol'], [y for y in years if int(y) in done_years], 'done')
+        journal_record(run_id, job['symbol'], [y for y in missing_years if int(y) in negative_years], 'skipped')
+        journal_record(run_id, job['symbol'], [y for y in missing_years if int(y) not in negative_years], 'empty')
+    return records
+
+
+def run_bulk_ingestion(jobs, years=DEFAULT_YEARS, max_workers=8, requests_per_second=None,
+                       force_refresh=False, provider=None, progress_every=100,
+                       run_id=None, max_attempts=3):
+    """
+    Scarica in parallelo i ticker di `jobs` con un pool di thread limitato.
+    Tutti i worker condividono il token bucket di rate_limiter; se viene
+    passato requests_per_second il limiter di processo viene ridimensionato.
+    `provider` (default quello di processo) permette di girare anche su fixture offline.
+    Con run_id lo stato di ogni ticker/anno viene scritto nel journal e i
+    ticker/anno già completati in quel run vengono saltati.
+    Restituisce (lista record, IngestionStats).
+    """
+    if requests_per_second:
+        configure_limiter(requests_per_second * 60)
+
+    # Anni ancora da fare per ogni ticker (tutti se non c'è journal)
+    if run_id:
+        pending = journal_pending_work(run_id, max_attempts=max_attempts)
+        work = [(job, sorted(pending[job['symbol']])) for job in jobs if job['symbol'] in pending]
+        logger.info(f"Run {run_id}: {len(work)}/{len(jobs)} ticker ancora da completare")
+    else:
+        work = [(job, list(years)) for job in jobs]
+
+    stats = IngestionStats(len(work))
+    financial_data = []
+
+    with track_changes() as changes, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        stats.changed_keys = changes['financials']
+        futures = {
+            executor.submit(_ingest_one, job, job_years, force_refresh, provider, run_id): job
+            for job, job_years in work
+        }
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                records = future.result()
+                financial_data.extend(records)
+                stats.add(records=len(records))
+            except Exception as e:
+                logger.error(f"Errore ingestion per {job['symbol']}: {e}")
+                stats.add(failed=True)
+
+            if progress_every and stats.done % progress_every == 0:
+                logger.info(f"Ingestion {stats.done}/{stats.total}: {stats.summary()}")
+
+    logger.info(f"✅ Ingestion terminata: {stats.summary()} (throttling: {get_limiter().throttle_events})")
+    return financial_data, stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Ingestion massiva dei dati finanziari")
+    parser.add_argument('--exchange', action='append', help="Nome exchange (ripetibile), default tutti")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--rps', type=float, default=None, help="Richieste al secondo verso Yahoo (default UPSTREAM_CALLS_PER_MINUTE)")
+    parser.add_argument('--force-refresh', action='store_true')
+    parser.add_argument('--new-run', action='store_true', help="Non riprendere l'ultimo run incompleto")
+    parser.add_argument('--summary', action='store_true', help="Mostra solo il riepilogo del journal")
+    parser.add_argument('--fixtures', help="Cartella di fixture registrate: ingestion offline senza Yahoo")
+    parser.add_argument('--latency', type=float, default=0.0, help="Latenza simulata per chiamata (con --fixtures)")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="Tasso di errori simulati (con --fixtures)")
+    args = parser.parse_args()
+
+    provider = None
+    if args.fixtures:
+        provider = FixtureProvider(args.fixtures, latency=args.latency, failure_rate=args.failure_rate)
+
+    if args.summary:
+        create_tables()
+        print(journal_summary().to_string(index=False))
+    else:
+        jobs = build_jobs('exchanges.txt', exchange_names=args.exchange)
+        run_id = start_run(jobs, DEFAULT_YEARS, resume=not args.new_run)
+        _, stats = run_bulk_ingestion(
+            jobs,
+            max_workers=args.workers,
+            requests_per_second=args.rps,
+            force_refresh=args.force_refresh,
+            provider=provider,
+            run_id=run_id
+        )
+        print(stats.summary())
+        print(journal_summary(run_id).to_string(index=False))
+        # KPI e aggregati di settore ricalcolati solo per i record effettivamente cambiati
+        print(materialize_kpis(keys=stats.changed_keys))
+        print(refresh_aggregates(keys=stats.changed_keys))
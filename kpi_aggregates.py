@@ -0,0 +1,157 @@
+import time
+import logging
+import argparse
+
+import pandas as pd
+
+from cache_db import create_tables, load_frame, replace_kpi_aggregates, aggregated_groups, AGGREGATE_ALL
+from data_utils import compute_kpis
+from kpi_registry import LEVEL_KPIS, KPI_PLAN
+from quantile_sketch import QuantileSketch
+import percentile_index
+
+# Logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("kpi_aggregates")
+
+# Percentili salvati per ogni gruppo di pari, oltre a count/mean/median/min/max
+QUANTILES = {'p10': 0.10, 'p25': 0.25, 'p75': 0.75, 'p90': 0.90}
+# Livelli dei gruppi: exchange/settore/industria, exchange/settore, exchange intero
+GROUP_LEVELS = [('sector', 'industry'), ('sector',), ()]
+GROUP_COLUMNS = ['stock_exchange', 'year', 'sector', 'industry', 'kpi']
+# Settore/industria mancanti: stesso segnaposto delle pagine
+UNKNOWN_GROUP = "N/A"
+META_COLUMNS = ['symbol', 'year', 'stock_exchange', 'sector', 'industry', 'description']
+
+
+def compute_aggregates(frame):
+    """
+    Statistiche cross-section dei KPI per tutti i livelli di GROUP_LEVELS.
+    `frame` sono righe di FinancialCache (con stock_exchange/sector/industry);
+    i KPI si calcolano con il piano del registro, una sola volta per tutte le righe.
+    """
+    frame = frame.dropna(subset=['stock_exchange']).drop_duplicates(subset=['symbol', 'year'])
+    if frame.empty:
+        return pd.DataFrame(columns=GROUP_COLUMNS + ['count', 'mean', 'median'] + list(QUANTILES) + ['min', 'max', 'sketch'])
+    kpis = compute_kpis(frame)
+    meta = frame[['symbol', 'year', 'stock_exchange', 'sector', 'industry']]
+    kpis = kpis.drop(columns=['description'], errors='ignore').merge(meta, on=['symbol', 'year'], how='left')
+    kpis['sector'] = kpis['sector'].fillna(UNKNOWN_GROUP)
+    kpis['industry'] = kpis['industry'].fillna(UNKNOWN_GROUP)
+    kpis['year'] = kpis['year'].astype(int)
+
+    # Formato lungo: una riga per azienda/anno/KPI, i mancanti non entrano nelle statistiche.
+    # Solo KPI di livello: i trend richiederebbero anche gli anni precedenti di ogni gruppo.
+    long = kpis.melt(
+        id_vars=['stock_exchange', 'year', 'sector', 'industry'],
+        value_vars=[name for name in LEVEL_KPIS if name in kpis.columns],
+        var_name='kpi', value_name='value'
+    ).dropna(subset=['value'])
+
+    frames = []
+    for level in GROUP_LEVELS:
+        rolled = long.assign(**{column: AGGREGATE_ALL for column in ('sector', 'industry') if column not in level})
+        grouped = rolled.groupby(GROUP_COLUMNS, sort=False)['value']
+        stats = grouped.agg(['count', 'mean', 'median', 'min', 'max'])
+        quantiles = grouped.quantile(list(QUANTILES.values())).unstack()
+        quantiles.columns = list(QUANTILES)
+        # Sketch dei quantili: a dimensione costante e unibile fra exchange (vista "All"),
+        # usato anche dall'indice dei percentili (percentile_index)
+        sketches = grouped.agg(lambda values: QuantileSketch.from_values(values.to_numpy()).to_bytes()).rename('sketch')
+        frames.append(stats.join(quantiles).join(sketches).reset_index())
+    return pd.concat(frames, ignore_index=True)
+
+
+def _affected_groups(keys):
+    # (stock_exchange, year) che contengono le chiavi cambiate
+    keys = set(keys)
+    frame = load_frame(
+        symbols=sorted({symbol for symbol, _ in keys}), years=sorted({year for _, year in keys}),
+        columns=['symbol', 'year', 'stock_exchange']
+    )
+    frame = frame[pd.MultiIndex.from_frame(frame[['symbol', 'year']]).isin(list(keys))]
+    frame = frame.dropna(subset=['stock_exchange'])
+    return set(zip(frame['stock_exchange'], frame['year'].astype(int)))
+
+
+def missing_groups():
+    """(stock_exchange, year) con dati in FinancialCache ma senza aggregati (o senza sketch)"""
+    frame = load_frame(columns=['stock_exchange', 'year']).dropna().drop_duplicates()
+    return set(zip(frame['stock_exchange'], frame['year'].astype(int))) - aggregated_groups()
+
+
+def refresh_aggregates(stock_exchanges=None, years=None, keys=None, groups=None):
+    """
+    Ricostruisce la tabella kpi_aggregates sull'universo completo (o su alcuni
+    exchange/anni). Con `keys` (chiavi (symbol, year) cambiate) si ricalcolano solo
+    gli exchange/anni che le contengono: i percentili richiedono l'intero gruppo.
+    `groups` indica direttamente gli (stock_exchange, year) da ricostruire.
+    Gira nei job (scheduler, ingestion, CLI), mai durante il render delle pagine.
+    """
+    started = time.monotonic()
+    if groups is not None:
+        groups = {(exchange, int(year)) for exchange, year in groups}
+        if not groups:
+            return 0
+        stock_exchanges = sorted({exchange for exchange, _ in groups})
+        years = sorted({year for _, year in groups})
+    if keys is not None:
+        if not keys:
+            logger.info("Nessuna chiave cambiata: aggregati già aggiornati")
+            return 0
+        groups = _affected_groups(keys)
+        if not groups:
+            return 0
+        stock_exchanges = sorted({exchange for exchange, _ in groups})
+        years = sorted({year for _, year in groups})
+
+    frame = load_frame(
+        years=years, stock_exchanges=stock_exchanges,
+        columns=list(dict.fromkeys(META_COLUMNS + KPI_PLAN.inputs))
+    )
+    frame = frame.dropna(subset=['stock_exchange']).astype({'year': int})
+    if groups is not None:
+        frame = frame[pd.MultiIndex.from_frame(frame[['stock_exchange', 'year']]).isin(list(groups))]
+    else:
+        groups = {(exchange, int(year)) for exchange, year in zip(frame['stock_exchange'], frame['year'])}
+    loaded = time.monotonic()
+
+    aggregates = compute_aggregates(frame)
+    aggregates = aggregates.astype(object).where(aggregates.notna(), None)
+    rows = aggregates.to_dict('records')
+    for row in rows:
+        row['year'] = int(row['year'])
+        row['count'] = int(row['count'])
+    computed = time.monotonic()
+
+    replace_kpi_aggregates(rows, sorted(groups))
+    percentile_index.invalidate(groups)
+    logger.info(
+        f"✅ Aggregati KPI per {len(groups)} exchange/anni ({len(frame)} righe) in {time.monotonic() - started:.2f}s "
+        f"(lettura {loaded - started:.2f}s, calcolo {computed - loaded:.2f}s, "
+        f"scrittura {time.monotonic() - computed:.2f}s)"
+    )
+    return len(rows)
+
+
+def refresh_missing_aggregates():
+    """Costruisce gli aggregati degli exchange/anni che non li hanno ancora (job periodico)"""
+    groups = missing_groups()
+    if not groups:
+        logger.info("Aggregati KPI già presenti per tutti gli exchange/anni")
+        return 0
+    return refresh_aggregates(groups=groups)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Ricostruzione della tabella kpi_aggregates")
+    parser.add_argument('--exchange', action='append', help="Nome exchange (ripetibile), default tutti")
+    parser.add_argument('--years', type=int, nargs='+', default=None)
+    parser.add_argument('--missing', action='store_true', help="Solo gli exchange/anni non ancora aggregati")
+    args = parser.parse_args()
+
+    create_tables()
+    if args.missing:
+        print(refresh_missing_aggregates())
+    else:
+        print(refresh_aggregates(stock_exchanges=args.exchange, years=args.years))
@@ -0,0 +1,258 @@
+import os
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from statements import FIELD_NAMES
+import cache_db
+from cache_db import create_tables, load_frame, save_kpis_to_db, frame_hashes
+from data_utils import compute_kpis, KPI_FORMULA_VERSION
+from kpi_registry import KPI_PLAN, lag_positions
+from kpi_aggregates import refresh_aggregates
+
+# Logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("kpi_materialize")
+
+# Colonne di FinancialCache che entrano nell'hash degli input dei KPI
+INPUT_COLUMNS = ['description'] + FIELD_NAMES
+# Ricostruzione completa: shard per exchange o per intervalli contigui di simboli
+SHARD_MODES = ('exchange', 'symbols')
+# Shard per processo con shard_by='symbols' (shard piccoli bilanciano meglio il pool)
+SHARDS_PER_WORKER = 4
+
+
+def input_hashes(frame):
+    """
+    Hash degli input per (symbol, year): una riga KPI si riscrive solo se cambia.
+    Comprende gli anni precedenti letti dai KPI di trend (fino a KPI_PLAN.max_lag).
+    """
+    frame = frame.drop_duplicates(subset=['symbol', 'year'], keep='last')
+    hashes = frame_hashes(frame, INPUT_COLUMNS).to_numpy()
+    if KPI_PLAN.max_lag:
+        parts = {'h0': hashes}
+        for n, position in lag_positions(frame['symbol'], frame['year'], range(1, KPI_PLAN.max_lag + 1)).items():
+            parts[f'h{n}'] = np.where(position >= 0, hashes[position], '')
+        hashes = frame_hashes(pd.DataFrame(parts), list(parts)).to_numpy()
+    return pd.Series(hashes, index=pd.MultiIndex.from_arrays([frame['symbol'], frame['year']]))
+
+
+def materialize_kpis(symbols=None, years=None, stock_exchanges=None, keys=None, force=False):
+    """
+    Ricalcola i KPI di tutto l'universo (o di un sottoinsieme) in blocco:
+    una lettura tipizzata, un calcolo vettoriale, un upsert in KPICache.
+    Con `keys` (insieme di (symbol, year), es. le chiavi cambiate di un refresh)
+    si ricalcolano solo quelle e gli anni successivi i cui trend le leggono.
+    Gli anni precedenti servono ai trend: si leggono ma non si riscrivono.
+    force=True riscrive anche le righe con versione e hash degli input invariati
+    (formule cambiate senza incrementare KPI_FORMULA_VERSION).
+    Restituisce i conteggi di save_kpis_to_db più righe calcolate e tempi delle fasi.
+    """
+    started = time.monotonic()
+    lookback = KPI_PLAN.max_lag
+    if keys is not None:
+        if not keys:
+            logger.info("Nessuna chiave cambiata: KPI già aggiornati")
+            return {'inserted': 0, 'updated': 0, 'unchanged': 0, 'rows': 0}
+        keys = {(symbol, int(year) + n) for symbol, year in keys for n in range(lookback + 1)}
+        symbols = sorted({symbol for symbol, _ in keys})
+        years = sorted({year for _, year in keys})
+    target_years = None if years is None else {int(year) for year in years}
+    load_years = None if years is None else sorted({year - n for year in target_years for n in range(lookback + 1)})
+    frame = load_frame(symbols=symbols, years=load_years, stock_exchanges=stock_exchanges)
+    if frame.empty:
+        logger.info("Nessun dato finanziario da materializzare")
+        return {'inserted': 0, 'updated': 0, 'unchanged': 0, 'rows': 0}
+    loaded = time.monotonic()
+
+    kpis = compute_kpis(frame)
+    if keys is not None:
+        kpis = kpis[pd.MultiIndex.from_frame(kpis[['symbol', 'year']]).isin(list(keys))]
+    elif target_years is not None:
+        kpis = kpis[kpis['year'].isin(target_years)]
+    computed = time.monotonic()
+
+    counts = save_kpis_to_db(kpis, formula_version=KPI_FORMULA_VERSION, input_hashes=input_hashes(frame), force=force)
+    finished = time.monotonic()
+    counts.update(
+        rows=len(kpis), read_s=round(loaded - started, 3),
+        compute_s=round(computed - loaded, 3), write_s=round(finished - computed, 3)
+    )
+    logger.info(
+        f"✅ KPI materializzati per {len(kpis)} righe in {time.monotonic() - started:.2f}s "
+        f"(lettura {loaded - started:.2f}s, calcolo {computed - loaded:.2f}s, "
+        f"scrittura {finished - computed:.2f}s)"
+    )
+    return counts
+
+
+def plan_shards(shard_by='exchange', shards=None):
+    """
+    Divide l'universo di FinancialCache in shard indipendenti per rebuild_kpis:
+    uno per exchange, oppure `shards` intervalli contigui di simboli ordinati.
+    Ogni shard è un dict di argomenti per materialize_kpis.
+    """
+    if shard_by not in SHARD_MODES:
+        raise ValueError(f"shard_by deve essere uno di {SHARD_MODES}, non {shard_by!r}")
+    universe = load_frame(columns=['symbol', 'stock_exchange']).drop_duplicates()
+    if universe.empty:
+        return []
+    if shard_by == 'exchange':
+        plan = [{'stock_exchanges': [exchange]} for exchange in sorted(universe['stock_exchange'].dropna().unique())]
+        # Righe senza exchange: uno shard per simboli, altrimenti resterebbero fuori
+        orphans = sorted(universe.loc[universe['stock_exchange'].isna(), 'symbol'].unique())
+        if orphans:
+            plan.append({'symbols': orphans})
+        return plan
+    symbols = np.array(sorted(universe['symbol'].unique()), dtype=object)
+    shards = max(1, min(int(shards or (os.cpu_count() or 1) * SHARDS_PER_WORKER), len(symbols)))
+    return [{'symbols': list(chunk)} for chunk in np.array_split(symbols, shards)]
+
+
+def _shard_label(shard):
+    if 'stock_exchanges' in shard:
+        return ', '.join(shard['stock_exchanges'])
+    symbols = shard['symbols']
+    return f"{symbols[0]}..{symbols[-1]} ({len(symbols)} simboli)"
+
+
+def _init_worker():
+    # Le connessioni ereditate con fork non vanno riusate dal processo figlio
+    cache_db.engine.dispose(close=False)
+
+
+def _rebuild_shard(shard, force=False):
+    started = time.monotonic()
+    counts = materialize_kpis(force=force, **shard)
+    return dict(counts, shard=_shard_label(shard), seconds=round(time.monotonic() - started, 3))
+
+
+def rebuild_kpis(shard_by='exchange', workers=None, shards=None, force=False):
+    """
+    Ricalcola i KPI dell'intero universo (es. dopo un cambio di formule) su un pool
+    di processi: ogni shard legge in blocco, calcola in modo vettoriale e scrive con
+    un upsert in blocco (materialize_kpis). Le righe con versione e hash degli input
+    invariati non si riscrivono, salvo force=True. Restituisce un DataFrame con conteggi e tempi per shard.
+    """
+    started = time.monotonic()
+    plan = plan_shards(shard_by, shards)
+    if not plan:
+        logger.info("Nessun dato finanziario da ricostruire")
+        return pd.DataFrame()
+    workers = max(1, min(int(workers or os.cpu_count() or 1), len(plan)))
+    logger.info(f"Ricostruzione KPI: {len(plan)} shard per {shard_by} su {workers} processi")
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        futures = {executor.submit(_rebuild_shard, shard, force): shard for shard in plan}
+        for future in as_completed(futures):
+            label = _shard_label(futures[future])
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"Errore nello shard {label}: {e}")
+                result = {'shard': label, 'error': str(e)}
+            else:
+                logger.info(
+                    f"Shard {label}: {result['rows']} righe in {result['seconds']:.2f}s "
+                    f"({result['inserted']} inseriti, {result['updated']} aggiornati, {result['unchanged']} invariati)"
+                )
+            results.append(result)
+
+    report = pd.DataFrame(results)
+    failed = int(report['error'].notna().sum()) if 'error' in report else 0
+    logger.info(
+        f"✅ Ricostruzione KPI completata in {time.monotonic() - started:.2f}s "
+        f"({len(plan) - failed}/{len(plan)} shard riusciti)"
+    )
+    return report
+
+
+def _per_cell_kpis(df):
+    # Percorso precedente di compute_kpis (conversione cella per cella), solo per confronto
+    def to_float(val):
+        if pd.isna(val):
+            return np.nan
+        if isinstance(val, str):
+            val = val.replace(",", "").replace("(", "-").replace(")", "")
+        try:
+            return float(val)
+        except (TypeError, ValueError):
+            return np.nan
+
+    df = df.copy()
+    for column in KPI_PLAN.inputs:
+        df[column] = df[column].apply(to_float)
+    df = df.drop_duplicates(subset=['symbol', 'year'])
+    kpis = KPI_PLAN.evaluate(df[KPI_PLAN.inputs].to_numpy(dtype='float64'), symbols=df['symbol'].to_numpy(), years=df['year'].to_numpy())
+    return pd.concat([df[['symbol', 'year']], pd.DataFrame(kpis, columns=KPI_PLAN.names, index=df.index)], axis=1)
+
+
+def _benchmark_frame(size, dirty, rng):
+    columns = list(KPI_PLAN.inputs)
+    values = rng.normal(10, 5, (size, len(columns)))
+    values[::7, 0] = np.nan
+    values[::11, 1] = 0.0
+    df = pd.DataFrame(values, columns=columns)
+    if dirty:
+        # Colonne object con numeri come stringhe ("(1,234.50)"), come da fonti esterne
+        df = df.astype(object)
+        df.iloc[::13, 2] = [f"({v:,.2f})" for v in values[::13, 2]]
+    df['symbol'] = [f"S{i}" for i in range(size)]
+    df['year'] = 2023
+    return df
+
+
+def benchmark_compute_kpis(sizes=(100, 10_000, 100_000), repeat=3, seed=0):
+    """Tempi di compute_kpis (vettoriale) contro la conversione cella per cella"""
+    rng = np.random.default_rng(seed)
+    results = []
+    for dirty in (False, True):
+        for size in sizes:
+            df = _benchmark_frame(size, dirty, rng)
+            timings = {}
+            for label, fn in (('per_cella', _per_cell_kpis), ('vettoriale', compute_kpis)):
+                best = None
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    fn(df)
+                    elapsed = time.perf_counter() - started
+                    best = elapsed if best is None else min(best, elapsed)
+                timings[label] = best
+            results.append({
+                'input': 'object+stringhe' if dirty else 'float64',
+                'rows': size,
+                'per_cell_ms': round(timings['per_cella'] * 1000, 2),
+                'vectorized_ms': round(timings['vettoriale'] * 1000, 2),
+                'speedup': round(timings['per_cella'] / timings['vettoriale'], 1),
+            })
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Materializzazione dei KPI in KPICache")
+    parser.add_argument('--exchange', action='append', help="Nome exchange (ripetibile), default tutti")
+    parser.add_argument('--years', type=int, nargs='+', default=None)
+    parser.add_argument('--benchmark', action='store_true', help="Micro-benchmark di compute_kpis (100, 10k, 100k righe)")
+    parser.add_argument('--rebuild', action='store_true', help="Ricostruzione completa su un pool di processi")
+    parser.add_argument('--shard-by', choices=SHARD_MODES, default='exchange')
+    parser.add_argument('--workers', type=int, default=None, help="Processi del pool, default numero di CPU")
+    parser.add_argument('--shards', type=int, default=None, help="Shard con --shard-by symbols, default 4 per processo")
+    parser.add_argument('--force', action='store_true', help="Riscrive tutte le righe ignorando versione e hash salvati")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        print(benchmark_compute_kpis().to_string(index=False))
+    elif args.rebuild:
+        create_tables()
+        report = rebuild_kpis(shard_by=args.shard_by, workers=args.workers, shards=args.shards, force=args.force)
+        print(report.to_string(index=False))
+        # Gli aggregati di settore dipendono dalle stesse formule
+        refresh_aggregates()
+    else:
+        create_tables()
+        print(materialize_kpis(years=args.years, stock_exchanges=args.exchange, force=args.force))
@@ -0,0 +1,253 @@
+import ast
+
+import numpy as np
+import pandas as pd
+
+from statements import FIELD_MAP, FIELD_NAMES
+
+# Da incrementare a ogni modifica delle formule: KPICache riscrive le righe con versione diversa
+KPI_FORMULA_VERSION = '3'
+
+# Registro dichiarativo dei KPI: (nome, etichetta, formula sui campi dei record, unità, percentuale, tipo).
+# L'ordine è quello di visualizzazione; lo schema del codec binario è fissato a parte in
+# record_codec.KPI_SCHEMA_FIELDS, dove ogni KPI nuovo (anche di trend generato) va aggiunto in coda.
+# Formule: campi di FIELD_NAMES, costanti numeriche, + - * / ** e parentesi, più le funzioni
+#   lag(expr, n): valore di expr n anni prima per lo stesso simbolo (NaN se l'anno manca)
+#   std(expr, n): deviazione standard campionaria di expr sugli ultimi n anni
+#   abs(expr)
+# Tipo: 'level' (un solo anno) o 'trend' (serve la serie storica del simbolo).
+KPI_REGISTRY = [
+    ('Gross Margin', 'Gross Margin', 'gross_profit / total_revenue', 'ratio', True, 'level'),
+    ('Operating Margin', 'Operating Margin', 'operating_income / total_revenue', 'ratio', True, 'level'),
+    ('Net Margin', 'Net Margin', 'net_income / total_revenue', 'ratio', True, 'level'),
+    ('EBITDA Margin', 'EBITDA Margin', 'ebitda / total_revenue', 'ratio', True, 'level'),
+    ('ROA', 'ROA', 'net_income / total_assets', 'ratio', True, 'level'),
+    ('ROE', 'ROE', 'net_income / stockholders_equity', 'ratio', True, 'level'),
+    ('ROIC', 'ROIC', 'ebit / invested_capital', 'ratio', True, 'level'),
+    ('Debt/Equity', 'Debt to Equity', 'total_debt / stockholders_equity', 'x', False, 'level'),
+    ('Tax Rate', 'Tax Rate', 'tax_provision / pretax_income', 'ratio', True, 'level'),
+    ('SG&A/Revenue', 'SG&A / Revenue', 'sg_and_a / total_revenue', 'ratio', True, 'level'),
+    ('R&D/Revenue', 'R&D / Revenue', 'r_and_d / total_revenue', 'ratio', True, 'level'),
+    ('FCF Margin', 'FCF Margin', 'free_cash_flow / total_revenue', 'ratio', True, 'level'),
+    ('Working Capital/Revenue', 'Working Capital / Revenue', 'working_capital / total_revenue', 'ratio', True, 'level'),
+    ('Asset Turnover', 'Asset Turnover', 'total_revenue / total_assets', 'x', False, 'level'),
+    ('Equity Ratio', 'Equity Ratio', 'stockholders_equity / total_assets', 'ratio', True, 'level'),
+    ('Interest Coverage', 'Interest Coverage', 'ebit / interest_expense', 'x', False, 'level'),
+    ('EPS', 'Earnings per Share (EPS)', 'basic_eps', 'currency', False, 'level'),
+    # Current Ratio, Quick Ratio, Inventory/Receivables Turnover: servono attivo/passivo
+    # corrente, magazzino e crediti, che non sono ancora tra i campi di FIELD_MAP
+]
+
+# Campi con crescita anno su anno e CAGR a 3 anni
+TREND_FIELDS = [
+    'total_revenue', 'gross_profit', 'operating_income', 'ebitda', 'ebit', 'net_income',
+    'free_cash_flow', 'basic_eps', 'total_assets', 'stockholders_equity', 'total_debt', 'working_capital',
+]
+FIELD_LABELS = {field[0]: field[2] for field in FIELD_MAP}
+
+
+def _trend_entries(levels):
+    # Crescite sui campi, variazione e volatilità sui KPI percentuali: riusano le formule
+    # di livello, quindi nel piano condividono le stesse sotto-espressioni
+    entries = []
+    for field in TREND_FIELDS:
+        label = FIELD_LABELS[field]
+        entries.append((f"{label} YoY", f"{label} YoY", f"({field} - lag({field}, 1)) / abs(lag({field}, 1))", 'ratio', True, 'trend'))
+        entries.append((f"{label} CAGR 3Y", f"{label} CAGR 3Y", f"(({field} / lag({field}, 3)) ** (1 / 3)) - 1", 'ratio', True, 'trend'))
+    for name, label, formula, unit, percent, _ in levels:
+        if percent:
+            entries.append((f"{name} Delta", f"{label} Δ YoY", f"({formula}) - lag({formula}, 1)", unit, True, 'trend'))
+            entries.append((f"{name} Volatility 3Y", f"{label} Volatility 3Y", f"std({formula}, 3)", unit, True, 'trend'))
+    return entries
+
+
+KPI_REGISTRY += _trend_entries(KPI_REGISTRY)
+
+KPI_NAMES = [kpi[0] for kpi in KPI_REGISTRY]
+LEVEL_KPIS = [kpi[0] for kpi in KPI_REGISTRY if kpi[5] == 'level']
+TREND_KPIS = [kpi[0] for kpi in KPI_REGISTRY if kpi[5] == 'trend']
+KPI_LABELS = {kpi[0]: kpi[1] for kpi in KPI_REGISTRY}
+KPI_UNITS = {kpi[0]: kpi[3] for kpi in KPI_REGISTRY}
+PERCENT_KPIS = {kpi[0] for kpi in KPI_REGISTRY if kpi[4]}
+
+_BINARY_OPS = {ast.Add: 'add', ast.Sub: 'sub', ast.Mult: 'mul', ast.Div: 'div', ast.Pow: 'pow'}
+_NUMPY_OPS = {
+    'add': np.add, 'sub': np.subtract, 'mul': np.multiply, 'div': np.divide, 'pow': np.power,
+    'neg': np.negative, 'abs': np.abs,
+}
+# Funzioni temporali: l'operatore porta con sé il numero di anni ('lag3', 'std3')
+_TEMPORAL_FUNCTIONS = {'lag': 1, 'std': 2}
+
+
+class FormulaError(ValueError):
+    """Formula di un KPI non valida (sintassi, operatore o campo sconosciuto)"""
+
+
+def _parse(formula, name):
+    # Formula -> albero di tuple canonico: sotto-espressioni uguali hanno la stessa chiave
+    def visit(node):
+        if isinstance(node, ast.Expression):
+            return visit(node.body)
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPS:
+            op, left, right = _BINARY_OPS[type(node.op)], visit(node.left), visit(node.right)
+            if left[0] == 'const' and right[0] == 'const':
+                return ('const', float(_NUMPY_OPS[op](left[1], right[1])))
+            return (op, left, right)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            operand = visit(node.operand)
+            return ('const', -operand[1]) if operand[0] == 'const' else ('neg', operand)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            function = node.func.id
+            if function == 'abs' and len(node.args) == 1:
+                return ('abs', visit(node.args[0]))
+            if function in _TEMPORAL_FUNCTIONS and len(node.args) == 2:
+                years = node.args[1]
+                if not (isinstance(years, ast.Constant) and type(years.value) is int and years.value >= _TEMPORAL_FUNCTIONS[function]):
+                    raise FormulaError(f"KPI {name}: {function}() vuole un numero intero di anni >= {_TEMPORAL_FUNCTIONS[function]}")
+                return (f"{function}{years.value}", visit(node.args[0]))
+            raise FormulaError(f"KPI {name}: funzione non ammessa '{function}'")
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.UAdd):
+            return visit(node.operand)
+        if isinstance(node, ast.Name):
+            if node.id not in FIELD_NAMES:
+                raise FormulaError(f"KPI {name}: campo sconosciuto '{node.id}'")
+            return ('field', node.id)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            return ('const', float(node.value))
+        raise FormulaError(f"KPI {name}: espressione non ammessa '{ast.dump(node)}'")
+
+    try:
+        tree = ast.parse(formula, mode='eval')
+    except SyntaxError as e:
+        raise FormulaError(f"KPI {name}: formula non valida '{formula}': {e}")
+    return visit(tree)
+
+
+def lag_positions(symbols, years, lags):
+    """
+    {n: posizione della riga (symbol, year - n)} per ogni n di `lags`, -1 se manca.
+    Un solo indice (symbol, year) per tutti i lag: gli anni mancanti non slittano
+    come farebbe uno shift posizionale. Le coppie (symbol, year) devono essere uniche.
+    """
+    symbols = np.asarray(symbols, dtype=object)
+    years = pd.to_numeric(pd.Series(np.asarray(years, dtype=object)), errors='coerce').to_numpy(dtype='float64')
+    rows = pd.MultiIndex.from_arrays([symbols, years])
+    positions = {}
+    for n in lags:
+        position = rows.get_indexer(pd.MultiIndex.from_arrays([symbols, years - n]))
+        position[np.isnan(years)] = -1
+        positions[n] = position
+    return positions
+
+
+def _shift(block, positions, years):
+    # Slot x righe -> stessi slot con i valori di `years` anni prima dello stesso simbolo
+    position = positions.get(years)
+    if position is None:
+        return np.full_like(block, np.nan)
+    shifted = block[:, position]
+    shifted[:, position < 0] = np.nan
+    return shifted
+
+
+class KPIPlan:
+    """
+    Piano di valutazione compilato dal registro. Ogni sotto-espressione distinta
+    (campi compresi) occupa uno slot e si calcola una sola volta; le operazioni
+    sono raggruppate per profondità e operatore, quindi tutte le divisioni di un
+    livello sono un'unica operazione NumPy su tutte le righe. lag/std leggono le
+    righe degli anni precedenti tramite le posizioni di lag_positions.
+    """
+
+    def __init__(self, registry=KPI_REGISTRY):
+        self.names = [kpi[0] for kpi in registry]
+        if len(set(self.names)) != len(self.names):
+            raise FormulaError("Nomi di KPI duplicati nel registro")
+        trees = [_parse(kpi[2], kpi[0]) for kpi in registry]
+
+        # Foglie (campi e costanti) e nodi interni con la loro profondità
+        self.inputs = []
+        self.constants = []
+        depths = {}
+
+        def collect(node):
+            if node in depths:
+                return depths[node]
+            if node[0] == 'field':
+                depth = 0
+                if node[1] not in self.inputs:
+                    self.inputs.append(node[1])
+            elif node[0] == 'const':
+                depth = 0
+                if node[1] not in self.constants:
+                    self.constants.append(node[1])
+            else:
+                depth = 1 + max(collect(child) for child in node[1:])
+            depths[node] = depth
+            return depth
+
+        for tree in trees:
+            collect(tree)
+
+        # Slot: prima gli input (colonne della matrice), poi le costanti, poi i nodi per livello
+        slots = {('field', field): i for i, field in enumerate(self.inputs)}
+        for value in self.constants:
+            slots[('const', value)] = len(slots)
+        self.steps = []
+        for depth in range(1, max(depths.values(), default=0) + 1):
+            groups = {}
+            for node, node_depth in depths.items():
+                if node_depth == depth:
+                    slots[node] = len(slots)
+                    groups.setdefault(node[0], []).append(node)
+            for op, nodes in groups.items():
+                outs = [slots[node] for node in nodes]
+                operands = [[slots[node[i]] for node in nodes] for i in range(1, len(nodes[0]))]
+                self.steps.append((op, outs, operands))
+        self.n_slots = len(slots)
+        self.outputs = [slots[tree] for tree in trees]
+        self.n_subexpressions = len(depths)
+
+        # Anni precedenti richiesti dalle funzioni temporali
+        lags = set()
+        for op, _, _ in self.steps:
+            if op[:3] == 'lag':
+                lags.add(int(op[3:]))
+            elif op[:3] == 'std':
+                lags.update(range(1, int(op[3:])))
+        self.lags = sorted(lags)
+        self.max_lag = max(self.lags, default=0)
+
+    def evaluate(self, matrix, symbols=None, years=None):
+        """
+        Matrice righe x self.inputs (float64) -> matrice righe x self.names.
+        Divisioni per zero e risultati non finiti -> NaN. Senza symbols/years
+        (uno per riga, coppie uniche) i KPI temporali restano NaN.
+        """
+        matrix = np.asarray(matrix, dtype='float64')
+        n_inputs = len(self.inputs)
+        values = np.empty((self.n_slots, matrix.shape[0]))
+        values[:n_inputs] = matrix.T
+        for i, value in enumerate(self.constants):
+            values[n_inputs + i] = value
+        positions = lag_positions(symbols, years, self.lags) if symbols is not None and self.lags else {}
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            for op, outs, operands in self.steps:
+                if op[:3] == 'lag':
+                    values[outs] = _shift(values[operands[0]], positions, int(op[3:]))
+                elif op[:3] == 'std':
+                    block = values[operands[0]]
+                    window = [block] + [_shift(block, positions, n) for n in range(1, int(op[3:]))]
+                    values[outs] = np.std(np.stack(window), axis=0, ddof=1)
+                else:
+                    values[outs] = _NUMPY_OPS[op](*(values[slots] for slots in operands))
+        result = values[self.outputs].T
+        result[~np.isfinite(result)] = np.nan
+        return result
+
+
+KPI_PLAN = KPIPlan(KPI_REGISTRY)
+
+
+def kpi_label(name):
+    return KPI_LABELS.get(name, name)
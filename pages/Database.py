@@ -1,7 +1,7 @@
 import streamlit as st
 import pandas as pd
-from data_utils import read_exchanges, read_companies, get_financial_data, remove_duplicates, get_or_fetch_data, add_meta_tags
-from cache_db import save_to_db, load_from_db, load_many_from_db
+from data_utils import read_exchanges, read_companies, get_financial_data, get_or_fetch_data, add_meta_tags
+from cache_db import save_to_db, load_from_db, iter_many_from_db, load_profiles
 import base64
 import os
 import io
@@ -11,6 +11,9 @@ from PIL import Image
 import copy
 import requests
 import uuid
+from app_init import init_app
+
+init_app()
 
 MEASUREMENT_ID = "G-Q5FDX0L1H2" # Il tuo ID GA4 
 
@@ -92,7 +95,6 @@ exchange_names = list(exchanges.keys())
 years_available = ['2021', '2022', '2023', '2024']
 sectors_available = ['Communication Services', 'Consumer Cyclical', 'Consumer Defensive', 'Energy', 'Financial Services', 'Healthcare', 'Industrials', 'Real Estate', 'Technology', 'Utilities']
 
-financial_data = []
 selected_years = ['2023']
 selected_exchanges = ['NASDAQ']
 selected_sectors = []
@@ -103,9 +105,28 @@ with col1:
     selected_years = st.multiselect("Select Years", years_available, default=selected_years)
 with col2:
     selected_exchanges = st.multiselect("Select Stock Exchanges", exchange_names, default=selected_exchanges)
+
+# Settori e industrie dalla tabella dei profili, senza decodificare data_json
+@st.cache_data(ttl=3600)
+def load_exchange_profiles(symbols):
+    return load_profiles(list(symbols))
+
+exchange_companies = {exchange: read_companies(exchanges[exchange]) for exchange in selected_exchanges}
+all_symbols = tuple(c['ticker'] for companies in exchange_companies.values() for c in companies)
+profiles = load_exchange_profiles(all_symbols)
+profiles = profiles[profiles['sector'].notna() & (profiles['sector'] != 'N/A')]
+if not profiles.empty:
+    sectors_available = sorted(profiles['sector'].unique())
+
 with col3:
     selected_sectors = st.multiselect("Select Sector", sectors_available)
 
+if not profiles.empty:
+    sector_profiles = profiles[profiles['sector'].isin(selected_sectors)] if selected_sectors else profiles
+    with col4:
+        industries_available = sorted(sector_profiles['industry'].dropna().unique())
+        selected_industries = st.multiselect("Select Industry", industries_available, default=selected_industries)
+
 
 if st.button("Reset Filters"):
     selected_years = ['2023']
@@ -141,18 +162,75 @@ st.markdown(f"<div class='currency-info'>{currency_messages.get(currency, 'Numbe
 
 use_cache = True
 
-financial_data = []
+column_order = [
+'symbol', 'description', 'sector', 'industry', 'stock_exchange', 'year',
+'total_revenue', 'operating_revenue', 'cost_of_revenue', 'gross_profit',
+'operating_expense', 'sg_and_a', 'r_and_d', 'operating_income',
+'net_non_operating_interest_income_expense', 'interest_expense_non_operating',
+'pretax_income', 'tax_provision', 'net_income_common_stockholders',
+'net_income', 'net_income_continuous_operations', 'basic_eps', 'diluted_eps',
+'basic_average_shares', 'diluted_average_shares', 'total_expenses',
+'normalized_income', 'interest_expense', 'net_interest_income',
+'ebit', 'ebitda', 'reconciled_depreciation', 'normalized_ebitda',
+'total_assets', 'stockholders_equity', 'free_cash_flow', 'changes_in_cash',
+'working_capital', 'invested_capital', 'total_debt'
+]
+
+# I record letti in streaming si filtrano subito e finiscono in DataFrame a blocchi
+# di CHUNK_ROWS righe: in memoria non resta mai la lista di tutti i dict
+CHUNK_ROWS = 5000
+frames = []
+rows = []
+# Industrie dei record caricati (servono al filtro se manca la tabella dei profili)
+industries_loaded = set()
+# Il filtro per industria si applica in streaming solo se le opzioni vengono dai profili
+filter_industries = selected_industries if not profiles.empty else []
+
+def flush_rows():
+    if rows:
+        frames.append(pd.DataFrame(rows, columns=column_order))
+        rows.clear()
+
+def add_record(data, description, stock_exchange):
+    if not isinstance(data, dict) or data.get('symbol') is None or data.get('year') is None:
+        return
+    if selected_sectors and data.get('sector') not in selected_sectors:
+        return
+    industries_loaded.add(data.get('industry'))
+    if filter_industries and data.get('industry') not in filter_industries:
+        return
+    row = [data.get(column) for column in column_order]
+    row[1], row[4] = description, stock_exchange
+    rows.append(row)
+    if len(rows) >= CHUNK_ROWS:
+        flush_rows()
+
 for exchange in selected_exchanges:
-    companies = read_companies(exchanges[exchange])
+    companies = exchange_companies[exchange]
     symbols = [c['ticker'] for c in companies]
     symbol_to_company = {c['ticker']: c for c in companies}
 
+    # Con filtri attivi carichiamo solo i ticker compatibili (o senza profilo)
+    if not profiles.empty and (selected_sectors or selected_industries):
+        matching = profiles
+        if selected_sectors:
+            matching = matching[matching['sector'].isin(selected_sectors)]
+        if selected_industries:
+            matching = matching[matching['industry'].isin(selected_industries)]
+        matching_symbols = set(matching['symbol'])
+        profiled_symbols = set(profiles['symbol'])
+        symbols = [s for s in symbols if s in matching_symbols or s not in profiled_symbols]
+
     print(f"Carico dati dal DB per {len(symbols)} simboli su {exchange}...")
-    db_data = load_many_from_db(symbols, selected_years)
-    print(f"Caricati dal DB: {len(db_data)} record")
+    # Lettura in streaming a blocchi di simboli, nell'ordine symbol/anno
+    loaded_keys = set()
+    for (symbol, y), data in iter_many_from_db(symbols, selected_years):
+        add_record(data, symbol_to_company[symbol].get('description', ''), exchange)
+        loaded_keys.add((symbol, y))
+    print(f"Caricati dal DB: {len(loaded_keys)} record")
 
-    for k, v in list(db_data.items())[:5]:
-        print(f"DB record esempio: {k} keys={list(v.keys()) if v else None}")
+    if use_cache:
+        continue
 
     for symbol in symbols:
         company = symbol_to_company[symbol]
@@ -160,73 +238,35 @@ for exchange in selected_exchanges:
         stock_exchange = exchange
 
         data_list = []
-        missing_years = []
-
-        for year in selected_years:
-            y = int(year)
-            data = db_data.get((symbol, y))
-            if data:
-                data_copy = copy.deepcopy(data)
-                data_copy['description'] = description
-                data_copy['stock_exchange'] = stock_exchange
-                data_list.append(data_copy)
-            else:
-                missing_years.append(y)
-                data_list.append(None)
-
-        if not use_cache and missing_years:
+        missing_years = [int(year) for year in selected_years if (symbol, int(year)) not in loaded_keys]
+
+        if missing_years:
             print(f"Fetch dati mancanti per {symbol}: anni {missing_years}", flush=True)
-            fetched_data = get_or_fetch_data(symbol, missing_years, description, stock_exchange)
+            data_list = get_or_fetch_data(symbol, missing_years, description, stock_exchange)
             # NON serve save_to_db qui perché già fatto dentro get_or_fetch_data
-            for i, year in enumerate(selected_years):
-                if data_list[i] is None and year in missing_years:
-                    idx = missing_years.index(year)
-                    data_list[i] = fetched_data[idx]
 
-        financial_data.extend([d for d in data_list if d is not None])
+        for data in data_list:
+            add_record(data, description, stock_exchange)
 
-print(f"Totale dati caricati in financial_data: {len(financial_data)}")
-print("Esempio dati caricati:", financial_data[:3])
+flush_rows()
+df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=column_order)
+print(f"Totale dati caricati: {len(df)} righe in {len(frames)} blocchi")
 
+# Senza profili in tabella le industrie si ricavano dai record caricati
+if profiles.empty:
+    industries_available = sorted(industry for industry in industries_loaded if industry is not None)
 
+    # Mostra il multiselect per l'industria con le opzioni basate sulle industrie disponibili
+    with col4:
+        selected_industries = st.multiselect("Select Industry", industries_available, default=selected_industries)
 
-financial_data = remove_duplicates(financial_data)
-if selected_sectors:
-    industries_available = list(set(d['industry'] for d in financial_data if 'industry' in d and d['sector'] in selected_sectors))
-else:
-    industries_available = list(set(d['industry'] for d in financial_data if 'industry' in d))
-
-# Mostra il multiselect per l'industria con le opzioni basate sulle industrie disponibili
-with col4:
-    selected_industries = st.multiselect("Select Industry", industries_available, default=selected_industries)
-
-
-if selected_sectors:
-    financial_data = [d for d in financial_data if d.get('sector') in selected_sectors]
-if selected_industries:
-    financial_data = [d for d in financial_data if d.get('industry') in selected_industries]
-
-financial_data = [x for x in financial_data if isinstance(x, dict) and 'symbol' in x and 'year' in x]
-financial_data.sort(key=lambda x: (x['symbol'], x['year']))
-
-
-if financial_data:
-    df = pd.DataFrame(financial_data)
-    column_order = [
-    'symbol', 'description', 'sector', 'industry', 'stock_exchange', 'year',
-    'total_revenue', 'operating_revenue', 'cost_of_revenue', 'gross_profit',
-    'operating_expense', 'sg_and_a', 'r_and_d', 'operating_income',
-    'net_non_operating_interest_income_expense', 'interest_expense_non_operating',
-    'pretax_income', 'tax_provision', 'net_income_common_stockholders',
-    'net_income', 'net_income_continuous_operations', 'basic_eps', 'diluted_eps',
-    'basic_average_shares', 'diluted_average_shares', 'total_expenses',
-    'normalized_income', 'interest_expense', 'net_interest_income',
-    'ebit', 'ebitda', 'reconciled_depreciation', 'normalized_ebitda',
-    'total_assets', 'stockholders_equity', 'free_cash_flow', 'changes_in_cash',
-    'working_capital', 'invested_capital', 'total_debt'
-    ]
-
-    df = df[column_order]  # applica l'ordine delle colonne
+    if selected_industries:
+        df = df[df['industry'].isin(selected_industries)]
+
+df = df.drop_duplicates().sort_values(['symbol', 'year'], kind='stable').reset_index(drop=True)
+
+
+if not df.empty:
     st.success(f"{len(df)} records loaded.")
     COLUMN_LABELS = {
     "symbol": "Ticker",
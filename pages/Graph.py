@@ -3,7 +3,9 @@ import pandas as pd
 import numpy as np
 import plotly.express as px
 from data_utils import read_exchanges, read_companies, get_financial_data, compute_kpis, add_meta_tags
-from cache_db import load_kpis_for_symbol_year, save_kpis_to_db, KPICache, Session
+from cache_db import load_kpis_for_symbol_year, save_kpis_to_db, KPICache, Session, decode_kpi_payload
+from kpi_registry import KPI_NAMES, LEVEL_KPIS, TREND_KPIS, KPI_LABELS, PERCENT_KPIS
+import snapshot
 import json
 import io
 import os
@@ -11,6 +13,9 @@ import base64
 import logging
 import requests
 import uuid
+from app_init import init_app
+
+init_app()
 
 MEASUREMENT_ID = "G-Q5FDX0L1H2" # Il tuo ID GA4
 
@@ -56,7 +61,8 @@ COLUMN_LABELS = {
     "stockholders_equity": "Equity",
     "total_assets": "Total Assets",
     "basic_eps": "Basic EPS",
-    "diluted_eps": "Diluted EPS"
+    "diluted_eps": "Diluted EPS",
+    **KPI_LABELS
 }
 
 # === FUNZIONI MIGLIORATE ===
@@ -65,6 +71,14 @@ USE_DB = True
 
 @st.cache_data(show_spinner=False)
 def load_kpis_filtered_by_exchange(symbols_filter=None):
+    # Prima lo snapshot Arrow locale (mappato in memoria), poi il DB
+    if snapshot.SNAPSHOT_READS:
+        try:
+            df = snapshot.snapshot_frame('kpis', symbols=symbols_filter or None)
+            # Solo KPI e identificativi: le colonne descrittive finirebbero nel radar
+            return df.drop(columns=['sector', 'industry', 'stock_exchange'], errors='ignore')
+        except Exception as e:
+            logger.warning(f"Snapshot KPI non disponibile, leggo dal DB: {e}")
     try:
         with Session() as session:
             query = session.query(KPICache)
@@ -75,7 +89,7 @@ def load_kpis_filtered_by_exchange(symbols_filter=None):
             kpi_data = []
             for e in entries:
                 try:
-                    val = json.loads(e.kpi_json) if isinstance(e.kpi_json, str) else e.kpi_json
+                    val = decode_kpi_payload(e.kpi_json, e.kpi_blob)
                     if isinstance(val, dict):
                         val['symbol'] = e.symbol
                         val['year'] = e.year
@@ -92,8 +106,10 @@ def load_kpis_filtered_by_exchange(symbols_filter=None):
 
 @st.cache_data(show_spinner=True)
 def load_data_for_selection(selected_symbols, selected_years):
-    from cache_db import load_many_from_db, save_kpis_to_db, Session, KPICache
+    from cache_db import load_many_from_db, Session, KPICache, decode_kpi_payload
     from data_utils import get_financial_data, compute_kpis
+    from kpi_registry import KPI_PLAN
+    from kpi_materialize import materialize_kpis
 
     results = {}
     to_fetch = []
@@ -110,7 +126,7 @@ def load_data_for_selection(selected_symbols, selected_years):
                     exists = session.query(KPICache).filter_by(symbol=symbol, year=int(year)).first()
                     if exists:
                         logger.info(f"✅ KPI esistente per {symbol} {year}, carico da DB")
-                        val = json.loads(exists.kpi_json) if isinstance(exists.kpi_json, str) else exists.kpi_json
+                        val = decode_kpi_payload(exists.kpi_json, exists.kpi_blob)
                         val['symbol'] = symbol
                         val['year'] = year
                         val['description'] = exists.description
@@ -119,34 +135,39 @@ def load_data_for_selection(selected_symbols, selected_years):
                         logger.info(f"🔄 KPI mancanti per {symbol} {year}, vanno calcolati")
                         to_fetch.append((symbol, year))
 
-        # 🔁 Calcolo e salvataggio solo per i mancanti
+        # 🔁 Calcolo e salvataggio solo per i mancanti. I KPI di trend leggono gli anni
+        # precedenti: si scaricano anche quelli (fino a KPI_PLAN.max_lag), altrimenti
+        # in KPICache finirebbero crescite e volatilità tutte NaN
+        missing_by_symbol = {}
         for symbol, year in to_fetch:
+            missing_by_symbol.setdefault(symbol, {})[int(year)] = year
+        for symbol, years in missing_by_symbol.items():
             try:
-                raw_data = get_financial_data(symbol, int(year))
-                if not raw_data:
-                    logger.warning(f"Nessun dato finanziario per {symbol} {year}")
+                history = sorted({year - n for year in years for n in range(KPI_PLAN.max_lag + 1)})
+                raw_data = [d for d in get_financial_data(symbol, history) if d]
+                if not any(int(d['year']) in years for d in raw_data):
+                    logger.warning(f"Nessun dato finanziario per {symbol} {sorted(years)}")
                     continue
 
                 df_kpis = compute_kpis(raw_data)
                 if df_kpis.empty:
-                    logger.warning(f"KPI vuoti per {symbol} {year}")
+                    logger.warning(f"KPI vuoti per {symbol} {sorted(years)}")
                     continue
 
-                save_kpis_to_db(df_kpis)
+                # Salvataggio come i job batch: stesso hash degli input, anni precedenti compresi
+                materialize_kpis(symbols=[symbol], years=sorted(years))
 
-                for _, row in df_kpis.iterrows():
-                    record = row.to_dict()
-                    record['symbol'] = symbol
-                    record['year'] = year
-                    results[(symbol, year)] = record
+                for record in df_kpis[df_kpis['year'].astype(int).isin(years)].to_dict('records'):
+                    results[(symbol, years[int(record['year'])])] = record
 
             except Exception as e:
-                logger.error(f"Errore nel calcolo o salvataggio KPI per {symbol} {year}: {e}")
+                logger.error(f"Errore nel calcolo o salvataggio KPI per {symbol} {sorted(years)}: {e}")
 
     # 🔄 Ricostruzione lista di dizionari per DataFrame
     data = []
     for (symbol, year), record in results.items():
         if isinstance(record, dict) and record:
+            record = dict(record)
             record['symbol'] = symbol
             record['year'] = year
             data.append(record)
@@ -236,7 +257,8 @@ def render_kpis(exchanges_dict):
 
     # ---------------- TABELLA KPI ----------------
     id_vars = ['symbol', 'description', 'year']
-    value_vars = [col for col in df_filtered.columns if col not in id_vars and df_filtered[col].dtype != 'object']
+    # KPI nell'ordine del registro, così tabella e radar coincidono con le altre pagine
+    value_vars = [col for col in KPI_NAMES if col in df_filtered.columns]
 
     df_melt = df_filtered.melt(id_vars=id_vars, value_vars=value_vars, var_name='KPI', value_name='Value')
     df_melt['desc_year'] = df_melt['description'] + ' ' + df_melt['year'].astype(str)
@@ -278,8 +300,11 @@ def render_kpis(exchanges_dict):
         unsafe_allow_html=True
     )
 
-    num_cols = df_pivot.select_dtypes(include=['number']).columns
-    styled = df_pivot.style.format({col: "{:.2%}" for col in num_cols})
+    df_pivot = df_pivot.reindex([COLUMN_LABELS.get(k, k) for k in value_vars])
+    percent_rows = [COLUMN_LABELS.get(k, k) for k in value_vars if k in PERCENT_KPIS]
+    other_rows = [COLUMN_LABELS.get(k, k) for k in value_vars if k not in PERCENT_KPIS]
+    styled = df_pivot.style.format("{:.2%}", subset=pd.IndexSlice[percent_rows, :], na_rep="") \
+        .format("{:.2f}", subset=pd.IndexSlice[other_rows, :], na_rep="")
 
     with st.container():
         st.dataframe(
@@ -322,7 +347,7 @@ def render_kpis(exchanges_dict):
     st.subheader("📊 KPI Comparison Radar")
     
     id_vars = ['symbol', 'description', 'year']
-    candidate_cols = [c for c in df_filtered.columns if c not in id_vars]
+    candidate_cols = [c for c in LEVEL_KPIS if c in df_filtered.columns]
     
     if not candidate_cols:
         st.info("Nessun KPI numerico disponibile per il radar chart.")
@@ -384,6 +409,27 @@ def render_kpis(exchanges_dict):
         )
     
         st.plotly_chart(fig, use_container_width=True, config={"responsive": True})
+
+    # Trend: serie storica materializzata (tutti gli anni delle aziende selezionate)
+    st.markdown("<br><br>", unsafe_allow_html=True)
+    st.subheader("📈 Trends")
+    trend_options = [c for c in TREND_KPIS + LEVEL_KPIS if c in df_all_kpis.columns]
+    if trend_options:
+        trend_metric = st.selectbox("Metric", trend_options, format_func=lambda k: COLUMN_LABELS.get(k, k))
+        df_trend = df_all_kpis[
+            df_all_kpis['symbol'].isin(selected_symbols) & df_all_kpis['description'].isin(selected_desc)
+        ].dropna(subset=[trend_metric]).sort_values('year')
+        if df_trend.empty:
+            st.info("Serie storica non disponibile per le aziende selezionate.")
+        else:
+            fig = px.line(
+                df_trend, x='year', y=trend_metric, color='description', markers=True,
+                labels={trend_metric: COLUMN_LABELS.get(trend_metric, trend_metric), 'year': 'Year', 'description': 'Company'}
+            )
+            if trend_metric in PERCENT_KPIS:
+                fig.update_yaxes(tickformat='.0%')
+            fig.update_xaxes(dtick=1)
+            st.plotly_chart(fig, use_container_width=True)
     
     # Bubble Chart
     # Aggiunge 3 righe vuote
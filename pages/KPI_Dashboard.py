@@ -1,8 +1,11 @@
 import streamlit as st
 import pandas as pd
 import plotly.graph_objects as go
-from data_utils import read_exchanges, read_companies, get_financial_data, remove_duplicates, compute_kpis, add_meta_tags
+from data_utils import read_exchanges, read_companies, read_all_companies, get_financial_data, remove_duplicates, compute_kpis, add_meta_tags
 from data_utils import get_or_fetch_data 
+from cache_db import load_profiles, AGGREGATE_ALL
+from percentile_index import load_index, load_peer_sketches
+from kpi_registry import PERCENT_KPIS, kpi_label
 import os
 import base64
 import requests
@@ -10,6 +13,9 @@ import uuid
 import textwrap
 import numpy as np
 import random
+from app_init import init_app
+
+init_app()
 
 MEASUREMENT_ID = "G-Q5FDX0L1H2" # Il tuo ID GA4 
 
@@ -72,6 +78,8 @@ exchanges = read_exchanges("exchanges.txt")
 exchange_names = ["All"] + list(exchanges.keys())
 
 years_available = ['2021', '2022', '2023', '2024']
+# KPI mostrati nei grafici: etichette e formato percentuale dal registro
+DASHBOARD_KPIS = ["EBITDA Margin", "FCF Margin", "Debt/Equity", "EPS"]
 sectors_available = ['Communication Services', 'Consumer Cyclical', 'Consumer Defensive', 'Energy', 'Financial Services', 'Healthcare', 'Industrials', 'Real Estate', 'Technology', 'Utilities']
 
 # Layout filtri
@@ -82,12 +90,14 @@ with col2:
     selected_exchange = st.selectbox("Exchange", exchange_names, index=0, key="exchange_select")
 
 # Carico lista aziende
+# Exchange di appartenenza di ogni ticker (dal file dell'exchange, come nell'ingestion)
 if selected_exchange == "All":
-    companies = []
-    for exch in exchanges.values():
-        companies.extend(read_companies(exch))
+    companies = read_all_companies(exchanges)
 else:
-    companies = read_companies(exchanges[selected_exchange])
+    companies = read_all_companies({selected_exchange: exchanges[selected_exchange]})
+symbol_to_exchange = {}
+for c in companies:
+    symbol_to_exchange.setdefault(c["ticker"], c["stock_exchange"])
 
 symbol_to_name = {c["ticker"]: c["description"] for c in companies}
 name_to_symbol = {v: k for k, v in symbol_to_name.items()}
@@ -97,55 +107,29 @@ with col3:
     selected_company_names = st.multiselect("Companies (up to 10)", options=sorted(company_names), max_selections=10, key="companies_select")
     selected_symbols = [name_to_symbol[name] for name in selected_company_names]
 
-with col4:
-    if selected_exchange == "All":
-        selected_sector = st.selectbox("Sector", options=["All"], disabled=True, help="Sector filter is disabled when 'All' exchanges are selected", key="sector_select_disabled")
-    else:
-        selected_sector = st.selectbox("Sector", options=["All"] + sectors_available, key="sector_select_enabled")
-
-# Cache per dati settore
+# Settori dell'exchange dalla tabella dei profili (fallback sulla lista fissa)
 @st.cache_data(ttl=3600)
-def load_all_sector_data(exchange_name, year, max_companies=100):
-    """Carica tutti i dati di un exchange per calcolo settori"""
+def load_sector_options(symbols):
+    profiles = load_profiles(list(symbols))
+    return sorted(s for s in profiles["sector"].dropna().unique() if s != "N/A")
+
+with col4:
+    exchange_sectors = load_sector_options(tuple(symbol_to_name.keys())) or sectors_available
+    selected_sector = st.selectbox("Sector", options=["All"] + exchange_sectors, key="sector_select")
+
+# Benchmark di settore dagli sketch dei quantili in kpi_aggregates: uno sketch per
+# exchange/settore/KPI, uniti fra exchange per la vista "All" (memoria costante).
+# Gli aggregati li costruiscono scheduler/ingestion: la pagina legge soltanto.
+@st.cache_data(ttl=600)
+def load_sector_benchmarks(exchange_names, year):
+    """Mediana e numero di aziende per settore e KPI sull'intero universo degli exchange"""
     try:
-        exch_file = exchanges[exchange_name]
-        all_companies = read_companies(exch_file)
-        
-        all_data = []
-        companies_processed = 0
-        
-        for company in all_companies:
-            if companies_processed >= max_companies:
-                break
-                
-            desc = company.get("description", "")
-            try:
-                data = get_or_fetch_data(company["ticker"], [year], desc, exchange_name)
-                if data:
-                    all_data.extend(data)
-                    companies_processed += 1
-            except:
-                continue
-        
-        if not all_data:
-            return pd.DataFrame()
-            
-        # Calcola KPI
-        df_all = compute_kpis(all_data)
-        df_all = df_all[df_all["year"] == int(year)]
-        
-        # Merge con raw data per EPS e settore
-        df_raw = pd.DataFrame(all_data)
-        if "ticker" in df_raw.columns and "symbol" not in df_raw.columns:
-            df_raw.rename(columns={"ticker": "symbol"}, inplace=True)
-        
-        df_all = pd.merge(df_all, df_raw[["symbol", "basic_eps", "sector"]], on="symbol", how="left")
-        
-        # Rinomina colonne
-        df_all.rename(columns={"EBITDA Margin": "EBITDA Margin", "Debt/Equity": "Debt to Equity", "FCF Margin": "FCF Margin", "basic_eps": "EPS"}, inplace=True)
-        
-        return df_all
-        
+        sketches = load_peer_sketches(int(year), exchange_names, sector=None, kpis=DASHBOARD_KPIS)
+        rows = [
+            {"sector": sector, "kpi": kpi, "count": len(sketch), "median": sketch.median()}
+            for (sector, _, kpi), sketch in sketches.items() if sector != AGGREGATE_ALL
+        ]
+        return pd.DataFrame(rows, columns=["sector", "kpi", "count", "median"])
     except Exception as e:
         st.error(f"Error loading sector data: {e}")
         return pd.DataFrame()
@@ -156,27 +140,23 @@ used_exchanges = set()
 
 for symbol in selected_symbols:
     desc = symbol_to_name.get(symbol, "")
-    if selected_exchange == "All":
-        for exch_name, exch_file in exchanges.items():
-            try:
-                data = get_or_fetch_data(symbol, [selected_year], desc, exch_name)
-                if data:
-                    financial_data.extend(data)
-                    used_exchanges.add(exch_name)
-                    break
-            except:
-                continue
-    else:
-        data = get_or_fetch_data(symbol, [selected_year], desc, selected_exchange)
-        if data:
-            financial_data.extend(data)
-            used_exchanges.add(selected_exchange)
-
-# Carica dati completi per settore se necessario
-df_all_sector = pd.DataFrame()
-if selected_sector != "All" and selected_exchange != "All":
+    # Anche nella vista "All" ogni azienda resta sul proprio exchange: i percentili
+    # e gli insight la confrontano con i pari di quell'exchange
+    exchange_name = symbol_to_exchange[symbol]
+    try:
+        data = get_or_fetch_data(symbol, [selected_year], desc, exchange_name)
+    except Exception:
+        data = []
+    if data:
+        financial_data.extend(data)
+        used_exchanges.add(exchange_name)
+
+# Aggregati di settore se necessari
+df_sector_agg = pd.DataFrame()
+if selected_sector != "All":
     with st.spinner(f"Loading {selected_sector} sector data from {selected_exchange}..."):
-        df_all_sector = load_all_sector_data(selected_exchange, selected_year)
+        benchmark_exchanges = tuple(exchanges) if selected_exchange == "All" else (selected_exchange,)
+        df_sector_agg = load_sector_benchmarks(benchmark_exchanges, selected_year)
 
 if not financial_data:
     st.warning("No data available for the selected companies.")
@@ -186,15 +166,12 @@ if not financial_data:
 df_kpi_all = compute_kpis(financial_data)
 df_kpi_all = df_kpi_all[df_kpi_all["year"] == int(selected_year)]
 
-# EPS e settore dal raw data
+# Settore dal raw data (EPS arriva dal registro dei KPI)
 df_raw = pd.DataFrame(financial_data)
 if "ticker" in df_raw.columns and "symbol" not in df_raw.columns:
     df_raw.rename(columns={"ticker": "symbol"}, inplace=True)
 
-df_kpi_all = pd.merge(df_kpi_all, df_raw[["symbol", "basic_eps", "sector"]], on="symbol", how="left")
-
-# Rinomina colonne
-df_kpi_all.rename(columns={"EBITDA Margin": "EBITDA Margin", "Debt/Equity": "Debt to Equity", "FCF Margin": "FCF Margin", "basic_eps": "EPS"}, inplace=True)
+df_kpi_all = pd.merge(df_kpi_all, df_raw[["symbol", "sector", "stock_exchange"]], on="symbol", how="left")
 
 # Aggiungi descrizione azienda
 df_kpi_all["company_name"] = df_kpi_all["symbol"].map(symbol_to_name)
@@ -203,18 +180,23 @@ df_kpi_all["company_name"] = df_kpi_all["symbol"].map(symbol_to_name)
 df_visible = df_kpi_all[df_kpi_all["symbol"].isin(selected_symbols)]
 
 # Info settore
-if selected_exchange != "All" and selected_sector != "All" and not df_all_sector.empty:
-    sector_count = len(df_all_sector[df_all_sector["sector"] == selected_sector])
+if selected_sector != "All" and df_sector_agg.empty:
+    st.info("ℹ️ Sector benchmarks are not available yet for this year: they are computed by the background refresh.")
+
+if selected_sector != "All" and not df_sector_agg.empty:
+    # Aziende del settore: il massimo dei conteggi per KPI (i KPI mancanti non contano)
+    companies_by_sector = df_sector_agg.groupby("sector")["count"].max().sort_values(ascending=False)
+    sector_count = int(companies_by_sector.get(selected_sector, 0))
+    exchange_label = "all exchanges" if selected_exchange == "All" else selected_exchange
     if sector_count > 0:
-        st.success(f"✅ Sector benchmark from {sector_count} {selected_sector} companies ({selected_exchange})")
+        st.success(f"✅ Sector benchmark from {sector_count} {selected_sector} companies ({exchange_label})")
     else:
-        st.warning(f"⚠️ No {selected_sector} companies found in {selected_exchange}")
+        st.warning(f"⚠️ No {selected_sector} companies found in {exchange_label}")
         
         # Debug: mostra settori disponibili
-        if not df_all_sector.empty:
-            available_sectors = df_all_sector["sector"].value_counts()
+        if not companies_by_sector.empty:
             st.write("**Available sectors in data:**")
-            for sector, count in available_sectors.head(10).items():
+            for sector, count in companies_by_sector.head(10).items():
                 st.write(f"- {sector}: {count} companies")
 
 def legend_chart():
@@ -234,14 +216,11 @@ def _safe_median(df, col):
         return np.nan
     return float(series.median())
 
-# Pre-calcola tutte le mediane di settore una volta sola
+# Mediane di settore dagli sketch (le mediane delle aziende selezionate restano esatte)
 sector_medians = {}
-if selected_sector != "All" and selected_exchange != "All" and not df_all_sector.empty:
-    df_sector = df_all_sector[df_all_sector["sector"] == selected_sector]
-    if not df_sector.empty:
-        metrics = ["EBITDA Margin", "FCF Margin", "Debt to Equity", "EPS"]
-        for metric in metrics:
-            sector_medians[metric] = _safe_median(df_sector, metric)
+if selected_sector != "All" and not df_sector_agg.empty:
+    df_sector = df_sector_agg[(df_sector_agg["sector"] == selected_sector) & df_sector_agg["kpi"].isin(DASHBOARD_KPIS)]
+    sector_medians = {kpi: float(median) for kpi, median in zip(df_sector["kpi"], df_sector["median"]) if median is not None}
 
 def kpi_chart(df_visible, metric, title, is_percent=True):
     fig = go.Figure()
@@ -334,13 +313,34 @@ def kpi_chart(df_visible, metric, title, is_percent=True):
     return fig
 
 # Grafici
-col1, col2 = st.columns(2)
-with col1:
-    st.plotly_chart(kpi_chart(df_visible, "EBITDA Margin", "EBITDA Margin", is_percent=True), use_container_width=True)
-    st.plotly_chart(kpi_chart(df_visible, "FCF Margin", "FCF Margin", is_percent=True), use_container_width=True)
-with col2:
-    st.plotly_chart(kpi_chart(df_visible, "Debt to Equity", "Debt to Equity", is_percent=False), use_container_width=True)
-    st.plotly_chart(kpi_chart(df_visible, "EPS", "Earnings per Share (EPS)", is_percent=False), use_container_width=True)
+chart_columns = st.columns(2)
+for i, metric in enumerate(DASHBOARD_KPIS):
+    with chart_columns[i // 2]:
+        st.plotly_chart(kpi_chart(df_visible, metric, kpi_label(metric), is_percent=metric in PERCENT_KPIS), use_container_width=True)
+
+# Posizione percentile nel settore: sketch dei quantili degli aggregati
+def sector_percentiles(df_visible, year):
+    ranks = pd.DataFrame(index=df_visible.index, columns=DASHBOARD_KPIS, dtype=float)
+    unavailable = []
+    for exchange, rows in df_visible.dropna(subset=["stock_exchange"]).groupby("stock_exchange"):
+        index = load_index(exchange, year)
+        if not len(index):
+            unavailable.append(exchange)
+            continue
+        sectors = rows["sector"].fillna("N/A").to_numpy()
+        for metric in DASHBOARD_KPIS:
+            ranks.loc[rows.index, metric] = index.rank_many(metric, rows[metric].to_numpy(dtype=float), sectors=sectors)
+    return ranks, unavailable
+
+df_percentiles, percentiles_unavailable = sector_percentiles(df_visible, selected_year)
+if percentiles_unavailable:
+    st.info(f"ℹ️ Percentile benchmarks are not available yet for {', '.join(percentiles_unavailable)} ({selected_year}).")
+if df_percentiles.notna().any().any():
+    st.subheader("📍 Percentile Rank in Sector")
+    st.caption("Position of each company among all companies of its sector on the same exchange (0 = lowest, 100 = highest).")
+    table = df_percentiles.rename(columns=kpi_label)
+    table.insert(0, "Company", df_visible["company_name"])
+    st.dataframe(table.style.format("{:.0f}", subset=[kpi_label(m) for m in DASHBOARD_KPIS], na_rep="–"), hide_index=True, use_container_width=True)
 
 # INSIGHTS
 insight_list = []
@@ -349,7 +349,7 @@ for index, row in df_visible.iterrows():
     sector = row["sector"]
     ebitda_margin = row["EBITDA Margin"]
     fcf_margin = row["FCF Margin"]
-    debt_equity = row["Debt to Equity"]
+    debt_equity = row["Debt/Equity"]
     eps = row["EPS"]
 
     if pd.isna(sector):
@@ -358,7 +358,7 @@ for index, row in df_visible.iterrows():
     sector_df = df_kpi_all[df_kpi_all["sector"] == sector]
     avg_ebitda = sector_df["EBITDA Margin"].mean()
     avg_fcf = sector_df["FCF Margin"].mean()
-    avg_debt_equity = sector_df["Debt to Equity"].mean()
+    avg_debt_equity = sector_df["Debt/Equity"].mean()
     avg_eps = sector_df["EPS"].mean()
 
     # EBITDA Margin
@@ -399,6 +399,15 @@ for index, row in df_visible.iterrows():
             options = [f"**{company}** trails the sector in earnings, with an EPS of just {eps:.2f}.", f"Earnings per share of **{company}** ({eps:.2f}) fall short of peer performance."]
             insight_list.append(random.choice(options))
 
+# Percentili estremi nel settore (primo e ultimo decile)
+for index, row in df_visible.iterrows():
+    for metric in DASHBOARD_KPIS:
+        rank = df_percentiles.at[index, metric]
+        if pd.isna(rank) or 10 < rank < 90:
+            continue
+        side = "top" if rank >= 90 else "bottom"
+        insight_list.append(f"**{row['company_name']}** is in the {side} decile of {row['sector']} companies on {row['stock_exchange']} for {kpi_label(metric)} (percentile {rank:.0f}).")
+
 # Shuffle insights
 unique_insights = list(dict.fromkeys(insight_list))
 random.shuffle(unique_insights)
@@ -4,6 +4,9 @@ from PIL import Image
 from data_utils import add_meta_tags
 import requests
 import uuid
+from app_init import init_app
+
+init_app()
 
 MEASUREMENT_ID = "G-Q5FDX0L1H2" # Il tuo ID GA4 
 
@@ -0,0 +1,79 @@
+import numpy as np
+
+from cache_db import load_kpi_sketches, AGGREGATE_ALL
+from record_cache import RecordCache, _MISSING
+from quantile_sketch import QuantileSketch
+
+# Indici caricati per (stock_exchange, year): pochi e grandi, scadono come la cache dei record
+_indexes = RecordCache(maxsize=64)
+
+
+class PercentileIndex:
+    """
+    Sketch dei quantili dei KPI di un exchange/anno per gruppo di pari (settore,
+    industria, con AGGREGATE_ALL per i livelli superiori), dalla tabella
+    kpi_aggregates. Il rank percentile (0-100) si interpola fra i centroidi dello
+    sketch: esatto per i gruppi piccoli, approssimato per quelli grandi.
+    """
+
+    def __init__(self, stock_exchange, year, sketches):
+        self.stock_exchange = stock_exchange
+        self.year = int(year)
+        self._sketches = sketches
+
+    def __len__(self):
+        return len(self._sketches)
+
+    def peers(self, kpi, sector=AGGREGATE_ALL, industry=AGGREGATE_ALL):
+        """Sketch del gruppo di pari, None se il gruppo non esiste"""
+        return self._sketches.get((sector, industry, kpi))
+
+    def rank(self, kpi, value, sector=AGGREGATE_ALL, industry=AGGREGATE_ALL):
+        return float(self.rank_many(kpi, [value], [sector], [industry])[0])
+
+    def rank_many(self, kpi, values, sectors=None, industries=None):
+        """
+        Rank percentili di molte aziende in blocco: un'interpolazione per gruppo di
+        pari distinto. NaN per valori mancanti o gruppi assenti.
+        """
+        values = np.asarray(values, dtype='float64')
+        sectors = np.full(len(values), AGGREGATE_ALL, dtype=object) if sectors is None else np.asarray(sectors, dtype=object)
+        industries = np.full(len(values), AGGREGATE_ALL, dtype=object) if industries is None else np.asarray(industries, dtype=object)
+        ranks = np.full(len(values), np.nan)
+        for sector, industry in set(zip(sectors, industries)):
+            peers = self.peers(kpi, sector, industry)
+            if peers is None or len(peers) == 0:
+                continue
+            mask = (sectors == sector) & (industries == industry) & ~np.isnan(values)
+            ranks[mask] = peers.rank(values[mask])
+        return ranks
+
+
+def load_index(stock_exchange, year):
+    """Indice dei percentili di un exchange/anno, condiviso nel processo"""
+    key = (stock_exchange, int(year))
+    index = _indexes.get(key)
+    if index is _MISSING:
+        token = _indexes.token(key)
+        index = PercentileIndex(stock_exchange, year, load_peer_sketches(year, [stock_exchange], sector=None, industry=None))
+        # Un indice vuoto (aggregati non ancora costruiti dal job) non si tiene in cache
+        if len(index):
+            _indexes.put(key, index, token=token)
+    return index
+
+
+def load_peer_sketches(year, stock_exchanges=None, sector=AGGREGATE_ALL, industry=AGGREGATE_ALL, kpis=None):
+    """
+    {(sector, industry, kpi): QuantileSketch} di un anno, uniti su più exchange
+    (default tutti): mediane e percentili della vista "All" senza leggere i valori.
+    """
+    blobs = load_kpi_sketches(year, stock_exchanges=stock_exchanges, sector=sector, industry=industry, kpis=kpis)
+    grouped = {}
+    for (_, group_sector, group_industry, kpi), blob in blobs.items():
+        grouped.setdefault((group_sector, group_industry, kpi), []).append(QuantileSketch.from_bytes(blob))
+    return {key: QuantileSketch.merge_all(sketches) for key, sketches in grouped.items()}
+
+
+def invalidate(groups):
+    """Da chiamare dopo la riscrittura degli aggregati di questi (stock_exchange, year)"""
+    _indexes.invalidate([(exchange, int(year)) for exchange, year in groups])
@@ -0,0 +1,183 @@
+import os
+import copy
+import json
+import time
+import random
+import logging
+import threading
+from abc import ABC, abstractmethod
+
+import pandas as pd
+import yfinance as yf
+
+from rate_limiter import get_limiter
+from statements import statement_years
+
+# Logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("providers")
+
+STATEMENTS = ('financials', 'balance_sheet', 'cashflow')
+
+
+class ProviderError(Exception):
+    """Errore (anche simulato) di un provider di dati finanziari"""
+
+
+class FinancialDataProvider(ABC):
+    """
+    Interfaccia comune: prospetti, info e periodi disponibili per un simbolo.
+    get_statements e get_info sono astratti: un provider incompleto fallisce
+    quando viene istanziato, non a metà di un'ingestion.
+    """
+
+    name = 'base'
+    # Limiter delle chiamate upstream; None = limiter di processo (rate_limiter.get_limiter)
+    limiter = None
+
+    @abstractmethod
+    def get_statements(self, symbol):
+        """Dict {'financials', 'balance_sheet', 'cashflow'} -> DataFrame (voci x periodi)"""
+
+    @abstractmethod
+    def get_info(self, symbol):
+        """Dict con i metadati del titolo (sector, industry, ...)"""
+
+    def get_periods(self, symbol):
+        """Anni disponibili nel conto economico"""
+        financials = self.get_statements(symbol)['financials']
+        return [int(y) for y in statement_years(financials).dropna()]
+
+    def calls_per_fetch(self, need_info=True):
+        """Chiamate upstream di un download: una per prospetto, più info se il profilo va aggiornato"""
+        return len(STATEMENTS) + (1 if need_info else 0)
+
+    def with_limiter(self, limiter):
+        """Copia del provider che usa `limiter` (es. la quota di un job dello scheduler)"""
+        provider = copy.copy(self)
+        provider.limiter = limiter
+        return provider
+
+    def _limiter(self):
+        return self.limiter or get_limiter()
+
+    def is_throttled(self):
+        """True se il limiter delle chiamate upstream è in backoff o in una serie di vuoti"""
+        return self._limiter().throttled
+
+
+class YFinanceProvider(FinancialDataProvider):
+    """Provider live su Yahoo Finance; ogni chiamata passa dal limiter condiviso"""
+
+    name = 'yfinance'
+
+    def __init__(self, ticker_factory=None):
+        # ticker_factory permette di sostituire yf.Ticker (es. con un finto Ticker locale)
+        self.ticker_factory = ticker_factory or yf.Ticker
+
+    def get_statements(self, symbol):
+        limiter = self._limiter()
+        stock = self.ticker_factory(symbol)
+        statements = {name: limiter.call(lambda: getattr(stock, name)) for name in STATEMENTS}
+        if all(frame is None or frame.empty for frame in statements.values()):
+            limiter.report_empty()
+        else:
+            limiter.report_success()
+        return statements
+
+    def get_info(self, symbol):
+        limiter = self._limiter()
+        stock = self.ticker_factory(symbol)
+        return limiter.call(lambda: stock.info) or {}
+
+
+class FixtureProvider(FinancialDataProvider):
+    """
+    Riproduce dati registrati su disco (<root>/<SYMBOL>/<prospetto>.csv e info.json)
+    con latenza e tasso di errore configurabili, per misurare l'ingestion offline.
+    """
+
+    name = 'fixture'
+
+    def __init__(self, root='fixtures', latency=0.0, failure_rate=0.0, seed=None):
+        self.root = root
+        self.latency = latency  # secondi, oppure (min, max)
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _simulate_network(self, symbol):
+        with self._lock:
+            if isinstance(self.latency, (tuple, list)):
+                delay = self._random.uniform(*self.latency)
+            else:
+                delay = self.latency
+            failed = self._random.random() < self.failure_rate
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise ProviderError(f"Errore simulato per {symbol}")
+
+    def _symbol_dir(self, symbol):
+        return os.path.join(self.root, symbol)
+
+    def get_statements(self, symbol):
+        statements = {}
+        for name in STATEMENTS:
+            self._simulate_network(symbol)
+            path = os.path.join(self._symbol_dir(symbol), f"{name}.csv")
+            statements[name] = pd.read_csv(path, index_col=0, float_precision='round_trip') if os.path.exists(path) else pd.DataFrame()
+        return statements
+
+    def get_info(self, symbol):
+        self._simulate_network(symbol)
+        path = os.path.join(self._symbol_dir(symbol), 'info.json')
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+
+def record_fixture(symbol, root='fixtures', provider=None):
+    """Salva su disco i dati di `symbol` letti da un altro provider (default Yahoo)"""
+    provider = provider or YFinanceProvider()
+    statements = provider.get_statements(symbol)
+    info = provider.get_info(symbol)
+
+    symbol_dir = os.path.join(root, symbol)
+    os.makedirs(symbol_dir, exist_ok=True)
+    for name, frame in statements.items():
+        if frame is not None and not frame.empty:
+            frame.to_csv(os.path.join(symbol_dir, f"{name}.csv"))
+    with open(os.path.join(symbol_dir, 'info.json'), 'w', encoding='utf-8') as file:
+        json.dump(info, file, ensure_ascii=False, default=str)
+    logger.info(f"Fixture registrata per {symbol} in {symbol_dir}")
+
+
+def provider_from_spec(spec):
+    """'yfinance' oppure 'fixture:<cartella>' (es. da FINANCIAL_DATA_PROVIDER)"""
+    if not spec or spec == 'yfinance':
+        return YFinanceProvider()
+    if spec.startswith('fixture'):
+        _, _, root = spec.partition(':')
+        return FixtureProvider(root or 'fixtures')
+    raise ValueError(f"Provider sconosciuto: {spec}")
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_provider():
+    """Provider di processo usato quando i chiamanti non ne passano uno"""
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            _provider = provider_from_spec(os.environ.get("FINANCIAL_DATA_PROVIDER", "yfinance"))
+        return _provider
+
+
+def set_provider(provider):
+    global _provider
+    with _provider_lock:
+        _provider = provider
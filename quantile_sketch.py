@@ -0,0 +1,154 @@
+import math
+import struct
+
+import numpy as np
+
+# Sketch dei quantili (t-digest "merging"): centroidi (media, peso) ordinati, più
+# fitti sulle code che al centro. Memoria costante rispetto ai valori inseriti e
+# sketch unibili: il merge di due sketch approssima lo sketch dell'unione, quindi
+# gli sketch per exchange si combinano per la vista "All".
+#
+# Formato binario:
+#   header <BHddI: versione, compressione, minimo, massimo, numero centroidi
+#   payload: float64 delle medie + float64 dei pesi
+SKETCH_VERSION = 1
+HEADER = struct.Struct('<BHddI')
+
+# Compressione δ: al più ~δ/2 centroidi dopo la compressione. Finché i centroidi sono
+# meno di δ lo sketch non comprime e i quantili sono esatti (gruppi piccoli).
+DEFAULT_COMPRESSION = 200
+# Valori accumulati prima di comprimere, in multipli di δ
+BUFFER_FACTOR = 5
+
+
+class SketchError(ValueError):
+    """Blob dello sketch non decodificabile"""
+
+
+class QuantileSketch:
+    """
+    t-digest con compressione vettoriale: i centroidi ordinati si raggruppano per
+    unità della funzione di scala k(q) = δ/2π · asin(2q - 1) calcolata sul peso
+    cumulato, con medie pesate via bincount. Quantili e rank percentili si
+    interpolano fra i centri dei centroidi (con minimo e massimo esatti).
+    """
+
+    def __init__(self, compression=DEFAULT_COMPRESSION):
+        self.compression = int(compression)
+        self.min = math.inf
+        self.max = -math.inf
+        self._means = np.empty(0)
+        self._weights = np.empty(0)
+        self._buffer = []
+        self._buffered = 0
+
+    @classmethod
+    def from_values(cls, values, compression=DEFAULT_COMPRESSION):
+        return cls(compression).update(values)
+
+    @property
+    def count(self):
+        return float(self._weights.sum()) + self._buffered
+
+    def __len__(self):
+        return int(self.count)
+
+    def update(self, values):
+        """Aggiunge valori (i non finiti si ignorano)"""
+        values = np.asarray(values, dtype='float64').ravel()
+        values = values[np.isfinite(values)]
+        if len(values):
+            self.min = min(self.min, float(values.min()))
+            self.max = max(self.max, float(values.max()))
+            self._buffer.append(values)
+            self._buffered += len(values)
+            if self._buffered >= BUFFER_FACTOR * self.compression:
+                self._flush()
+        return self
+
+    def merge(self, *others):
+        """Unisce altri sketch in questo (gli altri non cambiano)"""
+        for other in others:
+            other._flush()
+            if not len(other._means):
+                continue
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self._means = np.concatenate([self._means, other._means])
+            self._weights = np.concatenate([self._weights, other._weights])
+        self._flush(force=True)
+        return self
+
+    @classmethod
+    def merge_all(cls, sketches, compression=DEFAULT_COMPRESSION):
+        return cls(compression).merge(*sketches)
+
+    def _flush(self, force=False):
+        if not self._buffer and not force:
+            return
+        means = np.concatenate([self._means] + self._buffer)
+        weights = np.concatenate([self._weights] + [np.ones(len(values)) for values in self._buffer])
+        self._buffer, self._buffered = [], 0
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        if len(means) > self.compression:
+            # Gruppo = unità di k in cui cade il bordo destro di ogni centroide
+            q = np.cumsum(weights) / weights.sum()
+            k = self.compression / (2 * math.pi) * np.arcsin(np.clip(2 * q - 1, -1, 1))
+            groups = np.floor(k)
+            groups = np.concatenate([[0], np.cumsum(groups[1:] != groups[:-1])])
+            merged = np.bincount(groups, weights=weights)
+            means = np.bincount(groups, weights=means * weights) / merged
+            weights = merged
+        self._means, self._weights = means, weights
+
+    def _centers(self):
+        # Posizione (in ranghi, da 0.5 a count-0.5) del centro di ogni centroide
+        self._flush()
+        total = self._weights.sum()
+        centers = np.cumsum(self._weights) - self._weights / 2
+        positions = np.concatenate([[0.5], centers, [total - 0.5]])
+        values = np.concatenate([[self.min], self._means, [self.max]])
+        return positions, values, total
+
+    def quantile(self, q):
+        """Quantile/i q in [0, 1]; interpolazione lineare come pandas sui gruppi esatti"""
+        q = np.asarray(q, dtype='float64')
+        if not self.count:
+            return np.full(q.shape, np.nan) if q.ndim else np.nan
+        positions, values, total = self._centers()
+        result = np.interp(np.clip(q, 0, 1) * (total - 1) + 0.5, positions, values)
+        return result if q.ndim else float(result)
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def rank(self, values):
+        """Rank percentile (0-100) dei valori, stessa convenzione di PercentileIndex"""
+        values = np.asarray(values, dtype='float64')
+        if not self.count:
+            return np.full(values.shape, np.nan)
+        positions, points, total = self._centers()
+        ranks = np.interp(values, points, positions) / total * 100
+        ranks = np.where(values < self.min, 0.0, np.where(values > self.max, 100.0, ranks))
+        return np.where(np.isnan(values), np.nan, ranks)
+
+    def to_bytes(self):
+        self._flush()
+        header = HEADER.pack(SKETCH_VERSION, self.compression, self.min, self.max, len(self._means))
+        return header + self._means.astype('<f8').tobytes() + self._weights.astype('<f8').tobytes()
+
+    @classmethod
+    def from_bytes(cls, blob):
+        if blob is None or len(blob) < HEADER.size:
+            raise SketchError("Blob dello sketch troncato")
+        version, compression, minimum, maximum, size = HEADER.unpack_from(blob)
+        if version != SKETCH_VERSION:
+            raise SketchError(f"Versione sketch {version} non supportata")
+        if len(blob) != HEADER.size + 16 * size:
+            raise SketchError(f"Blob dello sketch di {len(blob)} byte, attesi {HEADER.size + 16 * size}")
+        arrays = np.frombuffer(blob, dtype='<f8', offset=HEADER.size).astype('float64')
+        sketch = cls(compression)
+        sketch.min, sketch.max = minimum, maximum
+        sketch._means, sketch._weights = arrays[:size], arrays[size:]
+        return sketch
@@ -0,0 +1,180 @@
+import os
+import time
+import logging
+import threading
+
+# Logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("rate_limiter")
+
+# Budget di default verso Yahoo Finance (chiamate al minuto)
+DEFAULT_CALLS_PER_MINUTE = float(os.environ.get("UPSTREAM_CALLS_PER_MINUTE", "60"))
+
+# Dopo quante risposte vuote consecutive le trattiamo come throttling "silenzioso"
+EMPTY_RESPONSES_THRESHOLD = 3
+
+
+def is_throttle_error(exc):
+    """True se l'eccezione indica un rate limit lato Yahoo (429 / Too Many Requests)"""
+    if type(exc).__name__ == 'YFRateLimitError':
+        return True
+    message = str(exc).lower()
+    return '429' in message or 'too many requests' in message or 'rate limit' in message
+
+
+class TokenBucket:
+    """
+    Token bucket condiviso (thread-safe) dimensionato in chiamate al minuto,
+    con backoff adattivo: raddoppia quando vede throttling o troppe risposte
+    vuote, e si riduce gradualmente quando le chiamate tornano a riuscire.
+    clock/sleep sono sostituibili (es. un orologio finto nei test).
+    """
+
+    def __init__(self, calls_per_minute=DEFAULT_CALLS_PER_MINUTE, burst=None,
+                 min_backoff=2.0, max_backoff=300.0, recovery_factor=0.5,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.rate = calls_per_minute / 60.0
+        self.capacity = float(burst) if burst else max(1.0, self.rate * 5)
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.recovery_factor = recovery_factor
+
+        self.tokens = self.capacity
+        self.backoff = 0.0
+        self.blocked_until = 0.0
+        self.consecutive_empty = 0
+        self.throttle_events = 0
+
+        self._clock = clock
+        self._sleep = sleep
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+
+    def acquire(self, tokens=1.0):
+        # Attende finché c'è un token disponibile e non siamo in backoff
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._refill(now)
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                else:
+                    wait = (tokens - self.tokens) / self.rate
+            self._sleep(wait)
+
+    def report_throttle(self):
+        with self._lock:
+            self.throttle_events += 1
+            self.backoff = min(self.max_backoff, max(self.min_backoff, self.backoff * 2))
+            self.blocked_until = self._clock() + self.backoff
+            self.tokens = 0.0
+        logger.warning(f"⚠️ Throttling upstream, backoff a {self.backoff:.1f}s")
+
+    def report_empty(self):
+        # Yahoo spesso risponde con frame vuoti invece di un 429 quando è sotto carico
+        with self._lock:
+            self.consecutive_empty += 1
+            throttled = self.consecutive_empty >= EMPTY_RESPONSES_THRESHOLD
+        if throttled:
+            self.report_throttle()
+
+    def report_success(self):
+        with self._lock:
+            self.consecutive_empty = 0
+            if self.backoff:
+                self.backoff *= self.recovery_factor
+                if self.backoff < self.min_backoff:
+                    self.backoff = 0.0
+
+    @property
+    def throttled(self):
+        """True in backoff o durante una serie di risposte vuote: un vuoto ora non è affidabile"""
+        return self.backoff > 0 or self.consecutive_empty >= EMPTY_RESPONSES_THRESHOLD
+
+    def call(self, fn, *args, **kwargs):
+        """Esegue una chiamata upstream consumando un token e registrando il throttling"""
+        self.acquire()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if is_throttle_error(e):
+                self.report_throttle()
+            raise
+
+
+class ShareLimiter(TokenBucket):
+    """
+    Quota esplicita di un limiter padre per un singolo job: ogni chiamata consuma
+    un token della quota e uno del padre, quindi la somma dei job non supera mai
+    il budget del padre. Throttling, risposte vuote e successi arrivano anche al
+    padre: lo stato di backoff è unico per tutto il budget upstream.
+    """
+
+    def __init__(self, parent, fraction):
+        super().__init__(parent.rate * 60 * fraction, clock=parent._clock, sleep=parent._sleep)
+        self.parent = parent
+        self.fraction = fraction
+
+    def acquire(self, tokens=1.0):
+        super().acquire(tokens)
+        self.parent.acquire(tokens)
+
+    def report_throttle(self):
+        super().report_throttle()
+        self.parent.report_throttle()
+
+    def report_empty(self):
+        # I vuoti si contano sul padre, condiviso da tutti i job: se diventano
+        # throttling il padre si blocca e la quota con lui (vedi throttled)
+        self.parent.report_empty()
+
+    def report_success(self):
+        super().report_success()
+        self.parent.report_success()
+
+    @property
+    def throttled(self):
+        return super().throttled or self.parent.throttled
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+_shares = {}
+
+
+def get_limiter():
+    """Limiter di processo usato da tutte le chiamate verso Yahoo"""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = TokenBucket(DEFAULT_CALLS_PER_MINUTE)
+        return _limiter
+
+
+def configure_limiter(calls_per_minute, burst=None):
+    """Sostituisce il limiter di processo (es. per l'ingestion massiva)"""
+    global _limiter
+    with _limiter_lock:
+        _limiter = TokenBucket(calls_per_minute, burst=burst)
+        return _limiter
+
+
+def share_limiter(name, fraction):
+    """
+    Quota `fraction` del limiter di processo riservata al job `name`, stabile fra
+    un'esecuzione e l'altra; si ricrea se il limiter di processo è stato sostituito.
+    """
+    parent = get_limiter()
+    with _limiter_lock:
+        share = _shares.get(name)
+        if share is None or share.parent is not parent or share.fraction != fraction:
+            share = _shares[name] = ShareLimiter(parent, fraction)
+        return share
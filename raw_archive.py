@@ -0,0 +1,189 @@
+import os
+import json
+import logging
+import argparse
+import threading
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from statements import extract_year_block, block_to_records
+
+# Logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("raw_archive")
+
+# Archivio dei prospetti grezzi: <ARCHIVE_ROOT>/<exchange>/<symbol>.parquet
+ARCHIVE_ROOT = os.environ.get("RAW_ARCHIVE_DIR", os.path.join("data", "raw_archive"))
+ARCHIVE_ENABLED = os.environ.get("RAW_ARCHIVE_ENABLED", "1") == "1"
+UNKNOWN_EXCHANGE = "_unknown"
+
+STATEMENTS = ('financials', 'balance_sheet', 'cashflow')
+
+
+def _safe_name(name):
+    return str(name or UNKNOWN_EXCHANGE).replace('/', '_').replace('\\', '_')
+
+
+def archive_path(symbol, stock_exchange=None, root=None):
+    return os.path.join(root or ARCHIVE_ROOT, _safe_name(stock_exchange), f"{_safe_name(symbol)}.parquet")
+
+
+def statements_to_long(statements):
+    """Prospetti larghi (voci x periodi) -> tabella lunga statement/item/period/value"""
+    parts = []
+    for name, frame in statements.items():
+        if frame is None or frame.empty:
+            continue
+        wide = frame.copy()
+        wide.index = wide.index.astype(str)
+        wide.columns = [str(col) for col in wide.columns]
+        long = wide.rename_axis('item').reset_index().melt(id_vars='item', var_name='period', value_name='value')
+        long['statement'] = name
+        parts.append(long)
+    if not parts:
+        return pd.DataFrame({'statement': [], 'item': [], 'period': [], 'value': []})
+    df = pd.concat(parts, ignore_index=True)[['statement', 'item', 'period', 'value']]
+    df['value'] = pd.to_numeric(df['value'], errors='coerce').astype('float64')
+    return df
+
+
+def long_to_statements(df):
+    """Inversa di statements_to_long: ricostruisce i tre prospetti larghi"""
+    statements = {}
+    for name in STATEMENTS:
+        part = df[df['statement'] == name].drop_duplicates(['item', 'period'])
+        if part.empty:
+            statements[name] = pd.DataFrame()
+            continue
+        wide = part.pivot(index='item', columns='period', values='value')
+        wide.columns.name = None
+        wide.index.name = None
+        statements[name] = wide
+    return statements
+
+
+def archive_statements(symbol, stock_exchange, statements, info, root=None):
+    """
+    Salva prospetti grezzi e info di un ticker in Parquet compresso (zstd).
+    Yahoo restituisce solo gli ultimi periodi: il file esistente viene unito al
+    nuovo download per (statement, period), e per un periodo presente in
+    entrambi vince il download più recente.
+    `info` è il payload completo solo quando è stato appena scaricato; con un
+    profilo fresco in DB arrivano solo sector/industry, che aggiornano le info
+    già archiviate senza cancellare gli altri campi.
+    """
+    df = statements_to_long(statements)
+    path = archive_path(symbol, stock_exchange, root)
+    archived_info = {}
+    if os.path.exists(path):
+        existing = pq.read_table(path)
+        archived_info = json.loads((existing.schema.metadata or {}).get(b'info', b'{}').decode('utf-8'))
+        old = existing.to_pandas()
+        fresh_keys = pd.MultiIndex.from_frame(df[['statement', 'period']])
+        kept = old[~pd.MultiIndex.from_frame(old[['statement', 'period']]).isin(fresh_keys)]
+        df = pd.concat([kept, df], ignore_index=True)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'info'] = json.dumps({**archived_info, **(info or {})}, ensure_ascii=False, default=str).encode('utf-8')
+    metadata[b'symbol'] = str(symbol).encode('utf-8')
+    metadata[b'archived_at'] = pd.Timestamp.utcnow().isoformat().encode('utf-8')
+    table = table.replace_schema_metadata(metadata)
+
+    # Scrittura su file temporaneo e rename: un lettore non vede mai un file a metà
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    pq.write_table(table, tmp_path, compression='zstd')
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_archived(symbol, stock_exchange=None, root=None, path=None):
+    """(prospetti, info) archiviati per un ticker, None se non presente"""
+    path = path or archive_path(symbol, stock_exchange, root)
+    if not os.path.exists(path):
+        return None
+    table = pq.read_table(path)
+    metadata = table.schema.metadata or {}
+    info = json.loads(metadata.get(b'info', b'{}').decode('utf-8'))
+    return long_to_statements(table.to_pandas()), info
+
+
+def iter_archive(root=None, exchanges=None):
+    """Itera (exchange, symbol, path) su tutto l'archivio"""
+    root = root or ARCHIVE_ROOT
+    if not os.path.isdir(root):
+        return
+    for exchange_dir in sorted(os.listdir(root)):
+        if exchanges and exchange_dir not in {_safe_name(e) for e in exchanges}:
+            continue
+        full_dir = os.path.join(root, exchange_dir)
+        if not os.path.isdir(full_dir):
+            continue
+        for file_name in sorted(os.listdir(full_dir)):
+            if file_name.endswith('.parquet'):
+                yield exchange_dir, file_name[:-len('.parquet')], os.path.join(full_dir, file_name)
+
+
+def derive_records(symbol, statements, info, years, description=None, stock_exchange=None):
+    """Record della cache ricavati dai prospetti archiviati, senza chiamate upstream"""
+    found_years, block = extract_year_block(
+        statements['financials'], statements['balance_sheet'], statements['cashflow'], years
+    )
+    return block_to_records(
+        symbol, found_years, block,
+        sector=info.get('sector', 'N/A'),
+        industry=info.get('industry', 'N/A'),
+        description=description,
+        stock_exchange=stock_exchange
+    )
+
+
+def rederive(years, exchanges=None, root=None, batch_size=2000):
+    """Ricostruisce i record di FinancialCache dall'archivio, a velocità di disco locale"""
+    from cache_db import upsert_financials
+    from data_utils import read_exchanges, read_companies
+
+    # Descrizioni dai file aziende, come nell'ingestion
+    descriptions = {}
+    for exchange_name, companies_file in read_exchanges('exchanges.txt').items():
+        for company in read_companies(companies_file):
+            descriptions[(_safe_name(exchange_name), company['ticker'])] = (exchange_name, company['description'])
+
+    count_symbols = 0
+    count_records = 0
+    pending = []
+    for exchange_dir, symbol, path in iter_archive(root, exchanges):
+        stock_exchange, description = descriptions.get((exchange_dir, symbol), (exchange_dir, None))
+        archived = load_archived(symbol, path=path)
+        if archived is None:
+            continue
+        statements, info = archived
+        records = derive_records(symbol, statements, info, years, description=description, stock_exchange=stock_exchange)
+        pending.extend(records)
+        count_records += len(records)
+        count_symbols += 1
+        # Scrittura a blocchi: un upsert ogni `batch_size` record
+        if len(pending) >= batch_size:
+            upsert_financials(pending)
+            pending = []
+    if pending:
+        upsert_financials(pending)
+
+    logger.info(f"✅ Ricostruiti {count_records} record da {count_symbols} ticker archiviati")
+    return count_symbols, count_records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Archivio dei prospetti grezzi")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    rederive_parser = subparsers.add_parser('rederive', help="Ricostruisce FinancialCache dall'archivio")
+    rederive_parser.add_argument('--exchange', action='append', help="Nome exchange (ripetibile), default tutti")
+    rederive_parser.add_argument('--years', type=int, nargs='+', default=[2021, 2022, 2023, 2024])
+    rederive_parser.add_argument('--root', default=None)
+    args = parser.parse_args()
+
+    if args.command == 'rederive':
+        rederive(args.years, exchanges=args.exchange, root=args.root)
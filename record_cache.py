@@ -0,0 +1,125 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+# Dimensione e durata della cache in memoria condivisa dalle pagine dello stesso processo
+RECORD_CACHE_SIZE = int(os.environ.get("RECORD_CACHE_SIZE", "50000"))
+RECORD_CACHE_TTL_SECONDS = float(os.environ.get("RECORD_CACHE_TTL_SECONDS", "600"))
+
+_MISSING = object()
+
+
+class FrozenRecord(dict):
+    """
+    Record condiviso in sola lettura: resta un dict (isinstance, pandas, json)
+    ma ogni modifica solleva TypeError. Chi deve modificarlo ne fa una copia
+    con dict(record); copy/deepcopy/pickle restituiscono un dict normale.
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Record in cache in sola lettura: copiarlo con dict() prima di modificarlo")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    update = pop = popitem = clear = setdefault = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return dict(self)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+def freeze(record):
+    if record is None or isinstance(record, FrozenRecord):
+        return record
+    return FrozenRecord(record)
+
+
+class RecordCache:
+    """
+    Cache LRU con scadenza (TTL) davanti ai loader di cache_db, chiave (symbol, year).
+    Thread-safe; salva anche i "non trovato" (valore None) finché una scrittura
+    sulla stessa chiave non li invalida.
+    Chi legge dal DB prende prima un token(key) e lo passa a put: se nel frattempo
+    la chiave è stata invalidata, il valore letto è vecchio e non entra in cache.
+    """
+
+    def __init__(self, maxsize=RECORD_CACHE_SIZE, ttl_seconds=RECORD_CACHE_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # Generazione per chiave invalidata; l'epoca cambia con clear() (e azzera il dict)
+        self._epoch = 0
+        self._generations = {}
+
+    def token(self, key):
+        """Versione corrente della chiave, da passare a put dopo la lettura dal DB"""
+        with self._lock:
+            return (self._epoch, self._generations.get(key, 0))
+
+    def get(self, key):
+        """Valore in cache oppure il sentinella _MISSING (None è un valore valido)"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return _MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, token=None):
+        expires_at = time.monotonic() + self.ttl_seconds
+        with self._lock:
+            if token is not None and token != (self._epoch, self._generations.get(key, 0)):
+                return False
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, keys):
+        with self._lock:
+            for key in keys:
+                self._generations[key] = self._generations.get(key, 0) + 1
+                if self._data.pop(key, None) is not None:
+                    self.invalidations += 1
+            if len(self._generations) > self.maxsize:
+                # Nuova epoca: i token in volo diventano tutti vecchi, il dict resta limitato
+                self._epoch += 1
+                self._generations.clear()
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+            self._epoch += 1
+            self._generations.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
@@ -0,0 +1,210 @@
+import json
+import math
+import time
+import zlib
+import struct
+import argparse
+
+import numpy as np
+
+from statements import FIELD_NAMES
+from kpi_registry import KPI_NAMES
+
+# zstd è opzionale: senza il pacchetto zstandard si usa zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Formato binario dei record numerici:
+#   header <BBBH: versione codec, id schema, compressione, numero campi
+#   payload: bitmap dei valori presenti (1 bit per campo) + float64 dei soli presenti
+# Il payload può essere compresso (zlib/zstd). I campi seguono l'ordine fisso dello schema.
+CODEC_VERSION = 1
+HEADER = struct.Struct('<BBBH')
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+COMPRESSIONS = {'none': COMPRESSION_NONE, 'zlib': COMPRESSION_ZLIB, 'zstd': COMPRESSION_ZSTD}
+
+# Schemi registrati: l'id finisce nell'header, quindi non si riusano mai
+SCHEMA_FINANCIALS = 1
+SCHEMA_KPIS = 2
+
+# Campi dello schema KPI, fissati qui e non derivati dal registro: la posizione di un
+# nome è il suo bit nei blob già salvati. Solo aggiunte in coda, mai riordinare o togliere;
+# per un ordine diverso serve un nuovo id di schema.
+KPI_SCHEMA_FIELDS = [
+    'Gross Margin', 'Operating Margin', 'Net Margin', 'EBITDA Margin', 'ROA', 'ROE', 'ROIC', 'Debt/Equity',
+    'Tax Rate', 'SG&A/Revenue', 'R&D/Revenue', 'FCF Margin', 'Working Capital/Revenue', 'Asset Turnover',
+    'Equity Ratio', 'Interest Coverage', 'EPS', 'Total Revenue YoY', 'Total Revenue CAGR 3Y',
+    'Gross Profit YoY', 'Gross Profit CAGR 3Y', 'Operating Income YoY', 'Operating Income CAGR 3Y',
+    'EBITDA YoY', 'EBITDA CAGR 3Y', 'EBIT YoY', 'EBIT CAGR 3Y', 'Net Income YoY', 'Net Income CAGR 3Y',
+    'Free Cash Flow YoY', 'Free Cash Flow CAGR 3Y', 'Basic EPS YoY', 'Basic EPS CAGR 3Y', 'Total Assets YoY',
+    'Total Assets CAGR 3Y', 'Stockholders Equity YoY', 'Stockholders Equity CAGR 3Y', 'Total Debt YoY',
+    'Total Debt CAGR 3Y', 'Working Capital YoY', 'Working Capital CAGR 3Y', 'Gross Margin Delta',
+    'Gross Margin Volatility 3Y', 'Operating Margin Delta', 'Operating Margin Volatility 3Y',
+    'Net Margin Delta', 'Net Margin Volatility 3Y', 'EBITDA Margin Delta', 'EBITDA Margin Volatility 3Y',
+    'ROA Delta', 'ROA Volatility 3Y', 'ROE Delta', 'ROE Volatility 3Y', 'ROIC Delta', 'ROIC Volatility 3Y',
+    'Tax Rate Delta', 'Tax Rate Volatility 3Y', 'SG&A/Revenue Delta', 'SG&A/Revenue Volatility 3Y',
+    'R&D/Revenue Delta', 'R&D/Revenue Volatility 3Y', 'FCF Margin Delta', 'FCF Margin Volatility 3Y',
+    'Working Capital/Revenue Delta', 'Working Capital/Revenue Volatility 3Y', 'Equity Ratio Delta',
+    'Equity Ratio Volatility 3Y',
+]
+
+SCHEMAS = {
+    SCHEMA_FINANCIALS: FIELD_NAMES,
+    SCHEMA_KPIS: KPI_SCHEMA_FIELDS,
+}
+
+
+class CodecError(ValueError):
+    """Blob non decodificabile (versione, schema o compressione sconosciuti)"""
+
+
+# Ogni KPI del registro deve avere un posto nello schema (un KPI tolto dal registro lo conserva)
+_unmapped = [name for name in KPI_NAMES if name not in KPI_SCHEMA_FIELDS]
+if _unmapped or len(set(KPI_SCHEMA_FIELDS)) != len(KPI_SCHEMA_FIELDS):
+    raise RuntimeError(
+        f"Schema KPI del codec non allineato al registro: aggiungere in coda a KPI_SCHEMA_FIELDS {_unmapped}"
+    )
+
+
+def _compress(payload, compression):
+    if compression == COMPRESSION_ZLIB:
+        return zlib.compress(payload, 6)
+    if compression == COMPRESSION_ZSTD:
+        return zstandard.ZstdCompressor(level=3).compress(payload)
+    return payload
+
+
+def _decompress(payload, compression):
+    if compression == COMPRESSION_NONE:
+        return payload
+    if compression == COMPRESSION_ZLIB:
+        return zlib.decompress(payload)
+    if compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise CodecError("Blob compresso con zstd ma il pacchetto zstandard non è installato")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    raise CodecError(f"Compressione sconosciuta: {compression}")
+
+
+def compression_id(name):
+    """'none' / 'zlib' / 'zstd' -> id; zstd ricade su zlib se non disponibile"""
+    if name not in COMPRESSIONS:
+        raise ValueError(f"Compressione sconosciuta: {name}")
+    if name == 'zstd' and zstandard is None:
+        return COMPRESSION_ZLIB
+    return COMPRESSIONS[name]
+
+
+def encodable(record, schema_id):
+    """True se il record ha solo campi dello schema (più eventuali chiavi escluse dal chiamante)"""
+    fields = set(SCHEMAS[schema_id])
+    return all(key in fields for key in record)
+
+
+_value_structs = {}
+
+
+def _values_struct(count):
+    # struct precompilati per numero di valori presenti (record piccoli: più veloce di NumPy)
+    packer = _value_structs.get(count)
+    if packer is None:
+        packer = _value_structs[count] = struct.Struct(f'<{count}d')
+    return packer
+
+
+def encode(record, schema_id, compression='zlib'):
+    """Record dict -> bytes. Campi assenti, None, NaN e inf sono 'mancanti' nella bitmap."""
+    fields = SCHEMAS[schema_id]
+    bits = 0
+    values = []
+    for i, field in enumerate(fields):
+        value = record.get(field)
+        if value is None:
+            continue
+        value = float(value)
+        if math.isfinite(value):
+            bits |= 1 << i
+            values.append(value)
+    payload = bits.to_bytes((len(fields) + 7) // 8, 'little') + _values_struct(len(values)).pack(*values)
+    compression = compression_id(compression) if isinstance(compression, str) else compression
+    header = HEADER.pack(CODEC_VERSION, schema_id, compression, len(fields))
+    return header + _compress(payload, compression)
+
+
+def decode(blob):
+    """bytes -> record dict con tutti i campi dello schema (None dove mancanti)"""
+    blob = bytes(blob)
+    version, schema_id, compression, n_fields = HEADER.unpack_from(blob)
+    if version != CODEC_VERSION:
+        raise CodecError(f"Versione del codec non supportata: {version}")
+    if schema_id not in SCHEMAS:
+        raise CodecError(f"Schema sconosciuto: {schema_id}")
+    fields = SCHEMAS[schema_id]
+    # Blob scritti con uno schema più corto: i campi aggiunti dopo risultano mancanti
+    if n_fields > len(fields):
+        raise CodecError(f"Blob con {n_fields} campi, schema {schema_id} ne ha {len(fields)}")
+
+    payload = _decompress(blob[HEADER.size:], compression)
+    bitmap_size = (n_fields + 7) // 8
+    bits = int.from_bytes(payload[:bitmap_size], 'little')
+    count = bin(bits).count('1')
+    if len(payload) != bitmap_size + 8 * count:
+        raise CodecError("Payload incoerente con la bitmap")
+    values = iter(_values_struct(count).unpack_from(payload, bitmap_size))
+
+    record = dict.fromkeys(fields)
+    for i in range(n_fields):
+        if bits >> i & 1:
+            record[fields[i]] = next(values)
+    return record
+
+
+def benchmark(records, schema_id, repeat=3):
+    """Dimensione media e tempo di decodifica per record: JSON contro codec binario"""
+    results = []
+    json_blobs = [json.dumps(r, ensure_ascii=False, allow_nan=False).encode('utf-8') for r in records]
+    candidates = [('json', json_blobs, lambda b: json.loads(b))]
+    for name in ('none', 'zlib', 'zstd'):
+        if name == 'zstd' and zstandard is None:
+            continue
+        blobs = [encode(r, schema_id, compression=name) for r in records]
+        candidates.append((f"binary+{name}", blobs, decode))
+
+    for name, blobs, decoder in candidates:
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for blob in blobs:
+                decoder(blob)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        results.append({
+            'format': name,
+            'avg_bytes': round(sum(len(b) for b in blobs) / len(blobs), 1),
+            'decode_us_per_record': round(best / len(blobs) * 1e6, 2),
+        })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark del codec binario contro JSON")
+    parser.add_argument('--records', type=int, default=5000, help="Numero di record sintetici")
+    parser.add_argument('--missing', type=float, default=0.2, help="Quota di valori mancanti")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for label, schema_id in (('financials', SCHEMA_FINANCIALS), ('kpis', SCHEMA_KPIS)):
+        fields = SCHEMAS[schema_id]
+        sample = []
+        for _ in range(args.records):
+            values = rng.normal(0, 50, len(fields))
+            values[rng.random(len(fields)) < args.missing] = np.nan
+            sample.append({f: (None if np.isnan(v) else float(v)) for f, v in zip(fields, values)})
+        print(f"--- {label} ({len(fields)} campi, {args.records} record) ---")
+        for row in benchmark(sample, schema_id):
+            print(f"{row['format']:<14} {row['avg_bytes']:>9} byte  {row['decode_us_per_record']:>8} µs/record")
@@ -0,0 +1,151 @@
+import os
+import math
+import logging
+import datetime
+
+import pandas as pd
+from apscheduler.schedulers.blocking import BlockingScheduler
+
+from cache_db import track_changes, create_tables, load_refresh_candidates, stale_profile_symbols, backfill_profiles_from_cache
+from data_utils import fetch_profile
+from providers import get_provider
+from rate_limiter import configure_limiter, share_limiter
+from ingestion import build_jobs, run_bulk_ingestion, DEFAULT_YEARS
+from kpi_materialize import materialize_kpis
+from kpi_aggregates import refresh_aggregates, refresh_missing_aggregates
+from snapshot import export_snapshot, ensure_snapshot
+
+# Logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("scheduler")
+
+# Budget orario complessivo di chiamate verso Yahoo dello scheduler: un solo limiter di
+# processo, di cui ogni job ha una quota esplicita (refresh dei prospetti e dei profili)
+CALLS_PER_HOUR = int(os.environ.get("SCHEDULER_CALLS_PER_HOUR", "600"))
+PROFILES_SHARE = float(os.environ.get("SCHEDULER_PROFILES_SHARE", "0.2"))
+REFRESH_SHARE = 1.0 - PROFILES_SHARE
+# Sotto questa età un ticker non viene riscaricato
+MIN_AGE_DAYS = float(os.environ.get("SCHEDULER_MIN_AGE_DAYS", "7"))
+# Età assegnata ai ticker mai scaricati (o senza fetched_at)
+NEVER_FETCHED_AGE_DAYS = 365.0
+# Profili societari (una chiamata info ciascuno) aggiornati ogni giorno
+PROFILES_PER_DAY = int(os.environ.get("SCHEDULER_PROFILES_PER_DAY", "500"))
+
+
+def prioritize(jobs, candidates, now=None, min_age_days=MIN_AGE_DAYS):
+    """
+    Ordina i ticker dell'universo per priorità di refresh:
+    età del dato più vecchio pesata per la domanda delle pagine.
+    """
+    now = now or datetime.datetime.utcnow()
+    universe = pd.DataFrame(jobs)
+    if universe.empty:
+        return universe
+
+    df = pd.merge(universe, candidates, on='symbol', how='left')
+    age = (now - pd.to_datetime(df['fetched_at'])).dt.total_seconds() / 86400
+    df['age_days'] = age.fillna(NEVER_FETCHED_AGE_DAYS)
+    df['request_count'] = df['request_count'].fillna(0)
+
+    df = df[df['age_days'] >= min_age_days].copy()
+    df['priority'] = df['age_days'] * (1 + df['request_count'].map(math.log1p))
+    return df.sort_values('priority', ascending=False)
+
+
+def select_within_budget(ranked, provider, budget):
+    """
+    Primi ticker per priorità le cui chiamate stanno nel budget. Le chiamate per ticker
+    vengono dal piano del provider: info solo se il profilo non è fresco (load_profile).
+    """
+    if ranked.empty:
+        return ranked
+    need_info = set(stale_profile_symbols(ranked['symbol'].tolist()))
+    calls = ranked['symbol'].map(lambda symbol: provider.calls_per_fetch(symbol in need_info))
+    return ranked[calls.cumsum() <= budget]
+
+
+def refresh_stalest(calls_per_hour=CALLS_PER_HOUR, years=DEFAULT_YEARS):
+    """Riscarica i ticker più vecchi/richiesti entro la quota oraria del job"""
+    jobs = build_jobs('exchanges.txt')
+    ranked = prioritize(jobs, load_refresh_candidates())
+    budget = int(calls_per_hour * REFRESH_SHARE)
+    provider = get_provider().with_limiter(share_limiter('refresh_stalest', REFRESH_SHARE))
+    selected = select_within_budget(ranked, provider, budget)
+    if selected.empty:
+        logger.info("Nessun ticker da aggiornare in questo giro")
+        return None
+
+    logger.info(f"Refresh di {len(selected)} ticker (quota {budget}/{calls_per_hour} chiamate/ora)")
+    selected_jobs = selected[['symbol', 'description', 'stock_exchange']].to_dict('records')
+    # Il budget viene distribuito sull'ora dalla quota del job nel limiter di processo
+    _, stats = run_bulk_ingestion(
+        selected_jobs, years,
+        max_workers=4,
+        force_refresh=True,
+        provider=provider,
+        progress_every=50
+    )
+    # KPI e aggregati ricalcolati solo per i record cambiati; snapshot rigenerato solo se serve
+    with track_changes() as changes:
+        materialize_kpis(keys=stats.changed_keys)
+    refresh_aggregates(keys=stats.changed_keys)
+    if stats.changed_keys or changes['kpis']:
+        export_snapshot()
+    return stats.summary()
+
+
+def refresh_stale_profiles(limit=PROFILES_PER_DAY):
+    """Aggiorna i profili sector/industry più vecchi, indipendentemente dai prospetti"""
+    jobs = build_jobs('exchanges.txt')
+    exchange_by_symbol = {job['symbol']: job['stock_exchange'] for job in jobs}
+    symbols = stale_profile_symbols(list(exchange_by_symbol))[:limit]
+    # Quota propria del limiter di processo: non si somma al budget dei refresh
+    provider = get_provider().with_limiter(share_limiter('refresh_stale_profiles', PROFILES_SHARE))
+    refreshed = 0
+    for symbol in symbols:
+        try:
+            fetch_profile(symbol, stock_exchange=exchange_by_symbol[symbol], provider=provider)
+            refreshed += 1
+        except Exception as e:
+            logger.error(f"Errore aggiornamento profilo {symbol}: {e}")
+    logger.info(f"Profili aggiornati: {refreshed}/{len(symbols)}")
+    return refreshed
+
+
+def main():
+    create_tables()
+    # Limiter unico dello scheduler, configurato una volta: i job ne usano una quota
+    configure_limiter(CALLS_PER_HOUR / 60)
+    backfill_profiles_from_cache()
+    scheduler = BlockingScheduler(timezone="UTC")
+    scheduler.add_job(
+        refresh_stale_profiles, 'interval', days=1,
+        id='refresh_stale_profiles',
+        max_instances=1, coalesce=True
+    )
+    # Snapshot letto dalle pagine: rigenerato qui quando è vecchio, mai durante una richiesta
+    scheduler.add_job(
+        ensure_snapshot, 'interval', minutes=30,
+        id='ensure_snapshot',
+        max_instances=1, coalesce=True,
+        next_run_time=datetime.datetime.utcnow()
+    )
+    # Benchmark di settore per exchange/anni mai aggregati: le pagine non li calcolano
+    scheduler.add_job(
+        refresh_missing_aggregates, 'interval', hours=1,
+        id='refresh_missing_aggregates',
+        max_instances=1, coalesce=True,
+        next_run_time=datetime.datetime.utcnow()
+    )
+    scheduler.add_job(
+        refresh_stalest, 'interval', hours=1,
+        id='refresh_stalest',
+        max_instances=1, coalesce=True,
+        next_run_time=datetime.datetime.utcnow()
+    )
+    logger.info("⏰ Scheduler di refresh avviato")
+    scheduler.start()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import os
+import copy
+import time
+import socket
+import logging
+import threading
+
+from cache_db import try_acquire_fetch_lock, release_fetch_lock, fetch_lock_held
+
+# Logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("singleflight")
+
+# Lock su DB tra processi diversi (più worker Streamlit / scheduler)
+DB_LOCK_ENABLED = os.environ.get("SINGLEFLIGHT_DB_LOCK", "0") == "1"
+DB_LOCK_TTL_SECONDS = 300
+DB_LOCK_WAIT_SECONDS = 120
+DB_LOCK_POLL_SECONDS = 0.5
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalescenza delle chiamate nello stesso processo: chi chiede una chiave
+    già in corso aspetta la chiamata in volo e ne condivide il risultato.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            # Copia: i chiamanti modificano i record (description, stock_exchange)
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+def _owner_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def run_with_db_lock(key, fn, on_released, ttl_seconds=DB_LOCK_TTL_SECONDS, wait_seconds=DB_LOCK_WAIT_SECONDS):
+    """
+    Variante tra processi basata su una riga di lock nel DB.
+    Chi ottiene il lock esegue fn(); gli altri aspettano che venga rilasciato
+    e poi chiamano on_released() (tipicamente rilettura dal DB).
+    """
+    owner = _owner_id()
+    deadline = time.monotonic() + wait_seconds
+    while True:
+        if try_acquire_fetch_lock(key, owner, ttl_seconds=ttl_seconds):
+            try:
+                return fn()
+            finally:
+                release_fetch_lock(key, owner)
+
+        logger.info(f"Download di {key} già in corso in un altro processo, attendo")
+        while fetch_lock_held(key):
+            if time.monotonic() > deadline:
+                logger.warning(f"Timeout in attesa del lock {key}, procedo comunque")
+                return fn()
+            time.sleep(DB_LOCK_POLL_SECONDS)
+        return on_released()
@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import datetime
+import threading
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from cache_db import load_frame, load_all_kpis, FINANCIAL_COLUMNS
+
+# Logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("snapshot")
+
+# Snapshot colonnare del dataset: <SNAPSHOT_ROOT>/<versione>/{financials,kpis}[.arrow]
+SNAPSHOT_ROOT = os.environ.get("SNAPSHOT_DIR", os.path.join("data", "snapshot"))
+# Le pagine leggono dallo snapshot se attivo; oltre questa età leggono dal DB finché
+# il job dello scheduler (ensure_snapshot) non lo rigenera
+SNAPSHOT_READS = os.environ.get("SNAPSHOT_READS", "1") == "1"
+SNAPSHOT_MAX_AGE_SECONDS = float(os.environ.get("SNAPSHOT_MAX_AGE_SECONDS", str(6 * 3600)))
+# Versioni precedenti conservate (un lettore può ancora avere mappata la vecchia)
+SNAPSHOT_KEEP = 2
+
+TABLES = ('financials', 'kpis')
+PARTITION_COLUMNS = ['stock_exchange', 'year']
+UNKNOWN_EXCHANGE = "_unknown"
+LATEST_FILE = 'LATEST'
+MANIFEST_FILE = 'manifest.json'
+
+
+class SnapshotUnavailable(Exception):
+    """Snapshot assente o troppo vecchio: il chiamante ripiega sul DB"""
+
+
+def _kpi_frame():
+    # KPICache non ha exchange/settore: li prendiamo dalle righe di FinancialCache
+    kpis = load_all_kpis()
+    if kpis.empty:
+        return kpis
+    meta = load_frame(columns=['symbol', 'year', 'sector', 'industry', 'stock_exchange'])
+    meta = meta.drop_duplicates(subset=['symbol', 'year'])
+    kpis = kpis.drop(columns=['sector', 'industry', 'stock_exchange'], errors='ignore')
+    return kpis.merge(meta, on=['symbol', 'year'], how='left')
+
+
+def _to_table(df):
+    df = df.copy()
+    df['stock_exchange'] = df['stock_exchange'].fillna(UNKNOWN_EXCHANGE)
+    df['year'] = df['year'].astype('int32')
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def _write_table(table, version_dir, name):
+    # Parquet partizionato per exchange/anno (zstd) + file Arrow IPC non compresso,
+    # che si può mappare in memoria senza copie né decompressione
+    pq.write_to_dataset(
+        table, os.path.join(version_dir, name),
+        partition_cols=PARTITION_COLUMNS, compression='zstd'
+    )
+    with pa.OSFile(os.path.join(version_dir, f"{name}.arrow"), 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def _prune(root, keep=SNAPSHOT_KEEP):
+    versions = sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)) and not d.startswith('.'))
+    for old in versions[:-keep]:
+        shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+
+
+def export_snapshot(root=None):
+    """Esporta FinancialCache e KPICache in una nuova versione dello snapshot e la pubblica"""
+    root = root or SNAPSHOT_ROOT
+    started = time.monotonic()
+    version = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    tmp_dir = os.path.join(root, f".{version}")
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    frames = {'financials': load_frame(), 'kpis': _kpi_frame()}
+    manifest = {'version': version, 'created_at': datetime.datetime.utcnow().isoformat(), 'rows': {}}
+    for name, df in frames.items():
+        if df.empty:
+            df = pd.DataFrame(columns=FINANCIAL_COLUMNS if name == 'financials' else ['symbol', 'year', 'stock_exchange'])
+        _write_table(_to_table(df), tmp_dir, name)
+        manifest['rows'][name] = len(df)
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w', encoding='utf-8') as file:
+        json.dump(manifest, file)
+
+    # Pubblicazione atomica: rename della cartella, poi del puntatore LATEST
+    os.replace(tmp_dir, os.path.join(root, version))
+    pointer_tmp = os.path.join(root, f".{LATEST_FILE}.tmp")
+    with open(pointer_tmp, 'w', encoding='utf-8') as file:
+        file.write(version)
+    os.replace(pointer_tmp, os.path.join(root, LATEST_FILE))
+    _prune(root)
+
+    logger.info(
+        f"✅ Snapshot {version}: {manifest['rows']['financials']} righe finanziarie, "
+        f"{manifest['rows']['kpis']} righe KPI in {time.monotonic() - started:.2f}s"
+    )
+    return os.path.join(root, version)
+
+
+def latest_snapshot(root=None):
+    """(cartella, età in secondi) dell'ultimo snapshot pubblicato, None se assente"""
+    root = root or SNAPSHOT_ROOT
+    pointer = os.path.join(root, LATEST_FILE)
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer, 'r', encoding='utf-8') as file:
+        version_dir = os.path.join(root, file.read().strip())
+    if not os.path.isdir(version_dir):
+        return None
+    return version_dir, time.time() - os.path.getmtime(pointer)
+
+
+def ensure_snapshot(root=None, max_age_seconds=SNAPSHOT_MAX_AGE_SECONDS):
+    """Rigenera lo snapshot se manca o è più vecchio di `max_age_seconds` (job periodico)"""
+    latest = latest_snapshot(root)
+    if latest is None or (max_age_seconds is not None and latest[1] > max_age_seconds):
+        return export_snapshot(root)
+    return latest[0]
+
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def snapshot_table(name, root=None, max_age_seconds=SNAPSHOT_MAX_AGE_SECONDS):
+    """
+    Tabella Arrow mappata in memoria dall'ultimo snapshot (zero-copy, condivisa
+    nel processo). Se manca o è più vecchio di `max_age_seconds` solleva
+    SnapshotUnavailable: la rigenerazione spetta allo scheduler, non alle pagine.
+    """
+    if name not in TABLES:
+        raise ValueError(f"Tabella di snapshot sconosciuta: {name}")
+    with _tables_lock:
+        latest = latest_snapshot(root)
+        if latest is None:
+            raise SnapshotUnavailable("Nessuno snapshot pubblicato")
+        if max_age_seconds is not None and latest[1] > max_age_seconds:
+            raise SnapshotUnavailable(f"Snapshot vecchio di {latest[1]:.0f}s (massimo {max_age_seconds:.0f}s)")
+        version_dir = latest[0]
+        key = (version_dir, name)
+        if key not in _tables:
+            source = pa.memory_map(os.path.join(version_dir, f"{name}.arrow"), 'r')
+            _tables[key] = pa.ipc.open_file(source).read_all()
+            # Le versioni precedenti non servono più a questo processo
+            for old_key in [k for k in _tables if k[1] == name and k != key]:
+                del _tables[old_key]
+        return _tables[key]
+
+
+def snapshot_frame(name, symbols=None, years=None, stock_exchanges=None, columns=None, root=None):
+    """DataFrame filtrato dallo snapshot: i filtri lavorano sulla tabella Arrow prima della conversione"""
+    table = snapshot_table(name, root=root)
+    mask = None
+    for column, values in (('symbol', symbols), ('year', years), ('stock_exchange', stock_exchanges)):
+        if values is None:
+            continue
+        if column == 'year':
+            values = [int(v) for v in values]
+        condition = pc.is_in(table[column], value_set=pa.array(list(values), type=table.schema.field(column).type))
+        mask = condition if mask is None else pc.and_(mask, condition)
+    if mask is not None:
+        table = table.filter(mask)
+    if columns is not None:
+        table = table.select([c for c in columns if c in table.column_names])
+    df = table.to_pandas()
+    if 'stock_exchange' in df.columns:
+        df['stock_exchange'] = df['stock_exchange'].replace(UNKNOWN_EXCHANGE, None)
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Snapshot Parquet/Arrow del dataset")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help="Esporta FinancialCache e KPICache")
+    export_parser.add_argument('--root', default=None)
+    export_parser.add_argument('--if-stale', action='store_true', help="Solo se manca o è più vecchio di SNAPSHOT_MAX_AGE_SECONDS")
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        print(ensure_snapshot(root=args.root) if args.if_stale else export_snapshot(root=args.root))
@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+
+BILLIONS = 1e-9
+UNITS = 1.0
+
+# Mappa dichiarativa: chiave del record -> (prospetto, voce Yahoo, scala)
+# L'ordine è quello dei record salvati in cache.
+FIELD_MAP = [
+    ('total_revenue', 'financials', 'Total Revenue', BILLIONS),
+    ('operating_revenue', 'financials', 'Operating Revenue', BILLIONS),
+    ('cost_of_revenue', 'financials', 'Cost Of Revenue', BILLIONS),
+    ('gross_profit', 'financials', 'Gross Profit', BILLIONS),
+    ('operating_expense', 'financials', 'Operating Expense', BILLIONS),
+    ('sg_and_a', 'financials', 'Selling General And Administration', BILLIONS),
+    ('r_and_d', 'financials', 'Research And Development', BILLIONS),
+    ('operating_income', 'financials', 'Operating Income', BILLIONS),
+    ('net_non_operating_interest_income_expense', 'financials', 'Net Non Operating Interest Income Expense', BILLIONS),
+    ('interest_expense_non_operating', 'financials', 'Interest Expense Non Operating', BILLIONS),
+    ('pretax_income', 'financials', 'Pretax Income', BILLIONS),
+    ('tax_provision', 'financials', 'Tax Provision', BILLIONS),
+    ('net_income_common_stockholders', 'financials', 'Net Income Common Stockholders', BILLIONS),
+    ('net_income', 'financials', 'Net Income', BILLIONS),
+    ('net_income_continuous_operations', 'financials', 'Net Income Continuous Operations', BILLIONS),
+    ('basic_eps', 'financials', 'Basic EPS', UNITS),
+    ('diluted_eps', 'financials', 'Diluted EPS', UNITS),
+    ('basic_average_shares', 'financials', 'Basic Average Shares', BILLIONS),
+    ('diluted_average_shares', 'financials', 'Diluted Average Shares', BILLIONS),
+    ('total_expenses', 'financials', 'Total Expenses', BILLIONS),
+    ('normalized_income', 'financials', 'Normalized Income', BILLIONS),
+    ('interest_expense', 'financials', 'Interest Expense', BILLIONS),
+    ('net_interest_income', 'financials', 'Net Interest Income', BILLIONS),
+    ('ebit', 'financials', 'EBIT', BILLIONS),
+    ('ebitda', 'financials', 'EBITDA', BILLIONS),
+    ('reconciled_depreciation', 'financials', 'Reconciled Depreciation', BILLIONS),
+    ('normalized_ebitda', 'financials', 'Normalized EBITDA', BILLIONS),
+    ('total_assets', 'balance_sheet', 'Total Assets', BILLIONS),
+    ('stockholders_equity', 'balance_sheet', 'Stockholders Equity', BILLIONS),
+    ('free_cash_flow', 'cashflow', 'Free Cash Flow', BILLIONS),
+    ('changes_in_cash', 'cashflow', 'Changes In Cash', BILLIONS),
+    ('working_capital', 'balance_sheet', 'Working Capital', BILLIONS),
+    ('invested_capital', 'balance_sheet', 'Invested Capital', BILLIONS),
+    ('total_debt', 'balance_sheet', 'Total Debt', BILLIONS),
+]
+
+FIELD_NAMES = [field[0] for field in FIELD_MAP]
+FIELD_SCALES = np.array([field[3] for field in FIELD_MAP], dtype=float)
+
+# Voci mancanti in un prospetto restano mancanti (NaN, None nei record): non più 0,
+# che non si distingueva da uno zero vero
+MISSING_VALUE = np.nan
+
+
+def statement_years(frame):
+    """Anni delle colonne di un prospetto, parsati in un colpo solo (NaN se non date)"""
+    if frame is None or frame.empty:
+        return pd.Index([], dtype=float)
+    return pd.Index(pd.to_datetime(pd.Index(frame.columns), errors='coerce').year)
+
+
+def _frame_by_year(frame):
+    # Colonne rinominate con l'anno; in caso di doppioni teniamo la prima colonna
+    years = statement_years(frame)
+    valid = ~years.isna()
+    frame = frame.loc[:, np.asarray(valid)]
+    frame.columns = years[valid].astype(int)
+    frame = frame.loc[~frame.index.duplicated(), ~frame.columns.duplicated()]
+    return frame
+
+
+def extract_year_block(financials, balance_sheet, cashflow, years):
+    """
+    Estrae tutti gli anni richiesti in un unico blocco NumPy (anni x campi).
+    Restituisce (anni trovati, blocco); gli anni seguono l'ordine richiesto
+    e sono solo quelli presenti nelle colonne di `financials`.
+    """
+    available = set(statement_years(financials).dropna().astype(int))
+    found_years = [int(y) for y in years if int(y) in available]
+
+    block = np.full((len(found_years), len(FIELD_MAP)), MISSING_VALUE)
+    if not found_years:
+        return found_years, block
+
+    frames = {'financials': financials, 'balance_sheet': balance_sheet, 'cashflow': cashflow}
+    for statement, frame in frames.items():
+        positions = [i for i, field in enumerate(FIELD_MAP) if field[1] == statement]
+        if frame is None or frame.empty:
+            continue
+        labels = [FIELD_MAP[i][2] for i in positions]
+        values = _frame_by_year(frame).reindex(index=labels, columns=found_years, fill_value=MISSING_VALUE)
+        values = values.apply(pd.to_numeric, errors='coerce')
+        block[:, positions] = values.to_numpy(dtype=float).T
+
+    return found_years, block * FIELD_SCALES
+
+
+def block_to_records(symbol, found_years, block, sector='N/A', industry='N/A', description=None, stock_exchange=None):
+    """Adattatore di output: un dict per anno, nello stesso formato dei record in cache"""
+    records = []
+    for i, year in enumerate(found_years):
+        data = {
+            'symbol': symbol,
+            'sector': sector,
+            'industry': industry,
+            'description': description,
+            'stock_exchange': stock_exchange,
+            'year': year,
+        }
+        data.update(
+            (field, value if np.isfinite(value) else None)
+            for field, value in zip(FIELD_NAMES, block[i].tolist())
+        )
+        records.append(data)
+    return records
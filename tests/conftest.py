@@ -0,0 +1,64 @@
+import os
+import sys
+import tempfile
+
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# cache_db apre data/financials_db.db relativo alla cartella corrente:
+# ogni sessione di test lavora su un DB SQLite vuoto in una cartella temporanea
+os.chdir(tempfile.mkdtemp(prefix='balanceship-tests-'))
+os.environ.setdefault('RAW_ARCHIVE_ENABLED', '0')
+
+from providers import FinancialDataProvider, ProviderError  # noqa: E402
+
+
+@pytest.fixture(scope='session', autouse=True)
+def database():
+    from cache_db import create_tables
+    create_tables()
+
+
+class StaticProvider(FinancialDataProvider):
+    """Provider offline con due anni di prospetti minimi per ogni simbolo"""
+
+    name = 'static'
+
+    def __init__(self, years=(2022, 2023)):
+        self.years = list(years)
+        self.calls = 0
+
+    def get_statements(self, symbol):
+        self.calls += 1
+        columns = [f"{year}-12-31" for year in self.years]
+        financials = pd.DataFrame(
+            [[100.0 + i for i in range(len(columns))], [10.0 + i for i in range(len(columns))]],
+            index=['Total Revenue', 'Net Income'], columns=columns
+        )
+        return {'financials': financials, 'balance_sheet': pd.DataFrame(), 'cashflow': pd.DataFrame()}
+
+    def get_info(self, symbol):
+        return {'sector': 'Energy', 'industry': 'Oil & Gas'}
+
+
+class FailingProvider(StaticProvider):
+    """Ogni download fallisce come un errore upstream transitorio"""
+
+    name = 'failing'
+
+    def get_statements(self, symbol):
+        self.calls += 1
+        raise ProviderError(f"Errore simulato per {symbol}")
+
+
+@pytest.fixture
+def static_provider():
+    return StaticProvider()
+
+
+@pytest.fixture
+def failing_provider():
+    return FailingProvider()
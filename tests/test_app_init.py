@@ -0,0 +1,52 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+
+from conftest import ROOT
+
+# Schema del primo rilascio: un blob JSON per symbol/anno e KPI in JSON, senza
+# colonne né vincoli aggiunti dopo
+BASELINE_SCHEMA = """
+CREATE TABLE cache (id INTEGER PRIMARY KEY AUTOINCREMENT, symbol VARCHAR, year INTEGER, data_json VARCHAR);
+CREATE INDEX ix_cache_symbol ON cache (symbol);
+CREATE INDEX ix_cache_year ON cache (year);
+CREATE TABLE kpi_cache (id INTEGER PRIMARY KEY, symbol VARCHAR, description VARCHAR, year INTEGER, kpi_json TEXT);
+CREATE INDEX ix_kpi_cache_symbol ON kpi_cache (symbol);
+"""
+
+PAGE_STARTUP = """
+from app_init import init_app
+init_app()
+from cache_db import load_from_db
+print(json.dumps(load_from_db('BASE', [2022, 2023])))
+"""
+
+
+def test_startup_migrates_baseline_database(tmp_path):
+    os.makedirs(tmp_path / 'data')
+    conn = sqlite3.connect(tmp_path / 'data' / 'financials_db.db')
+    conn.executescript(BASELINE_SCHEMA)
+    for year, revenue in ((2022, 100.0), (2023, 120.0)):
+        conn.execute('INSERT INTO cache (symbol, year, data_json) VALUES (?, ?, ?)',
+                     ('BASE', year, json.dumps({'symbol': 'BASE', 'year': year, 'total_revenue': revenue})))
+    conn.execute('INSERT INTO kpi_cache (symbol, description, year, kpi_json) VALUES (?, ?, ?, ?)',
+                 ('BASE', 'Base', 2023, json.dumps({'symbol': 'BASE', 'year': 2023})))
+    conn.commit()
+    conn.close()
+
+    # cache_db apre il DB della cartella corrente all'import: processo separato
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    env.pop('STREAMLIT_CLOUD', None)
+    result = subprocess.run([sys.executable, '-c', 'import json' + PAGE_STARTUP],
+                            cwd=tmp_path, env=env, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    records = json.loads(result.stdout.strip().splitlines()[-1])
+    assert [(r['year'], r['total_revenue']) for r in records] == [(2022, 100.0), (2023, 120.0)]
+
+    conn = sqlite3.connect(tmp_path / 'data' / 'financials_db.db')
+    kpi_columns = {row[1] for row in conn.execute('PRAGMA table_info(kpi_cache)')}
+    assert {'kpi_blob', 'content_hash'} <= kpi_columns
+    assert conn.execute('SELECT content_hash FROM kpi_cache').fetchone()[0] is not None
+    conn.close()
@@ -0,0 +1,59 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import IntegrityError
+
+import cache_db
+from cache_db import upsert_financials, load_from_db, Session, FinancialCache
+
+
+def _record(symbol, year, revenue):
+    return {'symbol': symbol, 'year': year, 'sector': 'Energy', 'industry': 'Oil & Gas',
+            'description': symbol, 'stock_exchange': 'TEST', 'total_revenue': revenue, 'net_income': None}
+
+
+def test_upsert_counts_inserted_updated_unchanged():
+    records = [_record('UPS1', 2022, 1.0), _record('UPS1', 2023, 2.0), _record('UPS2', 2023, 3.0)]
+    assert upsert_financials(records) == {'inserted': 3, 'updated': 0, 'unchanged': 0}
+    assert upsert_financials(records) == {'inserted': 0, 'updated': 0, 'unchanged': 3}
+
+    # Stessa chiave due volte nello stesso blocco: vince l'ultima
+    changed = [_record('UPS1', 2023, 2.5), _record('UPS2', 2023, 3.0), _record('UPS2', 2024, 4.0), _record('UPS2', 2024, 4.5)]
+    assert upsert_financials(changed) == {'inserted': 1, 'updated': 1, 'unchanged': 1}
+    assert [r['total_revenue'] for r in load_from_db('UPS1', [2022, 2023], refresh=True)] == [1.0, 2.5]
+    assert load_from_db('UPS2', [2024], refresh=True)[0]['total_revenue'] == 4.5
+
+
+def test_unique_constraint_rejects_duplicate_keys():
+    upsert_financials([_record('UNIQ1', 2023, 1.0)])
+    session = Session()
+    try:
+        session.add(FinancialCache(symbol='UNIQ1', year=2023))
+        with pytest.raises(IntegrityError):
+            session.commit()
+        session.rollback()
+        assert session.query(FinancialCache).filter_by(symbol='UNIQ1').count() == 1
+    finally:
+        session.close()
+
+
+def test_ensure_unique_keys_keeps_the_latest_row(tmp_path, monkeypatch):
+    # Tabella creata prima del vincolo, con doppioni
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as conn:
+        conn.execute(text(
+            'CREATE TABLE negative_cache (id INTEGER PRIMARY KEY AUTOINCREMENT, symbol VARCHAR, year INTEGER, '
+            'reason VARCHAR, retry_after DATETIME, created_at DATETIME)'
+        ))
+        conn.execute(text(
+            "INSERT INTO negative_cache (symbol, year, reason) VALUES "
+            "('DUP', 2022, 'old'), ('DUP', 2023, 'only'), ('DUP', 2022, 'newer'), ('DUP', 2022, 'newest')"
+        ))
+    monkeypatch.setattr(cache_db, 'engine', engine)
+    cache_db._ensure_unique_keys()
+    cache_db._ensure_unique_keys()  # idempotente
+
+    with engine.begin() as conn:
+        rows = conn.execute(text('SELECT id, year, reason FROM negative_cache ORDER BY year')).all()
+        assert [tuple(row) for row in rows] == [(4, 2022, 'newest'), (2, 2023, 'only')]
+        with pytest.raises(IntegrityError):
+            conn.execute(text("INSERT INTO negative_cache (symbol, year, reason) VALUES ('DUP', 2023, 'again')"))
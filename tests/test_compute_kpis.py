@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_utils import compute_kpis, to_numeric_column
+
+
+def test_to_numeric_column_cleans_only_the_leftover_strings():
+    column = pd.Series(['1,234', '(56)', 7, None, 'N/A', '8.5'], dtype=object)
+    values = to_numeric_column(column)
+    assert values.dtype == 'float64'
+    np.testing.assert_array_equal(values.to_numpy(), [1234.0, -56.0, 7.0, np.nan, np.nan, 8.5])
+
+
+def test_compute_kpis_accepts_mixed_inputs():
+    records = [
+        # Record con le chiavi dei campi, valori misti come arrivano dai vecchi JSON
+        {'symbol': 'MIX', 'year': 2023, 'description': 'Mix', 'total_revenue': '200', 'net_income': 20,
+         'total_assets': None, 'ebitda': 'N/A'},
+        # Doppione della stessa chiave: resta il primo
+        {'symbol': 'MIX', 'year': 2023, 'total_revenue': 1.0, 'net_income': 1.0},
+    ]
+    kpis = compute_kpis(records)
+    assert len(kpis) == 1
+    assert kpis['Net Margin'].iloc[0] == pytest.approx(0.10)
+    assert np.isnan(kpis['ROA'].iloc[0]) and np.isnan(kpis['EBITDA Margin'].iloc[0])
+    assert kpis['description'].iloc[0] == 'Mix'
+    assert kpis.attrs['formula_version']
+
+
+def test_compute_kpis_reads_yahoo_labels():
+    # Frame con le etichette Yahoo al posto delle chiavi dei campi
+    kpis = compute_kpis([{'symbol': 'LAB', 'year': 2023, 'Total Revenue': '(1,000)', 'Net Income': 50.0}])
+    assert kpis['Net Margin'].iloc[0] == pytest.approx(-0.05)
+
+
+def test_compute_kpis_single_record_and_zero_division():
+    kpis = compute_kpis({'symbol': 'ZERO', 'year': 2023, 'total_revenue': 0.0, 'net_income': 5.0})
+    assert len(kpis) == 1
+    # Divisione per zero: NaN, mai inf
+    assert np.isnan(kpis['Net Margin'].iloc[0])
+    values = kpis.drop(columns=['symbol', 'year']).to_numpy(dtype=float)
+    assert not np.isinf(values).any()
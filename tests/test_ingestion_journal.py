@@ -0,0 +1,105 @@
+import datetime
+import uuid
+
+import pandas as pd
+
+from cache_db import journal_start_run, journal_summary, journal_latest_open_run, load_negative, save_negative, Session, NegativeCache
+from ingestion import start_run, run_bulk_ingestion
+from rate_limiter import TokenBucket, EMPTY_RESPONSES_THRESHOLD
+from conftest import StaticProvider
+
+YEARS = [2022, 2023]
+
+
+def _jobs(*symbols):
+    return [{'symbol': symbol, 'description': symbol, 'stock_exchange': 'TEST'} for symbol in symbols]
+
+
+class EmptyProvider(StaticProvider):
+    """Yahoo risponde con prospetti vuoti"""
+
+    name = 'empty'
+
+    def get_statements(self, symbol):
+        self.calls += 1
+        return {'financials': pd.DataFrame(), 'balance_sheet': pd.DataFrame(), 'cashflow': pd.DataFrame()}
+
+
+def _new_run(jobs, years):
+    # start_run usa un id al secondo: due run nello stesso test collidono
+    run_id = f"test-{uuid.uuid4().hex}"
+    journal_start_run(run_id, jobs, years)
+    return run_id
+
+
+def _retry_days(symbol, year):
+    session = Session()
+    try:
+        entry = session.query(NegativeCache).filter_by(symbol=symbol, year=year).one()
+        return (entry.retry_after - datetime.datetime.utcnow()).total_seconds() / 86400
+    finally:
+        session.close()
+
+
+def _statuses(run_id):
+    summary = journal_summary(run_id).set_index('stock_exchange')
+    return summary.loc['TEST'].to_dict()
+
+
+def test_resume_retries_failed_tickers(failing_provider, static_provider):
+    jobs = _jobs('RESUME1', 'RESUME2')
+    run_id = start_run(jobs, YEARS, resume=False)
+    run_bulk_ingestion(jobs, YEARS, provider=failing_provider, run_id=run_id, max_workers=1)
+    assert _statuses(run_id)['failed'] == 4
+
+    # Un errore upstream non entra nella cache negativa: il resume riprova davvero
+    assert not load_negative('RESUME1', YEARS)
+    assert journal_latest_open_run() == run_id
+    run_bulk_ingestion(jobs, YEARS, provider=failing_provider, run_id=run_id, max_workers=1)
+    statuses = _statuses(run_id)
+    assert statuses['failed'] == 4 and statuses['empty'] == 0
+
+    run_bulk_ingestion(jobs, YEARS, provider=static_provider, run_id=run_id, max_workers=1)
+    statuses = _statuses(run_id)
+    assert statuses['done'] == 4 and statuses['failed'] == 0
+
+
+def test_negative_cache_skip_is_not_empty(static_provider):
+    jobs = _jobs('SKIPPED1')
+    save_negative('SKIPPED1', [2021], 'no_data')
+    run_id = _new_run(jobs, [2021])
+    run_bulk_ingestion(jobs, [2021], provider=static_provider, run_id=run_id, max_workers=1)
+    statuses = _statuses(run_id)
+    assert statuses['skipped'] == 1 and statuses['empty'] == 0
+    assert static_provider.calls == 0
+
+
+def test_no_data_needs_a_repeated_empty_result():
+    provider = EmptyProvider().with_limiter(TokenBucket(60000))
+    jobs = _jobs('EMPTY1')
+    run_id = _new_run(jobs, [2022])
+    run_bulk_ingestion(jobs, [2022], provider=provider, run_id=run_id, max_workers=1)
+    assert _statuses(run_id)['empty'] == 1
+    # Primo vuoto: si riprova dopo poche ore, non dopo 7 giorni
+    assert _retry_days('EMPTY1', 2022) < 1
+
+    run_id = _new_run(jobs, [2022])
+    run_bulk_ingestion(jobs, [2022], provider=provider, run_id=run_id, force_refresh=True, max_workers=1)
+    assert 6.9 < _retry_days('EMPTY1', 2022) <= 7
+
+
+def test_empty_during_throttle_streak_is_retried():
+    limiter = TokenBucket(60000)
+    limiter.consecutive_empty = EMPTY_RESPONSES_THRESHOLD
+    provider = EmptyProvider().with_limiter(limiter)
+    jobs = _jobs('THROTTLED1')
+    run_id = _new_run(jobs, YEARS)
+    run_bulk_ingestion(jobs, YEARS, provider=provider, run_id=run_id, max_workers=1)
+    statuses = _statuses(run_id)
+    assert statuses['failed'] == 2 and statuses['empty'] == 0
+    assert not load_negative('THROTTLED1', YEARS)
+
+    # Passato il throttling lo stesso run riprova il ticker
+    limiter.consecutive_empty = 0
+    run_bulk_ingestion(jobs, YEARS, provider=StaticProvider(), run_id=run_id, max_workers=1)
+    assert _statuses(run_id)['done'] == 2
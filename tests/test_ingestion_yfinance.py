@@ -0,0 +1,88 @@
+import pandas as pd
+
+from cache_db import journal_summary, load_from_db
+from ingestion import start_run, run_bulk_ingestion
+from providers import YFinanceProvider
+from rate_limiter import TokenBucket
+
+YEARS = [2022, 2023]
+
+
+class FakeTicker:
+    """Finto yf.Ticker: stessi attributi, dati costruiti in locale"""
+
+    # Simboli il cui download fallisce (come un errore di rete di Yahoo)
+    broken = set()
+    created = []
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        FakeTicker.created.append(symbol)
+
+    def _frame(self, rows):
+        if self.symbol.startswith('EMPTY'):
+            return pd.DataFrame()
+        columns = [f"{year}-12-31" for year in YEARS]
+        return pd.DataFrame({column: [value + i for value in rows.values()] for i, column in enumerate(columns)},
+                            index=list(rows))
+
+    @property
+    def financials(self):
+        if self.symbol in FakeTicker.broken:
+            raise ConnectionError(f"Connessione interrotta per {self.symbol}")
+        return self._frame({'Total Revenue': 1000.0, 'Net Income': 100.0})
+
+    @property
+    def balance_sheet(self):
+        return self._frame({'Total Assets': 5000.0})
+
+    @property
+    def cashflow(self):
+        return self._frame({'Free Cash Flow': 80.0})
+
+    @property
+    def info(self):
+        return {'sector': 'Technology', 'industry': 'Software'}
+
+
+def _provider():
+    FakeTicker.broken = set()
+    FakeTicker.created = []
+    return YFinanceProvider(ticker_factory=FakeTicker).with_limiter(TokenBucket(60000))
+
+
+def _jobs(*symbols):
+    return [{'symbol': symbol, 'description': symbol, 'stock_exchange': 'FAKEYF'} for symbol in symbols]
+
+
+def _statuses(run_id):
+    return journal_summary(run_id).set_index('stock_exchange').loc['FAKEYF'].to_dict()
+
+
+def test_bulk_ingestion_partial_failure_and_resume():
+    provider = _provider()
+    FakeTicker.broken = {'YFBAD'}
+    jobs = _jobs('YFOK', 'YFBAD', 'EMPTYYF')
+    run_id = start_run(jobs, YEARS, resume=False)
+
+    records, stats = run_bulk_ingestion(jobs, YEARS, provider=provider, run_id=run_id, max_workers=2)
+    assert sorted((r['symbol'], r['year']) for r in records) == [('YFOK', 2022), ('YFOK', 2023)]
+    assert stats.ok == 1 and stats.failed == 1 and stats.empty == 1
+    statuses = _statuses(run_id)
+    assert statuses['done'] == 2 and statuses['failed'] == 2 and statuses['empty'] == 2
+    assert statuses['pending'] == 0
+    assert len(load_from_db('YFOK', YEARS)) == 2
+
+    # Resume: solo il ticker fallito torna a Yahoo, gli altri sono già chiusi nel journal
+    FakeTicker.broken = set()
+    FakeTicker.created = []
+    records, stats = run_bulk_ingestion(jobs, YEARS, provider=provider, run_id=run_id, max_workers=2)
+    assert set(FakeTicker.created) == {'YFBAD'}
+    assert stats.total == 1 and stats.ok == 1
+    assert {r['year'] for r in records} == set(YEARS)
+    statuses = _statuses(run_id)
+    assert statuses['done'] == 4 and statuses['failed'] == 0 and statuses['empty'] == 2
+
+    # Run completato: un altro resume non ha più nulla da fare
+    records, stats = run_bulk_ingestion(jobs, YEARS, provider=provider, run_id=run_id, max_workers=2)
+    assert stats.total == 0 and records == []
@@ -0,0 +1,64 @@
+import pandas as pd
+import pytest
+
+from cache_db import save_kpis_to_db, upsert_financials, load_kpis_for_symbol_year
+from kpi_materialize import materialize_kpis, input_hashes, INPUT_COLUMNS
+
+
+def _stored(symbol, year):
+    frame = load_kpis_for_symbol_year(symbol, year)
+    return None if frame.empty else frame.iloc[0]
+
+
+def _kpis(symbol, margin):
+    return pd.DataFrame({'symbol': [symbol, symbol], 'year': [2022, 2023], 'description': [symbol, symbol],
+                         'Net Margin': [margin, margin + 0.01]})
+
+
+def _hashes(symbol, value):
+    return pd.Series([value, value], index=pd.MultiIndex.from_tuples([(symbol, 2022), (symbol, 2023)]))
+
+
+def test_save_skips_rows_with_same_version_and_input_hash():
+    kpis = _kpis('SKIP1', 0.10)
+    assert save_kpis_to_db(kpis, formula_version='3', input_hashes=_hashes('SKIP1', 'a')) == {'inserted': 2, 'updated': 0, 'unchanged': 0}
+    assert save_kpis_to_db(kpis, formula_version='3', input_hashes=_hashes('SKIP1', 'a')) == {'inserted': 0, 'updated': 0, 'unchanged': 2}
+
+    # Stessi input: anche con KPI diversi la riga non si riscrive
+    assert save_kpis_to_db(_kpis('SKIP1', 0.50), formula_version='3', input_hashes=_hashes('SKIP1', 'a'))['unchanged'] == 2
+    assert _stored('SKIP1', 2022)['Net Margin'] == pytest.approx(0.10)
+
+    # Input o versione delle formule cambiati: riscrittura
+    assert save_kpis_to_db(kpis, formula_version='3', input_hashes=_hashes('SKIP1', 'b'))['updated'] == 2
+    assert save_kpis_to_db(kpis, formula_version='4', input_hashes=_hashes('SKIP1', 'b'))['updated'] == 2
+    assert save_kpis_to_db(kpis, formula_version='4', input_hashes=_hashes('SKIP1', 'b'))['unchanged'] == 2
+    assert save_kpis_to_db(kpis, formula_version='4', input_hashes=_hashes('SKIP1', 'b'), force=True)['updated'] == 2
+
+
+def _financials(symbol, revenue_by_year):
+    return [{'symbol': symbol, 'year': year, 'description': symbol, 'stock_exchange': 'TEST',
+             'total_revenue': revenue, 'net_income': revenue / 10} for year, revenue in revenue_by_year.items()]
+
+
+def test_single_year_materialization_reads_the_lag_years():
+    upsert_financials(_financials('LAGS1', {2020: 100.0, 2021: 110.0, 2022: 121.0, 2023: 133.1}))
+    counts = materialize_kpis(symbols=['LAGS1'], years=[2023])
+    assert counts['inserted'] == 1 and counts['rows'] == 1
+
+    kpis = _stored('LAGS1', 2023)
+    assert kpis['Total Revenue YoY'] == pytest.approx(0.10)
+    assert kpis['Total Revenue CAGR 3Y'] == pytest.approx(0.10)
+    assert _stored('LAGS1', 2022) is None
+
+    # Input invariati: nessuna riscrittura; cambia un anno precedente: si riscrive
+    assert materialize_kpis(symbols=['LAGS1'], years=[2023])['unchanged'] == 1
+    upsert_financials(_financials('LAGS1', {2022: 120.0}))
+    assert materialize_kpis(symbols=['LAGS1'], years=[2023])['updated'] == 1
+
+
+def test_input_hash_covers_previous_years():
+    frame = pd.DataFrame(_financials('HASH1', {2022: 1.0, 2023: 2.0})).reindex(columns=['symbol', 'year'] + INPUT_COLUMNS)
+    changed = frame.assign(total_revenue=[1.5, 2.0])
+    before, after = input_hashes(frame), input_hashes(changed)
+    assert before[('HASH1', 2022)] != after[('HASH1', 2022)]
+    assert before[('HASH1', 2023)] != after[('HASH1', 2023)]
@@ -0,0 +1,94 @@
+import hashlib
+import json
+
+import numpy as np
+import pytest
+
+from data_utils import compute_kpis
+from kpi_registry import KPI_REGISTRY, KPI_FORMULA_VERSION, KPI_PLAN, TREND_KPIS, lag_positions
+
+# Impronta delle formule per ogni KPI_FORMULA_VERSION: se cambia una formula senza
+# incrementare la versione, KPICache terrebbe i valori calcolati con la formula vecchia
+FORMULA_FINGERPRINTS = {
+    '3': 'e72b6c9d3851741ed1137deded2a4af8232b901872202f207e30967afe842231',
+}
+
+
+def _fingerprint(registry):
+    payload = json.dumps([(kpi[0], kpi[2]) for kpi in registry], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def test_formula_changes_bump_the_version():
+    assert _fingerprint(KPI_REGISTRY) == FORMULA_FINGERPRINTS.get(KPI_FORMULA_VERSION), (
+        "Formule dei KPI cambiate: incrementare KPI_FORMULA_VERSION e registrarne l'impronta qui"
+    )
+
+
+def test_lag_positions_follow_years_not_rows():
+    symbols = ['A', 'A', 'B', 'A', 'B']
+    years = [2020, 2022, 2021, 2021, None]
+    positions = lag_positions(symbols, years, [1, 2])
+    assert positions[1].tolist() == [-1, 3, -1, 0, -1]
+    assert positions[2].tolist() == [-1, 0, -1, -1, -1]
+
+
+# Un simbolo con un anno mancante (2021), righe in ordine sparso e un altro simbolo in mezzo
+GAP_ROWS = [
+    {'symbol': 'GAP', 'year': 2023, 'total_revenue': 165.0, 'net_income': 12.0, 'ebit': 20.0, 'interest_expense': 4.0, 'basic_eps': 1.2},
+    {'symbol': 'OTHER', 'year': 2021, 'total_revenue': 999.0, 'net_income': 1.0, 'ebit': 1.0, 'interest_expense': 1.0, 'basic_eps': 9.9},
+    {'symbol': 'GAP', 'year': 2019, 'total_revenue': 100.0, 'net_income': 10.0, 'ebit': 15.0, 'interest_expense': 5.0, 'basic_eps': 1.0},
+    {'symbol': 'GAP', 'year': 2022, 'total_revenue': 150.0, 'net_income': 15.0, 'ebit': 18.0, 'interest_expense': 0.0, 'basic_eps': 1.5},
+    {'symbol': 'GAP', 'year': 2020, 'total_revenue': 110.0, 'net_income': 11.0, 'ebit': 16.0, 'interest_expense': 4.0, 'basic_eps': 1.1},
+    {'symbol': 'GAP', 'year': 2024, 'total_revenue': 200.0, 'net_income': 30.0, 'ebit': 40.0, 'interest_expense': 5.0, 'basic_eps': 3.0},
+]
+
+
+@pytest.fixture
+def gap_kpis():
+    kpis = compute_kpis(GAP_ROWS)
+    return kpis[kpis['symbol'] == 'GAP'].set_index('year')
+
+
+def test_growth_uses_the_previous_calendar_year(gap_kpis):
+    yoy = gap_kpis['Total Revenue YoY']
+    assert yoy[2020] == pytest.approx(0.10)
+    # 2021 manca: il 2022 non si confronta con il 2020
+    assert np.isnan(yoy[2022])
+    assert yoy[2023] == pytest.approx(0.10)
+    assert np.isnan(yoy[2019])
+
+    cagr = gap_kpis['Total Revenue CAGR 3Y']
+    assert cagr[2022] == pytest.approx(1.5 ** (1 / 3) - 1)
+    assert cagr[2023] == pytest.approx(1.5 ** (1 / 3) - 1)
+    assert np.isnan(cagr[2024])  # 2021 mancante
+
+
+def test_delta_and_volatility_of_percent_kpis(gap_kpis):
+    margins = {2019: 0.10, 2020: 0.10, 2022: 0.10, 2023: 12 / 165, 2024: 0.15}
+    np.testing.assert_allclose(gap_kpis['Net Margin'].loc[list(margins)], list(margins.values()))
+    assert gap_kpis.loc[2023, 'Net Margin Delta'] == pytest.approx(12 / 165 - 0.10)
+    assert np.isnan(gap_kpis.loc[2022, 'Net Margin Delta'])
+
+    volatility = gap_kpis['Net Margin Volatility 3Y']
+    assert volatility[2024] == pytest.approx(np.std([0.15, 12 / 165, 0.10], ddof=1))
+    assert np.isnan(volatility[2023]) and np.isnan(volatility[2022])
+
+
+def test_interest_coverage_and_eps(gap_kpis):
+    assert gap_kpis.loc[2023, 'Interest Coverage'] == pytest.approx(5.0)
+    assert gap_kpis.loc[2019, 'Interest Coverage'] == pytest.approx(3.0)
+    # Oneri finanziari nulli: NaN, non infinito
+    assert np.isnan(gap_kpis.loc[2022, 'Interest Coverage'])
+    assert gap_kpis['EPS'].to_dict() == {2023: 1.2, 2019: 1.0, 2022: 1.5, 2020: 1.1, 2024: 3.0}
+    assert gap_kpis.loc[2023, 'Basic EPS YoY'] == pytest.approx(1.2 / 1.5 - 1)
+    assert np.isnan(gap_kpis.loc[2022, 'Basic EPS YoY'])
+    assert gap_kpis.loc[2024, 'Basic EPS YoY'] == pytest.approx(1.5)
+
+
+def test_trend_kpis_need_the_symbol_history():
+    # Un anno da solo: livelli calcolati, trend tutti NaN
+    single = compute_kpis([row for row in GAP_ROWS if row['year'] == 2023 and row['symbol'] == 'GAP'])
+    assert single['Net Margin'].iloc[0] == pytest.approx(12 / 165)
+    assert single[TREND_KPIS].isna().all(axis=None)
+    assert KPI_PLAN.max_lag == 3
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+
+from cache_db import AGGREGATE_ALL
+from data_utils import read_all_companies
+from percentile_index import PercentileIndex, load_index
+from quantile_sketch import QuantileSketch
+from kpi_aggregates import compute_aggregates
+from cache_db import replace_kpi_aggregates
+
+
+def _write(path, text):
+    path.write_text(text, encoding='utf-8')
+    return str(path)
+
+
+def test_all_view_keeps_each_company_on_its_exchange(tmp_path):
+    exchanges = {
+        'NASDAQ': _write(tmp_path / 'nasdaq.txt', "ticker,description\nAAPL,Apple\nMSFT,Microsoft\n"),
+        'FTSE MIB': _write(tmp_path / 'mib.txt', "ticker,description\nENI.MI,Eni\nA2A.MI,A2A\n"),
+    }
+    companies = read_all_companies(exchanges)
+    exchange_by_symbol = {company['ticker']: company['stock_exchange'] for company in companies}
+    assert exchange_by_symbol == {'AAPL': 'NASDAQ', 'MSFT': 'NASDAQ', 'ENI.MI': 'FTSE MIB', 'A2A.MI': 'FTSE MIB'}
+
+
+def test_ranks_use_the_company_exchange_peers():
+    # Stesso valore, pari diversi: il rank dipende dall'exchange della società
+    peers = {
+        'NASDAQ': np.array([0.30, 0.40, 0.50, 0.60]),
+        'FTSE MIB': np.array([0.05, 0.10, 0.15, 0.20]),
+    }
+    indexes = {
+        exchange: PercentileIndex(exchange, 2023, {('Energy', AGGREGATE_ALL, 'EBITDA Margin'): QuantileSketch.from_values(values)})
+        for exchange, values in peers.items()
+    }
+    value = 0.25
+    assert indexes['FTSE MIB'].rank('EBITDA Margin', value, sector='Energy') == 100.0
+    assert indexes['NASDAQ'].rank('EBITDA Margin', value, sector='Energy') == 0.0
+    ranks = indexes['FTSE MIB'].rank_many('EBITDA Margin', [0.10, 0.12, np.nan], sectors=['Energy', 'Energy', 'Energy'])
+    # Metà dei pari uguali + interpolazione fra i valori del gruppo
+    np.testing.assert_allclose(ranks[:2], [37.5, 47.5])
+    assert np.isnan(ranks[2])
+
+
+def test_index_reads_sketches_from_the_aggregates_table():
+    rng = np.random.default_rng(7)
+    revenue = rng.uniform(100, 1000, 400)
+    frame = pd.DataFrame({
+        'symbol': [f"IDX{i}" for i in range(len(revenue))],
+        'year': 2023,
+        'stock_exchange': 'IDXTEST',
+        'sector': 'Energy',
+        'industry': 'Oil & Gas',
+        'description': None,
+        'total_revenue': revenue,
+        'net_income': revenue * rng.uniform(-0.1, 0.3, len(revenue)),
+    })
+    aggregates = compute_aggregates(frame)
+    assert 'sorted_values' not in aggregates.columns
+    rows = aggregates.astype(object).where(aggregates.notna(), None).to_dict('records')
+    for row in rows:
+        row['year'], row['count'] = int(row['year']), int(row['count'])
+    replace_kpi_aggregates(rows, [('IDXTEST', 2023)])
+
+    index = load_index('IDXTEST', 2023)
+    margins = (frame['net_income'] / frame['total_revenue']).to_numpy()
+    probes = np.quantile(margins, [0.1, 0.5, 0.9])
+    ranks = index.rank_many('Net Margin', probes, sectors=['Energy'] * 3)
+    exact = [(np.sum(margins < p) + np.sum(margins <= p)) / 2 / len(margins) * 100 for p in probes]
+    np.testing.assert_allclose(ranks, exact, atol=1.0)
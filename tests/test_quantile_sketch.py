@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from quantile_sketch import QuantileSketch, SketchError
+
+
+def test_small_groups_are_exact():
+    values = np.random.default_rng(1).lognormal(size=150)
+    sketch = QuantileSketch.from_values(values)
+    quantiles = [0.1, 0.25, 0.5, 0.75, 0.9]
+    np.testing.assert_allclose(sketch.quantile(quantiles), np.quantile(values, quantiles))
+    assert len(sketch) == 150
+
+
+def test_merge_accuracy_across_exchanges():
+    rng = np.random.default_rng(0)
+    exchanges = [rng.standard_t(3, size) * scale for size, scale in ((40_000, 1.0), (5_000, 3.0), (120, 0.5))]
+    merged = QuantileSketch.merge_all(QuantileSketch.from_values(values) for values in exchanges)
+    values = np.concatenate(exchanges)
+    assert len(merged) == len(values)
+    assert merged.min == values.min() and merged.max == values.max()
+
+    # Errore misurato in rank: ogni quantile dello sketch cade vicino al rank atteso
+    ordered = np.sort(values)
+    for q in (0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99):
+        rank = np.searchsorted(ordered, merged.quantile(q)) / len(ordered)
+        assert abs(rank - q) < 0.005
+
+
+def test_incremental_updates_match_batch():
+    values = np.random.default_rng(2).normal(size=50_000)
+    incremental = QuantileSketch()
+    for chunk in np.array_split(values, 500):
+        incremental.update(chunk)
+    assert abs(incremental.median() - np.median(values)) < 0.02
+    assert len(incremental._means) <= incremental.compression
+
+
+def test_serialization_round_trip():
+    sketch = QuantileSketch.from_values(np.random.default_rng(3).normal(size=5_000))
+    restored = QuantileSketch.from_bytes(sketch.to_bytes())
+    np.testing.assert_allclose(restored.quantile([0.1, 0.5, 0.9]), sketch.quantile([0.1, 0.5, 0.9]))
+    with pytest.raises(SketchError):
+        QuantileSketch.from_bytes(sketch.to_bytes()[:-8])
+
+
+def test_rank_matches_percentile_convention():
+    sketch = QuantileSketch.from_values([1.0, 2.0, 3.0, 4.0])
+    ranks = sketch.rank([1.0, 2.5, 0.0, 9.0, np.nan])
+    np.testing.assert_allclose(ranks[:4], [12.5, 50.0, 0.0, 100.0])
+    assert np.isnan(ranks[4])
+
+
+def test_non_finite_values_are_ignored():
+    sketch = QuantileSketch.from_values([1.0, np.nan, np.inf, 3.0])
+    assert len(sketch) == 2 and sketch.median() == 2.0
+    assert np.isnan(QuantileSketch().median())
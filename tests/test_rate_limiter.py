@@ -0,0 +1,108 @@
+import pytest
+
+from rate_limiter import TokenBucket, ShareLimiter, EMPTY_RESPONSES_THRESHOLD
+
+
+class FakeClock:
+    """Orologio finto: sleep fa avanzare il tempo invece di attendere"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        # Come un orologio vero avanza sempre, anche per attese sotto la risoluzione del float
+        seconds = max(seconds, 1e-6)
+        self.now += seconds
+        self.slept += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def _bucket(clock, calls_per_minute=60, **kwargs):
+    return TokenBucket(calls_per_minute, clock=clock, sleep=clock.sleep, **kwargs)
+
+
+def test_refill_rate_after_burst(clock):
+    bucket = _bucket(clock, burst=2)
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.slept == 0
+    # Burst esaurito: un token ogni secondo a 60 chiamate/minuto
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.slept == pytest.approx(3.0)
+
+
+def test_capacity_caps_idle_refill(clock):
+    bucket = _bucket(clock, calls_per_minute=120)
+    assert bucket.capacity == 10
+    for _ in range(10):
+        bucket.acquire()
+    clock.now += 3600
+    for _ in range(10):
+        bucket.acquire()
+    assert clock.slept == 0
+    bucket.acquire()
+    assert clock.slept == pytest.approx(0.5)
+
+
+def test_backoff_doubles_and_recovers(clock):
+    bucket = _bucket(clock, min_backoff=2.0, max_backoff=5.0)
+    bucket.report_throttle()
+    assert bucket.backoff == 2.0 and bucket.throttled
+    bucket.acquire()
+    assert clock.slept == pytest.approx(2.0)
+    bucket.report_throttle()
+    bucket.report_throttle()
+    assert bucket.backoff == 5.0
+    assert bucket.throttle_events == 3
+
+    bucket.report_success()
+    assert bucket.backoff == 2.5
+    bucket.report_success()
+    assert bucket.backoff == 0.0 and not bucket.throttled
+
+
+def test_empty_streak_becomes_throttling(clock):
+    bucket = _bucket(clock)
+    for _ in range(EMPTY_RESPONSES_THRESHOLD - 1):
+        bucket.report_empty()
+    assert bucket.throttle_events == 0
+    bucket.report_success()
+    for _ in range(EMPTY_RESPONSES_THRESHOLD):
+        bucket.report_empty()
+    assert bucket.throttle_events == 1 and bucket.throttled
+
+
+def test_share_fraction_limits_rate_and_consumes_parent(clock):
+    parent = _bucket(clock, calls_per_minute=600, burst=1)
+    share = ShareLimiter(parent, 0.25)
+    assert share.rate == pytest.approx(parent.rate * 0.25)
+    share.tokens = 0.0
+    for _ in range(5):
+        share.acquire()
+    # 5 chiamate alla quota di 2.5/s, non ai 10/s del padre
+    assert clock.slept == pytest.approx(2.0)
+    assert parent.tokens < 1
+
+
+def test_share_forwards_every_report_to_parent(clock):
+    parent = _bucket(clock)
+    share = ShareLimiter(parent, 0.5)
+    share.report_throttle()
+    assert parent.throttle_events == 1 and parent.backoff == 2.0
+
+    share.report_success()
+    assert parent.backoff == 0.0 and share.backoff == 0.0
+
+    for _ in range(EMPTY_RESPONSES_THRESHOLD):
+        share.report_empty()
+    assert parent.throttle_events == 2
+    assert share.throttled and parent.throttled
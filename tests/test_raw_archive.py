@@ -0,0 +1,26 @@
+import os
+
+import pandas as pd
+
+from raw_archive import archive_statements, load_archived, archive_path
+
+
+def _statements(revenue_by_year):
+    columns = [f"{year}-12-31" for year in revenue_by_year]
+    financials = pd.DataFrame([list(revenue_by_year.values())], index=['Total Revenue'], columns=columns)
+    return {'financials': financials, 'balance_sheet': pd.DataFrame(), 'cashflow': pd.DataFrame()}
+
+
+def test_archive_keeps_periods_dropped_by_later_fetches(tmp_path):
+    full_info = {'sector': 'Energy', 'industry': 'Oil & Gas', 'longName': 'Archive Corp'}
+    archive_statements('ARCH', 'TEST', _statements({2021: 10.0, 2022: 20.0, 2023: 30.0}), full_info, root=tmp_path)
+    # Il download successivo non ha più il 2021 e ha il 2023 rivisto
+    archive_statements('ARCH', 'TEST', _statements({2022: 20.0, 2023: 33.0, 2024: 40.0}),
+                       {'sector': 'Energy', 'industry': 'Integrated Oil'}, root=tmp_path)
+
+    statements, info = load_archived('ARCH', 'TEST', root=tmp_path)
+    revenue = statements['financials'].loc['Total Revenue']
+    assert revenue.to_dict() == {'2021-12-31': 10.0, '2022-12-31': 20.0, '2023-12-31': 33.0, '2024-12-31': 40.0}
+    # Il profilo da DB aggiorna sector/industry senza perdere il payload completo
+    assert info == {'sector': 'Energy', 'industry': 'Integrated Oil', 'longName': 'Archive Corp'}
+    assert os.listdir(os.path.dirname(archive_path('ARCH', 'TEST', root=tmp_path))) == ['ARCH.parquet']
@@ -0,0 +1,60 @@
+import threading
+import time
+
+import data_utils
+import singleflight
+from cache_db import Session, FinancialCache, record_to_row, load_from_db, try_acquire_fetch_lock, release_fetch_lock
+from record_cache import RecordCache, _MISSING
+
+
+def _write_from_other_process(symbol, year):
+    # Scrittura diretta sul DB, senza passare dalle invalidazioni di questo processo
+    session = Session()
+    try:
+        row = record_to_row({'symbol': symbol, 'year': year, 'total_revenue': 42.0, 'stock_exchange': 'TEST'})
+        session.execute(FinancialCache.__table__.insert(), [row])
+        session.commit()
+    finally:
+        session.close()
+
+
+def test_singleflight_waiter_sees_rows_written_by_other_process(monkeypatch, failing_provider):
+    symbol, year = 'WAITER1', 2023
+    assert load_from_db(symbol, [year]) == [None]  # "non trovato" ora in cache
+
+    lock_key = f"{symbol}:{year}"
+    assert try_acquire_fetch_lock(lock_key, 'altro-processo')
+
+    def other_process():
+        time.sleep(0.3)
+        _write_from_other_process(symbol, year)
+        release_fetch_lock(lock_key, 'altro-processo')
+
+    monkeypatch.setattr(singleflight, 'DB_LOCK_ENABLED', True)
+    monkeypatch.setattr(singleflight, 'DB_LOCK_POLL_SECONDS', 0.05)
+    writer = threading.Thread(target=other_process)
+    writer.start()
+    data = data_utils.fetch_once(symbol, [year], provider=failing_provider)
+    writer.join()
+
+    assert [record['total_revenue'] for record in data] == [42.0]
+    assert failing_provider.calls == 0
+
+
+def test_put_after_invalidate_is_dropped():
+    cache = RecordCache(maxsize=10)
+    token = cache.token('key')
+    cache.invalidate(['key'])  # scrittura concorrente durante la lettura dal DB
+    assert cache.put('key', 'vecchio', token=token) is False
+    assert cache.get('key') is _MISSING
+
+    token = cache.token('key')
+    assert cache.put('key', 'nuovo', token=token) is True
+    assert cache.get('key') == 'nuovo'
+
+
+def test_clear_makes_pending_tokens_stale():
+    cache = RecordCache(maxsize=10)
+    token = cache.token('key')
+    cache.clear()
+    assert cache.put('key', 'vecchio', token=token) is False
@@ -0,0 +1,50 @@
+import importlib
+
+import pytest
+
+import kpi_registry
+import record_codec
+
+# Blob KPI salvato (schema 2, senza compressione) con Gross Margin=0.5, EPS=2.0 e
+# Equity Ratio Volatility 3Y=0.25: deve decodificarsi con gli stessi nomi per sempre
+STORED_BLOB = bytes.fromhex(
+    '0102004300'  # header: versione 1, schema 2, nessuna compressione, 67 campi
+    '010001000000000004'  # bitmap: campi 0 (Gross Margin), 16 (EPS), 66
+    '000000000000e03f0000000000000040000000000000d03f'
+)
+
+
+def test_stored_blob_keeps_its_names():
+    record = record_codec.decode(STORED_BLOB)
+    assert {name: value for name, value in record.items() if value is not None} == {
+        'Gross Margin': 0.5, 'EPS': 2.0, 'Equity Ratio Volatility 3Y': 0.25,
+    }
+
+
+def test_round_trip_all_registry_kpis():
+    record = {name: float(i) for i, name in enumerate(kpi_registry.KPI_NAMES)}
+    for compression in ('none', 'zlib'):
+        decoded = record_codec.decode(record_codec.encode(record, record_codec.SCHEMA_KPIS, compression))
+        assert {name: decoded[name] for name in record} == record
+
+
+def test_registry_change_keeps_stored_positions(monkeypatch):
+    # Un KPI nuovo (o un riordino del registro) non sposta i campi dei blob già salvati
+    monkeypatch.setattr(kpi_registry, 'KPI_NAMES', list(reversed(kpi_registry.KPI_NAMES)))
+    codec = importlib.reload(record_codec)
+    try:
+        test_stored_blob_keeps_its_names()
+    finally:
+        monkeypatch.undo()
+        importlib.reload(record_codec)
+    assert codec.KPI_SCHEMA_FIELDS[0] == 'Gross Margin'
+
+
+def test_registry_kpi_without_schema_slot_fails_at_import(monkeypatch):
+    monkeypatch.setattr(kpi_registry, 'KPI_NAMES', kpi_registry.KPI_NAMES + ['New KPI'])
+    try:
+        with pytest.raises(RuntimeError, match='New KPI'):
+            importlib.reload(record_codec)
+    finally:
+        monkeypatch.undo()
+        importlib.reload(record_codec)
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from statements import extract_year_block, block_to_records, FIELD_NAMES
+
+
+def _frame(rows, years):
+    columns = pd.to_datetime([f"{year}-12-31" for year in years])
+    return pd.DataFrame.from_dict(rows, orient='index', columns=columns)
+
+
+@pytest.fixture
+def statements():
+    # Yahoo: colonne dalla più recente, valori in unità di valuta
+    years = [2024, 2023, 2021]
+    financials = _frame({
+        'Total Revenue': [4.0e9, 3.0e9, 2.0e9],
+        'Net Income': [4.0e8, np.nan, -1.0e8],
+        'Basic EPS': [1.25, 0.75, -0.5],
+        'Diluted EPS': [1.2, 0.7, -0.5],
+    }, years)
+    balance_sheet = _frame({'Total Assets': [9.0e9, 8.0e9, 7.0e9]}, years)
+    cashflow = _frame({'Free Cash Flow': [5.0e8, 4.0e8]}, [2024, 2023])
+    return financials, balance_sheet, cashflow
+
+
+def test_only_requested_years_in_requested_order(statements):
+    found_years, block = extract_year_block(*statements, [2021, 2022, 2024])
+    # Il 2022 non è nei prospetti, il 2023 non è richiesto
+    assert found_years == [2021, 2024]
+    assert block.shape == (2, len(FIELD_NAMES))
+
+
+def test_records_match_the_cache_format(statements):
+    found_years, block = extract_year_block(*statements, [2023, 2024, 2021])
+    records = block_to_records('TEST', found_years, block, sector='Energy', industry='Oil & Gas',
+                               description='Test', stock_exchange='TEST')
+    by_year = {record['year']: record for record in records}
+    assert [record['year'] for record in records] == [2023, 2024, 2021]
+    assert list(records[0]) == ['symbol', 'sector', 'industry', 'description', 'stock_exchange', 'year'] + FIELD_NAMES
+
+    # Importi in miliardi, EPS non scalato
+    assert by_year[2024]['total_revenue'] == pytest.approx(4.0)
+    assert by_year[2024]['net_income'] == pytest.approx(0.4)
+    assert by_year[2021]['net_income'] == pytest.approx(-0.1)
+    assert by_year[2024]['total_assets'] == pytest.approx(9.0)
+    assert by_year[2024]['basic_eps'] == 1.25 and by_year[2021]['diluted_eps'] == -0.5
+
+    # Voci assenti o NaN: None, non zero
+    assert by_year[2023]['net_income'] is None
+    assert by_year[2021]['free_cash_flow'] is None
+    assert all(by_year[2024][field] is None for field in ('ebitda', 'total_debt', 'gross_profit'))
+
+
+def test_empty_statements_give_missing_fields(statements):
+    financials, _, _ = statements
+    found_years, block = extract_year_block(financials, pd.DataFrame(), None, [2024])
+    record = block_to_records('TEST', found_years, block)[0]
+    assert record['total_revenue'] == pytest.approx(4.0)
+    assert record['total_assets'] is None and record['free_cash_flow'] is None
+
+
+def test_no_financials_no_years(statements):
+    _, balance_sheet, cashflow = statements
+    found_years, block = extract_year_block(pd.DataFrame(), balance_sheet, cashflow, [2023, 2024])
+    assert found_years == [] and block.shape == (0, len(FIELD_NAMES))
+    assert block_to_records('TEST', found_years, block) == []